@@ -40,6 +40,11 @@ try:
     DEFAULT_DOWNLOAD_CONCURRENCY = max(1, int(os.getenv("DEFAULT_DOWNLOAD_CONCURRENCY", "3")))
 except (TypeError, ValueError):
     DEFAULT_DOWNLOAD_CONCURRENCY = 3
+try:
+    # Threads used to hash existing files when rebuilding state from disk
+    HASH_WORKERS = max(1, int(os.getenv("HASH_WORKERS", "8")))
+except (TypeError, ValueError):
+    HASH_WORKERS = 8
 
 # Cache settings
 CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", 600))  # cache valid for 10 minutes by default
@@ -67,3 +72,9 @@ try:
         RCLONE_AUTO_THRESHOLD_GB = 10.0
 except (TypeError, ValueError):
     RCLONE_AUTO_THRESHOLD_GB = 10.0
+
+try:
+    # Concurrent `rclone lsjson` listings when syncing state from a remote
+    RCLONE_LIST_WORKERS = max(1, int(os.getenv("RCLONE_LIST_WORKERS", "4")))
+except (TypeError, ValueError):
+    RCLONE_LIST_WORKERS = 4
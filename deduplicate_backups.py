@@ -4,7 +4,8 @@ Deduplication script for telegram-backup (SQLite backend).
 
 This script:
 1. Scans the backup directory and computes sample hashes for all files
-   (reuses existing DB hashes when available; hashes files missing in DB)
+   (reuses existing DB hashes and the mtime-keyed hash cache when available;
+   hashes the remaining files)
 2. Updates DB records with missing hashes and/or sizes
 3. Rebuilds the global hash index in SQLite
 4. Identifies and moves duplicate files to a 'duplicates' folder
@@ -36,6 +37,11 @@ def _is_duplicate_dir(path):
     return 'duplicates' in parts or 'duplicate' in parts
 
 
+def _skip_scan_dir(path):
+    """Return True for directories the hash scan should not descend into."""
+    return _is_duplicate_dir(path) or '/.backup' in path
+
+
 def _normalize_path(path):
     if not path:
         return None
@@ -71,9 +77,12 @@ def get_backup_dir():
     return os.path.abspath(backup_dir)
 
 
-def scan_and_hash_files(backup_dir, message_index=None):
+def scan_and_hash_files(backup_dir, message_index=None, db_manager=None):
     """
     Recursively scan the backup directory and compute hashes for all files.
+    With db_manager, hashes of files whose mtime and size are unchanged since
+    the last scan come from the DB hash cache, new hashes are stored there and
+    entries for files no longer found (moved, deleted) are dropped.
     Returns: (file_hashes, untracked_files)
     - file_hashes: {file_path: (size, sample_hash)}
     - untracked_files: list of dicts with untracked file details
@@ -81,51 +90,63 @@ def scan_and_hash_files(backup_dir, message_index=None):
     file_hashes = {}
     untracked_files = []
 
-    for root, dirs, files in os.walk(backup_dir):
-        if _is_duplicate_dir(root) or '/.backup' in root:
-            continue
+    root_dir = _normalize_path(backup_dir)
 
+    cached = db_manager.get_cached_sample_hashes(backup_dir) if db_manager is not None else {}
+    cache_rows = []
+    seen_paths = set()
+
+    for entry in utils.iter_files(backup_dir, _skip_scan_dir):
         # Skip files directly in the backup root (only process subfolders)
-        if _normalize_path(root) == _normalize_path(backup_dir):
+        if _normalize_path(os.path.dirname(entry.path)) == root_dir:
             continue
 
-        for filename in files:
-            if filename.startswith('.'):
+        filename = entry.name
+        file_path = entry.path
+
+        try:
+            stat = entry.stat()
+            size = stat.st_size
+            if size == 0:
+                try:
+                    os.remove(file_path)
+                    print(f"  🗑️  Deleted empty file: {filename}")
+                except Exception as e:
+                    print(f"  ⚠️  Failed to delete empty file {filename}: {e}")
                 continue
-
-            file_path = os.path.join(root, filename)
-
-            try:
-                size = os.path.getsize(file_path)
-                if size == 0:
-                    try:
-                        os.remove(file_path)
-                        print(f"  🗑️  Deleted empty file: {filename}")
-                    except Exception as e:
-                        print(f"  ⚠️  Failed to delete empty file {filename}: {e}")
-                    continue
-
-                sample_hash = None
-                if message_index is not None:
-                    normalized = _normalize_path(file_path)
-                    existing = message_index.get(normalized)
-                    if existing and existing.get('sample_hash') and existing.get('file_size') == size:
-                        sample_hash = existing.get('sample_hash')
-                    if not existing:
-                        untracked_files.append({
-                            'path': file_path,
-                            'relative_path': os.path.relpath(file_path, backup_dir),
-                            'size': size
-                        })
-
-                if not sample_hash:
+            seen_paths.add(file_path)
+
+            sample_hash = None
+            if message_index is not None:
+                normalized = _normalize_path(file_path)
+                existing = message_index.get(normalized)
+                if existing and existing.get('sample_hash') and existing.get('file_size') == size:
+                    sample_hash = existing.get('sample_hash')
+                if not existing:
+                    untracked_files.append({
+                        'path': file_path,
+                        'relative_path': os.path.relpath(file_path, backup_dir),
+                        'size': size
+                    })
+
+            if not sample_hash:
+                hit = cached.get(file_path)
+                if hit and hit[0] == stat.st_mtime_ns and hit[1] == size:
+                    sample_hash = hit[2]
+                else:
                     sample_hash = utils.sample_hash_file(file_path)
+                    if sample_hash:
+                        cache_rows.append((file_path, stat.st_mtime_ns, size, sample_hash))
 
-                if sample_hash:
-                    file_hashes[file_path] = (size, sample_hash)
-            except Exception as e:
-                print(f"  ⚠️  Error processing {filename}: {e}")
-                continue
+            if sample_hash:
+                file_hashes[file_path] = (size, sample_hash)
+        except Exception as e:
+            print(f"  ⚠️  Error processing {filename}: {e}")
+            continue
+
+    removed = [path for path in cached if path not in seen_paths]
+    if cache_rows or removed:
+        db_manager.update_hash_cache(cache_rows, removed)
 
     # Attach hashes to untracked entries (only if we computed a hash)
     untracked_by_path = {u['path']: u for u in untracked_files}
@@ -169,14 +190,13 @@ def update_db_hashes(db_manager, message_index, file_hashes):
             cursor.execute(
                 """
                 UPDATE messages
-                SET file_size = ?, sample_hash = ?, file_path = ?, filename = ?
+                SET file_size = ?, sample_hash = ?, file_path = ?
                 WHERE chat_id = ? AND message_id = ?
                 """,
                 (
                     size,
                     sample_hash,
                     file_path,
-                    os.path.basename(file_path),
                     msg.get('chat_id'),
                     msg.get('message_id')
                 )
@@ -212,11 +232,14 @@ def prune_global_index(db_manager):
     """
     removed = 0
     with db_manager.get_cursor(commit=True) as cursor:
-        cursor.execute("SELECT hash_key, first_occurrence_path FROM file_hashes")
+        cursor.execute("SELECT file_size, sample_hash, first_occurrence_path FROM file_hashes")
         for row in cursor.fetchall():
             path = row['first_occurrence_path']
             if not path or not os.path.exists(path):
-                cursor.execute("DELETE FROM file_hashes WHERE hash_key = ?", (row['hash_key'],))
+                cursor.execute(
+                    "DELETE FROM file_hashes WHERE file_size = ? AND sample_hash = ?",
+                    (row['file_size'], row['sample_hash'])
+                )
                 removed += 1
     return removed
 
@@ -296,7 +319,7 @@ def main():
                 message_index[normalized] = dict(row)
 
     print("🔎 Scanning and hashing files...")
-    file_hashes, untracked_files = scan_and_hash_files(backup_dir, message_index)
+    file_hashes, untracked_files = scan_and_hash_files(backup_dir, message_index, db_manager)
     print(f"✓ Hashed {len(file_hashes)} file(s)\n")
 
     if untracked_files:
@@ -10,12 +10,13 @@ from rich.table import Table
 
 console = Console()
 
-def log_debug(message):
+def log_debug(message, *args):
     """
     Print debug message if DEBUG is enabled in config.
+    Any args are %-formatted into message only when DEBUG is on.
     """
     if config.DEBUG:
-        console.log(f"[DEBUG] {message}")
+        console.log(f"[DEBUG] {message % args if args else message}")
 
 
 class DialogSelector:
@@ -32,7 +33,7 @@ class DialogSelector:
         me = await self.client.get_me()
         async for dialog in self.client.iter_dialogs():
             dialogs.append(dialog)
-        log_debug(f"Found {len(dialogs)} dialogs")
+        log_debug("Found %s dialogs", len(dialogs))
         # Ensure 'Saved Messages' is present
         has_saved_messages = any(
             isinstance(d.entity, User) and d.entity.id == me.id 
@@ -3,7 +3,6 @@ Media download logic with progress tracking
 """
 import os
 import asyncio
-import json
 import time
 from datetime import datetime
 from telethon.errors import FloodWaitError, RPCError
@@ -15,13 +14,14 @@ from rich.panel import Panel
 import config
 import utils
 from state_manager import StateManager
+from state_db import json_dumps_bytes, json_loads, state_file_exists
 
 console = Console(width=120) # Set a fixed width for consistent output
 
-def log_debug(message):
-    """Print debug message if DEBUG is enabled"""
+def log_debug(message, *args):
+    """Print debug message if DEBUG is enabled (args are %-formatted lazily)"""
     if config.DEBUG:
-        console.log(f"[DEBUG] {message}")
+        console.log(f"[DEBUG] {message % args if args else message}")
 
 
 class MediaDownloader:
@@ -51,8 +51,8 @@ class MediaDownloader:
         if not os.path.exists(cache_file):
             return None
         try:
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            with open(cache_file, 'rb') as f:
+                data = json_loads(f.read())
             stored_key = data.get('cache_key')
             stored_at = data.get('stored_at', 0)
             if stored_key != cache_key:
@@ -71,8 +71,8 @@ class MediaDownloader:
             'messages': messages
         }
         try:
-            with open(cache_file, 'w', encoding='utf-8') as f:
-                json.dump(payload, f, indent=2)
+            with open(cache_file, 'wb') as f:
+                f.write(json_dumps_bytes(payload))
         except Exception:
             log_debug("Could not write message cache file")
 
@@ -108,6 +108,10 @@ class MediaDownloader:
 
         # Collect messages from scratch
         total_media_messages = 0
+        # Preload downloaded and skipped IDs so the scan tests membership in
+        # memory; only downloaded messages need per-message file validation
+        downloaded_ids = self.state_manager.get_downloaded_message_ids() if self.state_manager else set()
+        skipped_ids = self.state_manager.get_skipped_message_ids() if self.state_manager else set()
         if topic_id is None:
             console.print(f"[bold magenta]🔍 Scanning messages to collect media list...[/bold magenta]")
             async for message in self.client.iter_messages(entity, limit=limit, offset_date=date_to, reverse=False):
@@ -115,9 +119,9 @@ class MediaDownloader:
                     continue
                 if date_to and message.date > date_to:
                     continue
-                if self.state_manager and self.state_manager.validate_downloaded_file(message.id):
+                if message.id in downloaded_ids and self.state_manager.validate_downloaded_file(message.id):
                     continue
-                if self.state_manager and self.state_manager.is_message_skipped(message.id):
+                if message.id in skipped_ids:
                     continue
                 if self.media_filter.should_download(message):
                     reaction_count = self._reaction_count(message) if sort_by == "reactions_desc" else 0
@@ -125,9 +129,9 @@ class MediaDownloader:
                     total_media_messages += 1
         else:
             async for message in self.client.iter_messages(entity, limit=limit, reply_to=topic_id):
-                if self.state_manager and self.state_manager.validate_downloaded_file(message.id):
+                if message.id in downloaded_ids and self.state_manager.validate_downloaded_file(message.id):
                     continue
-                if self.state_manager and self.state_manager.is_message_skipped(message.id):
+                if message.id in skipped_ids:
                     continue
                 if self.media_filter.should_download(message):
                     reaction_count = self._reaction_count(message) if sort_by == "reactions_desc" else 0
@@ -156,12 +160,12 @@ class MediaDownloader:
         async def process_single_message(message):
             try:
                 if self.state_manager and self.state_manager.validate_downloaded_file(message.id):
-                    log_debug(f"Skipping already downloaded message {message.id}")
+                    log_debug("Skipping already downloaded message %s", message.id)
                     self._update_progress(downloaded=1, advance=0)
                     return
 
                 if self.state_manager and self.state_manager.is_message_skipped(message.id):
-                    log_debug(f"Skipping previously skipped message {message.id}")
+                    log_debug("Skipping previously skipped message %s", message.id)
                     self._update_progress(skipped=1, advance=0)
                     return
 
@@ -169,7 +173,7 @@ class MediaDownloader:
                     await self._download_media(message, output_dir)
             except Exception as e:
                 self.stats['errors'] += 1
-                log_debug(f"Unexpected processing error for message {message.id}: {e}")
+                log_debug("Unexpected processing error for message %s: %s", message.id, e)
                 if self.state_manager:
                     self.state_manager.mark_failed(message.id)
                 self._update_progress(errors=1)
@@ -194,11 +198,11 @@ class MediaDownloader:
 
     def _init_and_validate_state(self, chat_name, chat_dir):
         """Initialize state manager and validate existing files."""
-        state_file = os.path.join(self.output_dir, f".backup_state_{StateManager(self.output_dir, chat_name)._sanitize_for_filename(chat_name)}.json")
         self.state_manager = StateManager(self.output_dir, chat_name)
+        state_file = self.state_manager.state_file
         
         # If state file does not exist, generate it from existing files
-        if not os.path.exists(state_file):
+        if not state_file_exists(state_file):
             console.print(f"[bold yellow]⚠️  No state file found. Generating state from existing files in backup folder...[/bold yellow]")
             self.state_manager.generate_state_from_existing_files(chat_dir)
             console.print(f"[green]State file generated. Ready to resume backup.[/green]")
@@ -221,16 +225,15 @@ class MediaDownloader:
             # Validate and count corrupted files (but skip duplicates) - JSON only
             corrupted_count = 0
             if not self.state_manager.use_db:
-                if isinstance(self.state_manager.state['downloaded_messages'], dict):
-                    for msg_id in list(self.state_manager.state['downloaded_messages'].keys()):
-                        # Skip validation for duplicate messages (they don't have their own file)
-                        if self.state_manager.is_duplicate(msg_id):
-                            continue
-                        
-                        if not self.state_manager.validate_downloaded_file(msg_id):
-                            corrupted_count += 1
-                            del self.state_manager.state['downloaded_messages'][msg_id]
-                
+                for msg_id in list(self.state_manager.state['downloaded_messages'].keys()):
+                    # Skip validation for duplicate messages (they don't have their own file)
+                    if self.state_manager.is_duplicate(msg_id):
+                        continue
+                    
+                    if not self.state_manager.validate_downloaded_file(msg_id):
+                        corrupted_count += 1
+                        del self.state_manager.state['downloaded_messages'][msg_id]
+            
                 if corrupted_count > 0:
                     console.print(f"   [bold yellow]⚠️  Found {corrupted_count} missing or corrupted files - will re-download[/bold yellow]")
                 
@@ -282,8 +285,10 @@ class MediaDownloader:
             self.file_progress
         )
         return progress_group
-    def __init__(self, client, media_filter, output_dir, max_file_size=None, simple_mode=False, max_concurrent_downloads=3):
+    def __init__(self, client, media_filter, output_dir, max_file_size=None, simple_mode=False, max_concurrent_downloads=3,
+                 topic_handler=None):
         self.client = client
+        self.topic_handler = topic_handler  # shared so forum topics are scanned once per run
         self.media_filter = media_filter
         self.output_dir = output_dir
         self.max_file_size = max_file_size  # in bytes, None = no limit
@@ -312,22 +317,23 @@ class MediaDownloader:
     
     async def auto_rename_old_topic_folders(self, entity, chat_dir):
         """If chat is a forum, fetch topics and rename old topic folders automatically."""
-        from topic_handler import TopicHandler
-        topic_handler = TopicHandler(self.client)
-        is_forum = await topic_handler.is_forum(entity)
+        if self.topic_handler is None:
+            from topic_handler import TopicHandler
+            self.topic_handler = TopicHandler(self.client)
+        is_forum = self.topic_handler.is_forum(entity)
         if is_forum:
-            topics = await topic_handler.get_topics(entity)
+            topics = await self.topic_handler.get_topics(entity)
             renamed = utils.rename_old_topic_folders(chat_dir, topics)
             if renamed:
                 console.print(f"[bold cyan]📁 Migrated {len(renamed)} old topic folder(s) to new names[/bold cyan]\n")
 
     async def download_from_chat(self, entity, chat_name, limit=None, date_from=None, date_to=None, sort_by=None):
         """Download media from a chat"""
-        log_debug(f"Starting download from chat: {chat_name}")
+        log_debug("Starting download from chat: %s", chat_name)
         chat_dir = utils.create_directory(
             os.path.join(self.output_dir, utils.sanitize_dirname(chat_name))
         )
-        log_debug(f"Output directory: {chat_dir}")
+        log_debug("Output directory: %s", chat_dir)
         
         # Automatically rename old topic folders if this is a forum
         await self.auto_rename_old_topic_folders(entity, chat_dir)
@@ -452,13 +458,13 @@ class MediaDownloader:
 
         # Log media type for debugging
         media_type = type(message.media).__name__ if hasattr(message, 'media') else 'None'
-        log_debug(f"Attempting download for message {message.id}, media type: {media_type}")
+        log_debug("Attempting download for message %s, media type: %s", message.id, media_type)
 
         # Check if this message is already marked as a duplicate
         if self.state_manager:
             canonical_id = self.state_manager.is_duplicate(message.id)
             if canonical_id:
-                log_debug(f"Message {message.id} is marked as duplicate of {canonical_id}, skipping download")
+                log_debug("Message %s is marked as duplicate of %s, skipping download", message.id, canonical_id)
                 self._update_progress(skipped=1, advance=1)
                 return
 
@@ -470,7 +476,7 @@ class MediaDownloader:
                     self.state_manager.mark_skipped(message.id)
                 self.stats['skipped'] += 1
                 self.stats['skipped_size'] += 1
-                log_debug(f"Skipped message {message.id}: file size {utils.format_bytes(file_size)} exceeds limit {utils.format_bytes(self.max_file_size)}")
+                log_debug("Skipped message %s: file size %s exceeds limit %s", message.id, utils.format_bytes(file_size), utils.format_bytes(self.max_file_size))
                 self._update_progress(skipped=1)
                 return
 
@@ -491,32 +497,19 @@ class MediaDownloader:
 
         # If file exists on disk but not tracked, compute hash and add to state
         if file_exists_on_disk and (not file_info or not self.state_manager.validate_downloaded_file(message.id)):
-            actual_size = os.path.getsize(intended_path)
-            sample_hash = utils.sample_hash_file(intended_path)
-            if self.state_manager.use_db:
-                self.state_manager.mark_downloaded(
-                    message.id,
-                    intended_path,
-                    actual_size,
-                    sample_hash=sample_hash
-                )
-            else:
-                self.state_manager.state['downloaded_messages'][str(message.id)] = {
-                    'filename': filename,
-                    'size': actual_size,
-                    'path': intended_path,
-                    'sample_hash': sample_hash
-                }
-                # Update hash index
-                if sample_hash:
-                    self.state_manager._update_hash_index(actual_size, sample_hash, message.id)
-                self.state_manager._save_state()
-            log_debug(f"File {filename} found on disk and added to state with hash. Skipping download.")
+            actual_size, sample_hash = utils.file_fingerprint(intended_path)
+            self.state_manager.mark_downloaded(
+                message.id,
+                intended_path,
+                actual_size,
+                sample_hash=sample_hash
+            )
+            log_debug("File %s found on disk and added to state with hash. Skipping download.", filename)
             return
 
         # If file is tracked and valid, skip download
         if file_info and file_info.get('path') and self.state_manager.validate_downloaded_file(message.id):
-            log_debug(f"File already downloaded and valid: {filename}, skipping download.")
+            log_debug("File already downloaded and valid: %s, skipping download.", filename)
             return
 
         # Check for duplicates by size and hash BEFORE downloading
@@ -546,7 +539,7 @@ class MediaDownloader:
 
                 # Log download attempt details
                 expected_size = self._get_media_size(message)
-                log_debug(f"Starting download to: {filepath}, expected size: {utils.format_bytes(expected_size) if expected_size else 'unknown'}")
+                log_debug("Starting download to: %s, expected size: %s", filepath, utils.format_bytes(expected_size) if expected_size else 'unknown')
 
                 def progress_callback(current, total):
                     if self.file_progress and file_task_id is not None:
@@ -560,7 +553,7 @@ class MediaDownloader:
                 )
 
                 # Log download result
-                log_debug(f"Download result: {result if result else 'None/Failed'}")
+                log_debug("Download result: %s", result if result else 'None/Failed')
 
                 # Remove file task after completion
                 if self.file_progress and file_task_id is not None:
@@ -573,12 +566,12 @@ class MediaDownloader:
                     if actual_size == 0:
                         # Exponential backoff for retries
                         wait_time = config.RETRY_DELAY * (2 ** retries)
-                        log_debug(f"Downloaded file is empty (0 bytes) for message {message.id}: {filename}. Retry {retries + 1}/{config.MAX_RETRIES} after {wait_time}s")
+                        log_debug("Downloaded file is empty (0 bytes) for message %s: %s. Retry %s/%s after %ss", message.id, filename, retries + 1, config.MAX_RETRIES, wait_time)
                         if os.path.exists(result):
                             os.remove(result)
                         retries += 1
                         if retries >= config.MAX_RETRIES:
-                            log_debug(f"Failed to download non-empty file after {config.MAX_RETRIES} attempts: {filename}")
+                            log_debug("Failed to download non-empty file after %s attempts: %s", config.MAX_RETRIES, filename)
                             self.stats['errors'] += 1
                             if self.state_manager:
                                 self.state_manager.mark_failed(message.id)
@@ -606,7 +599,7 @@ class MediaDownloader:
                                     
                                     if existing_msg_id == 'global':
                                         # Cross-chat duplicate (remote or both)
-                                        log_debug(f"Detected cross-chat duplicate (remote): message {message.id} -> {remote_path or storage_status}")
+                                        log_debug("Detected cross-chat duplicate (remote): message %s -> %s", message.id, remote_path or storage_status)
                                         os.remove(result)
                                         self.state_manager.mark_duplicate(message.id, existing_location)
                                         self.stats['skipped'] += 1
@@ -615,7 +608,7 @@ class MediaDownloader:
                                         self._update_progress(skipped=1)
                                     else:
                                         # Same chat duplicate (remote or both)
-                                        log_debug(f"Detected duplicate (remote): message {message.id} is duplicate of {existing_msg_id}")
+                                        log_debug("Detected duplicate (remote): message %s is duplicate of %s", message.id, existing_msg_id)
                                         os.remove(result)
                                         self.state_manager.mark_duplicate(message.id, existing_msg_id)
                                         self.stats['skipped'] += 1
@@ -631,7 +624,7 @@ class MediaDownloader:
                                         if existing_msg_id == 'global':
                                             # Cross-chat duplicate
                                             chat_name = os.path.basename(os.path.dirname(existing_location))
-                                            log_debug(f"Detected cross-chat duplicate: message {message.id} is duplicate of file in chat '{chat_name}'")
+                                            log_debug("Detected cross-chat duplicate: message %s is duplicate of file in chat '%s'", message.id, chat_name)
                                             os.remove(result)
                                             self.state_manager.mark_duplicate(message.id, f"global:{existing_location}")
                                             self.stats['skipped'] += 1
@@ -640,7 +633,7 @@ class MediaDownloader:
                                             self._update_progress(skipped=1)
                                         else:
                                             # Same chat duplicate
-                                            log_debug(f"Detected duplicate: message {message.id} is duplicate of {existing_msg_id}")
+                                            log_debug("Detected duplicate: message %s is duplicate of %s", message.id, existing_msg_id)
                                             os.remove(result)
                                             self.state_manager.mark_duplicate(message.id, existing_msg_id)
                                             self.stats['skipped'] += 1
@@ -660,7 +653,7 @@ class MediaDownloader:
                         if self.state_manager:
                             self.state_manager.mark_downloaded(message.id, result, actual_size, sample_hash=sample_hash)
 
-                    log_debug(f"Successfully downloaded: {filename} ({utils.format_bytes(actual_size)})")
+                    log_debug("Successfully downloaded: %s (%s)", filename, utils.format_bytes(actual_size))
                     if self.simple_mode:
                         console.print(f"[green]✓ Downloaded:[/green] {filename} ({utils.format_bytes(actual_size)})")
                     self._update_progress(downloaded=1)
@@ -668,13 +661,13 @@ class MediaDownloader:
                     self.stats['skipped'] += 1
                     if self.state_manager:
                         self.state_manager.mark_skipped(message.id)
-                    log_debug(f"Skipped: {filename} (no media)")
+                    log_debug("Skipped: %s (no media)", filename)
                     self._update_progress(skipped=1)
                 return
 
             except FloodWaitError as e:
                 wait_time = e.seconds
-                log_debug(f"Rate limited. Waiting {wait_time}s...")
+                log_debug("Rate limited. Waiting %ss...", wait_time)
                 if self.file_progress and file_task_id is not None:
                     self.file_progress.remove_task(file_task_id)
                     file_task_id = None
@@ -691,7 +684,7 @@ class MediaDownloader:
                     self.stats['skipped'] += 1
                     if self.state_manager:
                         self.state_manager.mark_skipped(message.id)
-                    log_debug(f"Skipped: {filename} (file reference expired)")
+                    log_debug("Skipped: %s (file reference expired)", filename)
                     self._update_progress(skipped=1)
                     return
 
@@ -701,7 +694,7 @@ class MediaDownloader:
                     if self.state_manager:
                         self.state_manager.mark_failed(message.id)
                     error_short = error_msg[:60] + "..." if len(error_msg) > 60 else error_msg
-                    log_debug(f"Error: {filename} - {error_short}")
+                    log_debug("Error: %s - %s", filename, error_short)
                     self._update_progress(errors=1)
                     return
 
@@ -786,22 +779,13 @@ class MediaDownloader:
         size_groups = defaultdict(list)
         total_files = 0
         
-        for root, _, files in os.walk(backup_dir):
-            # Skip the duplicates folder itself
-            if 'duplicates' in root:
+        # Skip the duplicates folder itself
+        for entry in utils.iter_files(backup_dir, lambda path: 'duplicates' in path):
+            try:
+                size_groups[entry.stat().st_size].append(entry.path)
+                total_files += 1
+            except Exception:
                 continue
-            for fname in files:
-                if fname.startswith('.'):
-                    continue
-                fpath = os.path.join(root, fname)
-                if not os.path.isfile(fpath):
-                    continue
-                try:
-                    size = os.path.getsize(fpath)
-                    size_groups[size].append(fpath)
-                    total_files += 1
-                except Exception:
-                    continue
         
         console.print(f"[green]Found {total_files} files[/green]")
         
@@ -819,17 +803,22 @@ class MediaDownloader:
                     key = f"{size}:{sample_hash}"
                     sample_hash_groups[key].append(path)
         
-        # Stage 3: For sample hash collisions, verify with full hash (optional)
-        console.print("[dim]Stage 3/3: Identifying duplicates...[/dim]")
+        # Stage 3: For sample hash collisions, verify with full hash
+        console.print("[dim]Stage 3/3: Verifying sample hash collisions...[/dim]")
         duplicate_groups = []
         
         for key, paths in sample_hash_groups.items():
             if len(paths) < 2:
                 continue
             
-            # For files with same size and sample hash, they are duplicates
-            # (sample hash is highly accurate for our use case)
-            duplicate_groups.append(paths)
+            # Only files sharing size and sample hash get a full hash, so
+            # files that differ only in the middle are never moved
+            full_hash_groups = defaultdict(list)
+            for path in paths:
+                full_hash = utils.fast_hash_file(path)
+                if full_hash:
+                    full_hash_groups[full_hash].append(path)
+            duplicate_groups.extend(group for group in full_hash_groups.values() if len(group) > 1)
         
         if not duplicate_groups:
             console.print("[green]✓ No duplicate files found![/green]")
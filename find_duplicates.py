@@ -6,7 +6,8 @@ Usage:
 
 Functional approach:
 1. Group files by size to avoid hashing obviously unique files.
-2. For groups with >1 file, compute SHA-256 hashes in streaming mode.
+2. For groups with >1 file, compute BLAKE3 (if installed) or SHA-256 hashes in
+   streaming mode.
 3. Report groups where multiple files share the same size and hash.
 
 Complexity:
@@ -27,10 +28,27 @@ import sys
 from collections import defaultdict
 from typing import Dict, Iterable, List, Tuple
 
-CHUNK_SIZE = 1024 * 1024  # 1 MiB read size for hashing
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+CHUNK_SIZE = (4 if blake3 else 1) * 1024 * 1024  # read size for hashing
 SAMPLE_SIZE = 64 * 1024  # 64 KiB partial hash window for stage 2
 
 
+def new_digest():
+    """Return a fresh hash object: multithreaded BLAKE3 if available, else SHA-256.
+
+    Digests only group files within one run, so the algorithm can differ between
+    machines without affecting results.
+    """
+
+    if blake3 is not None:
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+    return hashlib.sha256()
+
+
 def iter_files(root: str) -> Iterable[Tuple[str, int]]:
     """Yield (absolute_path, size_bytes) for regular files under root.
 
@@ -55,12 +73,12 @@ def iter_files(root: str) -> Iterable[Tuple[str, int]]:
 
 
 def hash_file(path: str) -> str | None:
-    """Return SHA-256 hex digest for file, streaming in CHUNK_SIZE blocks.
+    """Return hex digest (see new_digest) for file, streaming in CHUNK_SIZE blocks.
 
     On failure, emit a warning and return None so caller can skip the file.
     """
 
-    digest = hashlib.sha256()
+    digest = new_digest()
     try:
         with open(path, "rb") as handle:
             while True:
@@ -76,7 +94,7 @@ def hash_file(path: str) -> str | None:
 
 
 def sample_hash_file(path: str, sample_size: int) -> str | None:
-    """Return SHA-256 digest of first+last N bytes to cheaply rule out mismatches.
+    """Return digest of first+last N bytes to cheaply rule out mismatches.
 
     Uses full file if it is shorter than 2 * sample_size. On failure returns None.
     """
@@ -84,7 +102,7 @@ def sample_hash_file(path: str, sample_size: int) -> str | None:
     if sample_size <= 0:
         return hash_file(path)
 
-    digest = hashlib.sha256()
+    digest = new_digest()
     try:
         with open(path, "rb") as handle:
             # First window
@@ -97,7 +115,7 @@ def sample_hash_file(path: str, sample_size: int) -> str | None:
             except OSError:
                 # File shorter than sample_size; rewind and hash full content once
                 handle.seek(0, os.SEEK_SET)
-                digest = hashlib.sha256()
+                digest = new_digest()
                 while True:
                     chunk = handle.read(CHUNK_SIZE)
                     if not chunk:
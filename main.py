@@ -11,7 +11,7 @@ from datetime import datetime
 from rich.console import Console
 from rich.panel import Panel
 from rich.prompt import Prompt
-from telegram_client import TelegramClientManager, log_debug
+from telegram_client import get_manager, log_debug
 from dialog_selector import DialogSelector
 from media_filter import MediaFilter
 from topic_handler import TopicHandler
@@ -49,7 +49,7 @@ class TelegramMediaBackup:
         self.auto_cloud_mode = auto_cloud_mode
         self.auto_threshold_bytes = auto_threshold_bytes
         self.remote_path_override = remote_path_override
-        self.client_manager = TelegramClientManager()
+        self.client_manager = get_manager()
         self.client = None
         self.last_max_file_size_input = None
         
@@ -121,11 +121,12 @@ class TelegramMediaBackup:
                 output_dir,
                 max_file_size=max_file_size,
                 simple_mode=self.simple_mode,
-                max_concurrent_downloads=download_concurrency
+                max_concurrent_downloads=download_concurrency,
+                topic_handler=topic_handler
             )
 
             # Download from forum or regular chat
-            is_forum = await topic_handler.is_forum(dialog.entity)
+            is_forum = topic_handler.is_forum(dialog.entity)
             if is_forum:
                 await self._download_forum_media(dialog, topic_handler, downloader, message_limit, sort_by)
             else:
@@ -219,12 +220,11 @@ class TelegramMediaBackup:
         
         for topic in topics:
             topic_name = topic_handler.get_topic_name(topic)
-            topic_id = topic.get('id') if isinstance(topic, dict) else getattr(topic, 'id', None)
             
-            if topic_id:
+            if topic.id:
                 await downloader.download_from_topic(
                     dialog.entity,
-                    topic_id,
+                    topic.id,
                     topic_name,
                     chat_dir,
                     limit=limit,
@@ -407,7 +407,7 @@ class TelegramMediaBackup:
             with open(path, 'w', encoding='utf-8') as f:
                 json.dump(data, f, indent=2)
         except Exception as e:
-            log_debug(f"Could not write last config file: {e}")
+            log_debug("Could not write last config file: %s", e)
 
 def print_help():
     """Display help message from help.txt file"""
@@ -431,7 +431,7 @@ def main():
     # Check for logout flag
     if '--logout' in sys.argv or '--signout' in sys.argv:
         console.print("[bold blue]Logging out...[/bold blue]\n")
-        client_manager = TelegramClientManager()
+        client_manager = get_manager()
         asyncio.run(logout_session(client_manager))
         return
     
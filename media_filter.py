@@ -10,10 +10,10 @@ from telethon.tl.types import (
 import config
 
 
-def log_debug(message):
-    """Print debug message if DEBUG is enabled"""
+def log_debug(message, *args):
+    """Print debug message if DEBUG is enabled (args are %-formatted lazily)"""
     if config.DEBUG:
-        print(f"[DEBUG] {message}")
+        print(f"[DEBUG] {message % args if args else message}")
 
 
 class MediaFilter:
@@ -34,7 +34,7 @@ class MediaFilter:
         try:
             return hasattr(message, 'media') and message.media is not None
         except Exception as e:
-            log_debug(f"Error checking if message is media: {e}")
+            log_debug("Error checking if message is media: %s", e)
             return False
     
     def should_download(self, message):
@@ -47,10 +47,10 @@ class MediaFilter:
             media_type = self._get_media_type(message.media)
             should = media_type in self.enabled_types
             if should:
-                log_debug(f"Message {message.id} has media type '{media_type}' - will download")
+                log_debug("Message %s has media type '%s' - will download", message.id, media_type)
             return should
         except Exception as e:
-            log_debug(f"Error determining if should download message {message.id}: {e}")
+            log_debug("Error determining if should download message %s: %s", message.id, e)
             return False
     
     def _get_media_type(self, media):
@@ -83,7 +83,7 @@ class MediaFilter:
                                     return "voice"
                                 return "audio"
                         except Exception as e:
-                            log_debug(f"Error checking document attribute: {e}")
+                            log_debug("Error checking document attribute: %s", e)
                             continue
                 
                 # Check MIME type
@@ -105,7 +105,7 @@ class MediaFilter:
             
             return "unknown"
         except Exception as e:
-            log_debug(f"Error getting media type: {e}")
+            log_debug("Error getting media type: %s", e)
             return "unknown"
     
     def get_filename(self, message):
@@ -141,7 +141,7 @@ class MediaFilter:
                                     return f"{name}.{ext.lower()}"
                                 return filename if filename else f"media_{message.id}"
                             except Exception as e:
-                                log_debug(f"Error extracting filename: {e}")
+                                log_debug("Error extracting filename: %s", e)
                                 break
                 
                 # Generate filename based on type and MIME type
@@ -152,7 +152,7 @@ class MediaFilter:
             
             return f"media_{message.id}"
         except Exception as e:
-            log_debug(f"Error generating filename for message {message.id}: {e}")
+            log_debug("Error generating filename for message %s: %s", message.id, e)
             return f"media_{message.id}"
     
     def _get_extension_from_mime(self, mime_type):
@@ -180,5 +180,5 @@ class MediaFilter:
             
             return mime_map.get(mime_type.lower(), '')
         except Exception as e:
-            log_debug(f"Error getting extension from MIME type '{mime_type}': {e}")
+            log_debug("Error getting extension from MIME type '%s': %s", mime_type, e)
             return ""
@@ -4,12 +4,11 @@ Seed script to import existing JSON state files into SQLite database.
 Scans the backup directory for all state files and populates the database.
 """
 import os
-import json
 import argparse
 from datetime import datetime
 from pathlib import Path
 import config
-from state_db import DatabaseManager
+from state_db import DatabaseManager, json_loads, read_state_file
 
 
 def log_info(message):
@@ -43,6 +42,11 @@ def find_state_files(backup_dir):
     # Look for state files in the backup directory
     for root, _, files in os.walk(backup_dir):
         for fname in files:
+            # Compressed state files (.json.zst) are read through read_state_file
+            if fname.endswith('.json.zst'):
+                fname = fname[:-4]
+                if fname in files:
+                    continue
             if fname.startswith('.backup_state_') and fname.endswith('.json'):
                 fpath = os.path.join(root, fname)
                 if 'global' in fname:
@@ -77,8 +81,7 @@ def import_chat_state(db, state_file, dry_run=False):
         tuple: (success: bool, chat_name: str, stats: dict)
     """
     try:
-        with open(state_file, 'r', encoding='utf-8') as f:
-            state = json.load(f)
+        state = json_loads(read_state_file(state_file))
     except Exception as e:
         return False, None, {'error': f"Failed to read state file: {e}"}
     
@@ -170,29 +173,45 @@ def import_chat_state(db, state_file, dry_run=False):
                 log_error(f"Failed to import message {msg_id_str}: {e}")
                 continue
         
-        # Import skipped messages
-        for msg_id in skipped_messages:
-            try:
-                db.set_message_status(chat_id, msg_id, 'skipped')
-            except Exception as e:
-                log_error(f"Failed to import skipped message {msg_id}: {e}")
-        
-        # Import failed messages
-        for msg_id in failed_messages:
-            try:
-                db.set_message_status(chat_id, msg_id, 'failed')
-            except Exception as e:
-                log_error(f"Failed to import failed message {msg_id}: {e}")
+        # Import skipped and failed messages
+        status_rows = []
+        for status, msg_ids in (('skipped', skipped_messages), ('failed', failed_messages)):
+            for msg_id in msg_ids:
+                try:
+                    status_rows.append((chat_id, int(msg_id), status, None))
+                except Exception as e:
+                    log_error(f"Failed to import {status} message {msg_id}: {e}")
+        try:
+            db.bulk_set_message_status(status_rows)
+        except Exception as e:
+            # One bad row aborts the whole batch; retry row by row so the
+            # good ones still make it in
+            log_error(f"Bulk import of skipped/failed messages failed, retrying per row: {e}")
+            for row_chat_id, msg_id, status, reason in status_rows:
+                try:
+                    db.set_message_status(row_chat_id, msg_id, status, reason)
+                except Exception as e:
+                    log_error(f"Failed to import {status} message {msg_id}: {e}")
         
         # Import duplicates
         duplicate_map = state.get('duplicate_map', {})
+        duplicate_rows = []
         for dup_msg_id_str, canon_msg_id_str in duplicate_map.items():
             try:
                 dup_msg_id = int(dup_msg_id_str)
                 canon_msg_id = int(canon_msg_id_str) if canon_msg_id_str != 'global' else -1
-                db.mark_duplicate(chat_id, dup_msg_id, chat_id, canon_msg_id)
+                duplicate_rows.append((chat_id, dup_msg_id, chat_id, canon_msg_id))
             except Exception as e:
                 log_error(f"Failed to import duplicate mapping {dup_msg_id_str} -> {canon_msg_id_str}: {e}")
+        try:
+            db.bulk_mark_duplicates(duplicate_rows)
+        except Exception as e:
+            log_error(f"Bulk import of duplicate mappings failed, retrying per row: {e}")
+            for row in duplicate_rows:
+                try:
+                    db.mark_duplicate(*row)
+                except Exception as e:
+                    log_error(f"Failed to import duplicate mapping {row[1]} -> {row[3]}: {e}")
         
         stats['imported_messages'] = message_count
         return True, chat_name, stats
@@ -214,8 +233,7 @@ def import_global_state(db, state_file, dry_run=False):
         tuple: (success: bool, stats: dict)
     """
     try:
-        with open(state_file, 'r', encoding='utf-8') as f:
-            state = json.load(f)
+        state = json_loads(read_state_file(state_file))
     except Exception as e:
         return False, {'error': f"Failed to read global state file: {e}"}
     
@@ -367,7 +385,7 @@ def seed_database(backup_dir, db_path=None, dry_run=False, force=False):
     if not dry_run and db:
         # Optimize database
         log_info("\nOptimizing database...")
-        db.vacuum()
+        db.incremental_vacuum()
         db_size = db.get_database_size()
         log_success(f"Database optimized. Final size: {db_size:,} bytes ({db_size / (1024**2):.2f} MB)")
         db.close()
@@ -7,9 +7,290 @@ import os
 import json
 from datetime import datetime
 from contextlib import contextmanager
-from typing import Optional, Dict, List, Tuple, Any
+from typing import Optional, Dict, List, Tuple, Any, Callable
+import queue
 import threading
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Compact JSON output for exports (no indentation or padding)
+JSON_SEPARATORS = (',', ':')
+
+
+def json_dumps_bytes(obj: Any, indent: bool = False) -> bytes:
+    """
+    Serialize obj to UTF-8 JSON bytes, using orjson when available.
+    Compact by default; indent=True gives two-space indentation for files
+    meant to be read by people.
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    if indent:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+    return json.dumps(obj, separators=JSON_SEPARATORS, ensure_ascii=False).encode('utf-8')
+
+
+def json_loads(data: bytes) -> Any:
+    """Parse JSON from bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# JSON state files are stored zstd-compressed as <path>.zst when the optional
+# zstandard package is installed, plain <path> otherwise
+STATE_COMPRESSION_LEVEL = 3
+
+
+def state_file_exists(path: str) -> bool:
+    """True if a JSON state file exists at path, plain or compressed."""
+    return os.path.exists(path) or os.path.exists(f"{path}.zst")
+
+
+def read_state_file(path: str) -> bytes:
+    """
+    Read the raw JSON of a state file, plain or compressed. If both exist the
+    newer one wins (a plain file is written when zstandard is unavailable).
+    
+    Raises:
+        FileNotFoundError: if neither file exists
+    """
+    compressed = f"{path}.zst"
+    if os.path.exists(compressed) and not (
+            os.path.exists(path) and os.path.getmtime(path) > os.path.getmtime(compressed)):
+        if zstandard is None:
+            raise RuntimeError(f"{compressed} is compressed; install zstandard to read it")
+        with open(compressed, 'rb') as f:
+            return zstandard.ZstdDecompressor().decompress(f.read())
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def write_state_file(path: str, data: bytes):
+    """
+    Atomically write the raw JSON of a state file (temporary file + rename),
+    compressed when zstandard is available. Writing compressed removes an
+    older plain copy; a plain write leaves any compressed copy in place.
+    The temporary file is fsynced before the rename, so a power loss cannot
+    swap in an empty or partial file.
+    """
+    if zstandard is not None:
+        target = f"{path}.zst"
+        data = zstandard.ZstdCompressor(level=STATE_COMPRESSION_LEVEL).compress(data)
+    else:
+        target = path
+    tmp_file = f"{target}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, target)
+    if target != path and os.path.exists(path):
+        os.remove(path)
+
+
+# ==================== Hot-path SQL ====================
+# Kept as module-level constants so every call passes the identical string
+# object and sqlite3's per-connection statement cache is hit reliably.
+
+SQL_ADD_MESSAGE = """
+    INSERT INTO messages
+    (chat_id, message_id, file_path, file_size, sample_hash, full_hash,
+     downloaded_at, local_path, remote_path, remote_ref, storage_status,
+     local_verified_at, remote_verified_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(chat_id, message_id) DO UPDATE SET
+        file_path = excluded.file_path,
+        file_size = excluded.file_size,
+        sample_hash = excluded.sample_hash,
+        full_hash = excluded.full_hash,
+        downloaded_at = excluded.downloaded_at,
+        local_path = excluded.local_path,
+        remote_path = excluded.remote_path,
+        remote_ref = excluded.remote_ref,
+        storage_status = excluded.storage_status,
+        local_verified_at = excluded.local_verified_at,
+        remote_verified_at = excluded.remote_verified_at
+"""
+
+SQL_GET_MESSAGE_ROW_ID = "SELECT id FROM messages WHERE chat_id = ? AND message_id = ?"
+
+SQL_GET_MESSAGE = "SELECT * FROM messages WHERE chat_id = ? AND message_id = ?"
+
+SQL_IS_DOWNLOADED = """
+    SELECT local_path, file_path, remote_path, storage_status FROM messages
+    WHERE chat_id = ? AND message_id = ?
+"""
+
+def message_filename(row) -> Optional[str]:
+    """Derive a message's filename from its stored path (filename is not stored)."""
+    path = row['file_path'] or row['local_path'] or row['remote_path']
+    return os.path.basename(path) if path else None
+
+
+def dict_row_factory(cursor: sqlite3.Cursor, row: tuple) -> Dict:
+    """Row factory building plain dicts directly, for results returned as dicts."""
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+def message_row_to_dict(row) -> Dict:
+    """Convert a messages row to a dict, adding the derived 'filename' key."""
+    message = dict(row)
+    message['filename'] = message_filename(row)
+    return message
+
+
+# Same availability rule as is_message_downloaded, for set-based queries
+SQL_DOWNLOADED_CONDITION = """
+    ((storage_status IN ('remote', 'both') AND COALESCE(remote_path, '') != '')
+     OR COALESCE(NULLIF(local_path, ''), file_path, '') != '')
+"""
+
+# Chat totals are adjusted in place so concurrent writers cannot lose updates
+SQL_BUMP_CHAT_STATS = """
+    UPDATE chats
+    SET total_files = total_files + ?, total_bytes = total_bytes + ?,
+        last_message_id = ?, last_updated = ?
+    WHERE chat_id = ?
+"""
+
+SQL_SET_CHAT_LAST_MESSAGE = """
+    UPDATE chats SET last_message_id = ?, last_updated = ?
+    WHERE chat_id = ?
+"""
+
+SQL_SET_STATUS = """
+    INSERT INTO message_status
+    (chat_id, message_id, status, status_reason, updated_at)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(chat_id, message_id) DO UPDATE SET
+        status = excluded.status,
+        status_reason = excluded.status_reason,
+        updated_at = excluded.updated_at
+"""
+
+SQL_GET_STATUS = "SELECT status FROM message_status WHERE chat_id = ? AND message_id = ?"
+
+SQL_REGISTER_HASH = """
+    INSERT INTO file_hashes
+    (file_size, sample_hash, first_occurrence_path, first_message_id,
+     first_chat_id, storage_location, remote_ref)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(file_size, sample_hash) DO NOTHING
+"""
+
+SQL_FIND_DUP_BY_HASH = """
+    SELECT first_occurrence_path, storage_location, remote_ref
+    FROM file_hashes
+    WHERE file_size = ? AND sample_hash = ?
+    LIMIT 1
+"""
+
+SQL_FIND_DUP_IN_CHAT = """
+    SELECT message_id, file_path, local_path, remote_path, storage_status
+    FROM messages
+    WHERE chat_id = ? AND file_size = ? AND sample_hash = ?
+    ORDER BY message_id
+    LIMIT 1
+"""
+
+SQL_MARK_DUPLICATE = """
+    INSERT INTO duplicates
+    (chat_id, duplicate_msg_id, canonical_chat_id, canonical_msg_id)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(chat_id, duplicate_msg_id) DO NOTHING
+"""
+
+SQL_GET_DUPLICATE_INFO = """
+    SELECT canonical_chat_id, canonical_msg_id
+    FROM duplicates
+    WHERE chat_id = ? AND duplicate_msg_id = ?
+"""
+
+
+class ConnectionPool:
+    """
+    Bounded pool of SQLite connections.
+    Connections are opened lazily up to max_size; callers block while all are
+    in use, for at most timeout seconds.
+    """
+    
+    def __init__(self, factory: Callable[[], sqlite3.Connection], max_size: int,
+                 timeout: float = 30.0):
+        """
+        Initialize connection pool.
+        
+        Args:
+            factory: Callable that opens a fully configured connection
+            max_size: Maximum number of open connections
+            timeout: Seconds to wait for a connection when all are in use
+        """
+        self._factory = factory
+        self._max_size = max(1, max_size)
+        self._timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+    
+    def acquire(self) -> sqlite3.Connection:
+        """Take an idle connection, opening a new one if under the limit."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            can_open = self._opened < self._max_size
+            if can_open:
+                self._opened += 1
+        
+        if can_open:
+            try:
+                return self._factory()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        
+        try:
+            return self._idle.get(timeout=self._timeout)
+        except queue.Empty:
+            # Same error SQLite raises when its busy timeout expires
+            raise sqlite3.OperationalError(
+                f"timed out after {self._timeout}s waiting for a pooled database connection"
+            ) from None
+    
+    def release(self, conn: sqlite3.Connection):
+        """Return a connection to the pool."""
+        self._idle.put(conn)
+    
+    def close(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.close()
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    self._opened -= 1
+
 
 class DatabaseManager:
     """
@@ -18,8 +299,27 @@ class DatabaseManager:
     """
     
     # Schema version for migrations
-    SCHEMA_VERSION = 2  # v2: Add remote/local location tracking
+    SCHEMA_VERSION = 9  # v9: Sample hash cache keyed by path, mtime and size
+    
+    # Tables whose row counts are maintained in table_counters
+    COUNTED_TABLES = ('chats', 'messages', 'duplicates', 'file_hashes')
+
+    # Per-connection prepared statement cache (sqlite3 default is 128)
+    STATEMENT_CACHE_SIZE = 512
     
+    # Per-connection page cache (negative = KiB) and memory-mapped I/O limit
+    CACHE_SIZE_KIB = 64 * 1024
+    MMAP_SIZE = 256 * 1024 * 1024
+    # WAL pages accumulated before an automatic checkpoint (default 1000)
+    WAL_AUTOCHECKPOINT_PAGES = 10000
+    
+    # Seconds to wait for a lock or a pooled connection before raising
+    BUSY_TIMEOUT = 30.0
+    
+    # Pool sizes: SQLite serializes writers anyway, readers scale with cores
+    WRITER_POOL_SIZE = 1
+    READER_POOL_SIZE = os.cpu_count() or 1
+
     def __init__(self, db_path: str):
         """
         Initialize database manager.
@@ -28,48 +328,112 @@ class DatabaseManager:
             db_path: Path to SQLite database file
         """
         self.db_path = db_path
-        self._local = threading.local()
+        self._writer_pool = ConnectionPool(self._open_connection, self.WRITER_POOL_SIZE,
+                                           self.BUSY_TIMEOUT)
+        self._reader_pool = ConnectionPool(self._open_connection, self.READER_POOL_SIZE,
+                                           self.BUSY_TIMEOUT)
+        # Writer connection checked out by the current thread, so nested
+        # writes reuse it instead of waiting on the single-writer pool
+        self._writer_owner = threading.local()
+        self._configure_database()
         self._ensure_database()
     
-    def _get_connection(self) -> sqlite3.Connection:
-        """Get thread-local database connection."""
-        if not hasattr(self._local, 'connection') or self._local.connection is None:
-            self._local.connection = sqlite3.connect(
-                self.db_path,
-                check_same_thread=False,
-                timeout=30.0
-            )
-            self._local.connection.row_factory = sqlite3.Row
-            # Enable foreign keys
-            self._local.connection.execute("PRAGMA foreign_keys = ON")
+    def _open_connection(self) -> sqlite3.Connection:
+        """Open a new configured database connection."""
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            timeout=self.BUSY_TIMEOUT,
+            cached_statements=self.STATEMENT_CACHE_SIZE
+        )
+        conn.row_factory = sqlite3.Row
+        # Enable foreign keys
+        conn.execute("PRAGMA foreign_keys = ON")
+        # In WAL mode NORMAL only syncs at checkpoints; a crash can lose the
+        # last commits but never corrupts the database
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute(f"PRAGMA cache_size = -{self.CACHE_SIZE_KIB}")
+        conn.execute(f"PRAGMA mmap_size = {self.MMAP_SIZE}")
+        conn.execute(f"PRAGMA wal_autocheckpoint = {self.WAL_AUTOCHECKPOINT_PAGES}")
+        return conn
+
+    def _configure_database(self):
+        """
+        Apply the persistent database-level settings once, before any pooled
+        connection is opened. Both need a write lock, so running them per
+        connection would stall a reader opened while a transaction is active.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=self.BUSY_TIMEOUT)
+        try:
+            # Incremental auto-vacuum; only takes effect on a new database (before
+            # the first table) or after a full VACUUM, otherwise a no-op
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
             # Enable Write-Ahead Logging for better concurrency
-            self._local.connection.execute("PRAGMA journal_mode = WAL")
-        return self._local.connection
+            conn.execute("PRAGMA journal_mode = WAL")
+        finally:
+            conn.close()
 
     def close(self):
-        """Close thread-local connection if open."""
-        if hasattr(self._local, 'connection') and self._local.connection is not None:
-            try:
-                self._local.connection.close()
-            except Exception:
-                pass
-            finally:
-                self._local.connection = None
+        """Refresh planner statistics and close all pooled connections."""
+        try:
+            self.optimize()
+        except sqlite3.Error:
+            pass
+        self._writer_pool.close()
+        self._reader_pool.close()
     
     @contextmanager
-    def get_cursor(self, commit: bool = False):
+    def get_cursor(self, commit: bool = False, mode: Optional[str] = None,
+                   durable: bool = True):
         """
         Context manager for database cursor with automatic commit/rollback.
+        Writers (commit=True) use the writer pool, everything else the reader pool.
         
         Args:
             commit: Whether to commit on successful completion
+            mode: Transaction mode, 'deferred' or 'immediate'. Writers default to
+                  'immediate' so the write lock is taken up front instead of being
+                  upgraded mid-transaction; readers stay deferred (implicit).
+            durable: If False, run the transaction with PRAGMA synchronous=OFF and
+                     restore the previous setting afterwards. Only for bulk work
+                     that can simply be rerun if the process crashes mid-way.
+        
+        While this thread holds the writer connection (e.g. inside
+        transaction()), nested cursors, readers included, join the outer
+        transaction: they share its connection, so reads see its uncommitted
+        writes, and leave commit/rollback to the outermost block.
             
         Yields:
             sqlite3.Cursor
         """
-        conn = self._get_connection()
+        if mode is None:
+            mode = 'immediate' if commit else 'deferred'
+        if mode not in ('deferred', 'immediate'):
+            raise ValueError(f"Unknown transaction mode: {mode}")
+        
+        outer_conn = getattr(self._writer_owner, 'conn', None)
+        if outer_conn is not None:
+            cursor = outer_conn.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+            return
+        
+        pool = self._writer_pool if commit else self._reader_pool
+        conn = pool.acquire()
+        if commit:
+            self._writer_owner.conn = conn
+        previous_sync = None
+        if not durable:
+            # synchronous cannot be changed inside a transaction
+            previous_sync = conn.execute("PRAGMA synchronous").fetchone()[0]
+            conn.execute("PRAGMA synchronous = OFF")
         cursor = conn.cursor()
         try:
+            if mode == 'immediate' and not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
             yield cursor
             if commit:
                 conn.commit()
@@ -78,6 +442,26 @@ class DatabaseManager:
             raise
         finally:
             cursor.close()
+            if commit:
+                self._writer_owner.conn = None
+            if previous_sync is not None:
+                conn.execute(f"PRAGMA synchronous = {int(previous_sync)}")
+            pool.release(conn)
+    
+    def get_reader_cursor(self):
+        """Cursor from the reader pool (no commit)."""
+        return self.get_cursor(commit=False)
+    
+    def get_writer_cursor(self):
+        """Cursor from the writer pool, committed on success."""
+        return self.get_cursor(commit=True)
+    
+    def transaction(self):
+        """
+        Explicit write transaction (BEGIN IMMEDIATE ... COMMIT, ROLLBACK on error).
+        Group several writes under it so they share one lock and one commit.
+        """
+        return self.get_cursor(commit=True, mode='immediate')
     
     def _ensure_database(self):
         """Create database and tables if they don't exist."""
@@ -101,7 +485,7 @@ class DatabaseManager:
                     self._create_schema(cursor)
                     cursor.execute(
                         "INSERT INTO schema_version (version, description) VALUES (?, ?)",
-                        (self.SCHEMA_VERSION, "Schema v2 with remote/local location tracking")
+                        (self.SCHEMA_VERSION, "Schema v9 with sample hash cache")
                     )
                 else:
                     # Apply migrations
@@ -129,6 +513,108 @@ class DatabaseManager:
                 "INSERT INTO schema_version (version, description) VALUES (?, ?)",
                 (2, "Add remote/local location tracking")
             )
+        if from_version < 3:
+            self._migrate_to_v3(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (3, "Composite (file_size, sample_hash) key for file_hashes")
+            )
+        if from_version < 4:
+            self._create_counters(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (4, "Trigger-maintained status and row counters")
+            )
+        if from_version < 5:
+            self._migrate_to_v5(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (5, "Drop stored filename (derived from path)")
+            )
+        if from_version < 6:
+            self._create_hash_rebuild_index(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (6, "Partial index for hash index rebuilds")
+            )
+        if from_version < 7:
+            # (chat_id, detected_at) also serves every chat_id-only lookup
+            cursor.execute("DROP INDEX IF EXISTS idx_duplicates_chat")
+            self._create_duplicates_chat_index(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (7, "Duplicates index ordered by detection time")
+            )
+        if from_version < 8:
+            self._create_duplicates_detected_index(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (8, "Global duplicates index on detection time")
+            )
+        if from_version < 9:
+            self._create_hash_cache_table(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (9, "Sample hash cache keyed by path, mtime and size")
+            )
+    
+    def _create_hash_rebuild_index(self, cursor: sqlite3.Cursor):
+        """
+        Index matching rebuild_hash_index_from_messages: the partial predicate
+        mirrors its WHERE clause and the column order serves its
+        PARTITION BY file_size, sample_hash ORDER BY downloaded_at.
+        """
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_messages_hash_rebuild
+            ON messages(file_size, sample_hash, downloaded_at)
+            WHERE sample_hash IS NOT NULL AND file_size > 0
+        """)
+    
+    def _create_duplicates_chat_index(self, cursor: sqlite3.Cursor):
+        """
+        Per-chat duplicates index that also yields rows in detected_at order,
+        so get_duplicate_report needs no temp B-tree sort. Joins to messages
+        already use the UNIQUE(chat_id, message_id) index.
+        """
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_duplicates_chat_detected
+            ON duplicates(chat_id, detected_at)
+        """)
+    
+    def _create_duplicates_detected_index(self, cursor: sqlite3.Cursor):
+        """Serves the unfiltered duplicate report's ORDER BY detected_at DESC."""
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_duplicates_detected
+            ON duplicates(detected_at)
+        """)
+    
+    def _create_hash_cache_table(self, cursor: sqlite3.Cursor):
+        """
+        Cache of sample hashes for local files, valid while the file's mtime
+        and size are unchanged, so re-syncs do not re-read unchanged files.
+        """
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS hash_cache (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                file_size INTEGER NOT NULL,
+                sample_hash TEXT NOT NULL
+            ) WITHOUT ROWID
+        """)
+    
+    def _migrate_to_v5(self, cursor: sqlite3.Cursor):
+        """
+        Migrate schema from v4 to v5: drop messages.filename, which duplicated
+        basename(file_path) in every row. Requires SQLite >= 3.35; on older
+        versions the column is left in place and simply no longer written.
+        """
+        cursor.execute("PRAGMA table_info(messages)")
+        columns = {row['name'] for row in cursor.fetchall()}
+        if 'filename' not in columns:
+            return
+        if sqlite3.sqlite_version_info < (3, 35, 0):
+            return
+        cursor.execute("ALTER TABLE messages DROP COLUMN filename")
     
     def _migrate_to_v2(self, cursor: sqlite3.Cursor):
         """Migrate schema from v1 to v2: add location tracking fields."""
@@ -176,6 +662,41 @@ class DatabaseManager:
             CREATE INDEX IF NOT EXISTS idx_messages_storage_status ON messages(storage_status)
         """)
 
+    def _migrate_to_v3(self, cursor: sqlite3.Cursor):
+        """Migrate schema from v2 to v3: replace hash_key TEXT PK with (file_size, sample_hash)."""
+        self._create_file_hashes_table(cursor, "file_hashes_v3")
+        
+        # Keep the earliest registration for each (size, hash) pair
+        cursor.execute("""
+            INSERT OR IGNORE INTO file_hashes_v3
+            (file_size, sample_hash, first_occurrence_path, first_message_id,
+             first_chat_id, storage_location, remote_ref, created_at)
+            SELECT file_size, sample_hash, first_occurrence_path, first_message_id,
+                   first_chat_id, storage_location, remote_ref, created_at
+            FROM file_hashes
+            ORDER BY created_at ASC
+        """)
+        cursor.execute("DROP TABLE file_hashes")
+        cursor.execute("ALTER TABLE file_hashes_v3 RENAME TO file_hashes")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_hashes_sample_hash ON file_hashes(sample_hash)")
+
+    def _create_file_hashes_table(self, cursor: sqlite3.Cursor, table_name: str = "file_hashes"):
+        """Create the global hash index table keyed by (file_size, sample_hash)."""
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                file_size INTEGER NOT NULL,
+                sample_hash TEXT NOT NULL,
+                first_occurrence_path TEXT,
+                first_message_id INTEGER,
+                first_chat_id INTEGER,
+                storage_location TEXT DEFAULT 'local',
+                remote_ref TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (file_size, sample_hash),
+                FOREIGN KEY (first_message_id) REFERENCES messages(id) ON DELETE SET NULL,
+                FOREIGN KEY (first_chat_id) REFERENCES chats(chat_id) ON DELETE SET NULL
+            ) WITHOUT ROWID
+        """)
     
     def _create_schema(self, cursor: sqlite3.Cursor):
         """Create all tables and indexes."""
@@ -202,7 +723,6 @@ class DatabaseManager:
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 chat_id INTEGER NOT NULL,
                 message_id INTEGER NOT NULL,
-                filename TEXT,
                 file_path TEXT,
                 file_size INTEGER,
                 sample_hash TEXT,
@@ -225,27 +745,13 @@ class DatabaseManager:
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_file_size ON messages(file_size)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_remote_path ON messages(remote_path)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_storage_status ON messages(storage_status)")
+        self._create_hash_rebuild_index(cursor)
         
-        # File hashes table (global index)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS file_hashes (
-                hash_key TEXT PRIMARY KEY,
-                file_size INTEGER NOT NULL,
-                sample_hash TEXT NOT NULL,
-                first_occurrence_path TEXT,
-                first_message_id INTEGER,
-                first_chat_id INTEGER,
-                storage_location TEXT DEFAULT 'local',
-                remote_ref TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (first_message_id) REFERENCES messages(id) ON DELETE SET NULL,
-                FOREIGN KEY (first_chat_id) REFERENCES chats(chat_id) ON DELETE SET NULL
-            )
-        """)
+        # File hashes table (global index); the (file_size, sample_hash) primary
+        # key also serves size-only lookups, so no separate size index is needed
+        self._create_file_hashes_table(cursor)
         
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_hashes_sample_hash ON file_hashes(sample_hash)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_hashes_size ON file_hashes(file_size)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_hashes_composite ON file_hashes(file_size, sample_hash)")
         
         # Duplicates table
         cursor.execute("""
@@ -263,7 +769,8 @@ class DatabaseManager:
         """)
         
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_duplicates_canonical ON duplicates(canonical_chat_id, canonical_msg_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_duplicates_chat ON duplicates(chat_id)")
+        self._create_duplicates_chat_index(cursor)
+        self._create_duplicates_detected_index(cursor)
         
         # Message status table
         cursor.execute("""
@@ -281,6 +788,89 @@ class DatabaseManager:
         
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_message_status_status ON message_status(status)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_message_status_chat ON message_status(chat_id)")
+        
+        self._create_hash_cache_table(cursor)
+        self._create_counters(cursor)
+    
+    def _create_counters(self, cursor: sqlite3.Cursor):
+        """
+        Create counter tables kept up to date by triggers, and seed them from current data.
+        Turns status/row COUNT(*) scans into point lookups.
+        """
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS status_counters (
+                chat_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (chat_id, status)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS table_counters (
+                table_name TEXT PRIMARY KEY,
+                count INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        
+        # Per-chat status counts
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_message_status_insert
+            AFTER INSERT ON message_status
+            BEGIN
+                INSERT INTO status_counters (chat_id, status, count)
+                VALUES (NEW.chat_id, NEW.status, 1)
+                ON CONFLICT(chat_id, status) DO UPDATE SET count = count + 1;
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_message_status_update
+            AFTER UPDATE OF chat_id, status ON message_status
+            WHEN OLD.status IS NOT NEW.status OR OLD.chat_id IS NOT NEW.chat_id
+            BEGIN
+                UPDATE status_counters SET count = count - 1
+                WHERE chat_id = OLD.chat_id AND status = OLD.status;
+                INSERT INTO status_counters (chat_id, status, count)
+                VALUES (NEW.chat_id, NEW.status, 1)
+                ON CONFLICT(chat_id, status) DO UPDATE SET count = count + 1;
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_message_status_delete
+            AFTER DELETE ON message_status
+            BEGIN
+                UPDATE status_counters SET count = count - 1
+                WHERE chat_id = OLD.chat_id AND status = OLD.status;
+            END
+        """)
+        
+        # Whole-table row counts
+        for table in self.COUNTED_TABLES:
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_count_insert
+                AFTER INSERT ON {table}
+                BEGIN
+                    UPDATE table_counters SET count = count + 1 WHERE table_name = '{table}';
+                END
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_count_delete
+                AFTER DELETE ON {table}
+                BEGIN
+                    UPDATE table_counters SET count = count - 1 WHERE table_name = '{table}';
+                END
+            """)
+        
+        # Seed from existing rows
+        cursor.execute("DELETE FROM status_counters")
+        cursor.execute("""
+            INSERT INTO status_counters (chat_id, status, count)
+            SELECT chat_id, status, COUNT(*) FROM message_status GROUP BY chat_id, status
+        """)
+        for table in self.COUNTED_TABLES:
+            cursor.execute(f"""
+                INSERT OR REPLACE INTO table_counters (table_name, count)
+                SELECT '{table}', COUNT(*) FROM {table}
+            """)
     
     # ==================== Chat Operations ====================
     
@@ -345,6 +935,25 @@ class DatabaseManager:
                 query = f"UPDATE chats SET {', '.join(updates)} WHERE chat_id = ?"
                 cursor.execute(query, params)
     
+    def bump_chat_stats(self, chat_id: int, files_delta: int = 0, bytes_delta: int = 0,
+                        last_message_id: int = None):
+        """
+        Adjust chat totals by the given deltas in a single UPDATE (no read of the
+        current values), optionally setting last_message_id.
+        """
+        now = datetime.now().isoformat()
+        with self.get_cursor(commit=True) as cursor:
+            if last_message_id is None:
+                cursor.execute("""
+                    UPDATE chats
+                    SET total_files = total_files + ?, total_bytes = total_bytes + ?,
+                        last_updated = ?
+                    WHERE chat_id = ?
+                """, (files_delta, bytes_delta, now, chat_id))
+            else:
+                cursor.execute(SQL_BUMP_CHAT_STATS, (files_delta, bytes_delta,
+                                                     last_message_id, now, chat_id))
+    
     def mark_chat_completed(self, chat_id: int):
         """Mark chat backup as completed."""
         with self.get_cursor(commit=True) as cursor:
@@ -381,6 +990,7 @@ class DatabaseManager:
         Add or update a downloaded message with location tracking.
         
         Args:
+            filename: Accepted for compatibility; the filename is derived from the path
             storage_status: 'local', 'remote', or 'both'
         
         Returns:
@@ -395,54 +1005,55 @@ class DatabaseManager:
         remote_verified = now if remote_path else None
         
         with self.get_cursor(commit=True) as cursor:
-            cursor.execute("""
-                INSERT INTO messages 
-                (chat_id, message_id, filename, file_path, file_size, sample_hash, full_hash, 
-                 downloaded_at, local_path, remote_path, remote_ref, storage_status,
-                 local_verified_at, remote_verified_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ON CONFLICT(chat_id, message_id) DO UPDATE SET
-                    filename = excluded.filename,
-                    file_path = excluded.file_path,
-                    file_size = excluded.file_size,
-                    sample_hash = excluded.sample_hash,
-                    full_hash = excluded.full_hash,
-                    downloaded_at = excluded.downloaded_at,
-                    local_path = excluded.local_path,
-                    remote_path = excluded.remote_path,
-                    remote_ref = excluded.remote_ref,
-                    storage_status = excluded.storage_status,
-                    local_verified_at = excluded.local_verified_at,
-                    remote_verified_at = excluded.remote_verified_at
-            """, (chat_id, message_id, filename, file_path or local_path, file_size, 
+            cursor.execute(SQL_ADD_MESSAGE, (chat_id, message_id, file_path or local_path, file_size, 
                   sample_hash, full_hash, now, local_path, remote_path, remote_ref,
                   storage_status, local_verified, remote_verified))
 
-            cursor.execute(
-                "SELECT id FROM messages WHERE chat_id = ? AND message_id = ?",
-                (chat_id, message_id)
-            )
+            cursor.execute(SQL_GET_MESSAGE_ROW_ID, (chat_id, message_id))
             row = cursor.fetchone()
             return row['id'] if row else cursor.lastrowid
     
+    def add_messages_bulk(self, chat_id: int, records: List[Dict]) -> int:
+        """
+        Add or update many messages of one chat in a single transaction.
+        
+        Args:
+            chat_id: Chat ID the messages belong to
+            records: Dicts with the add_message keyword arguments (message_id
+                     required; file_path, file_size, sample_hash, full_hash,
+                     local_path, remote_path, remote_ref, storage_status optional)
+        
+        Returns:
+            Number of message rows written
+        """
+        now = datetime.now().isoformat()
+        
+        def params():
+            for record in records:
+                local_path = record.get('local_path') or record.get('file_path')
+                remote_path = record.get('remote_path')
+                yield (chat_id, record['message_id'], record.get('file_path') or local_path,
+                       record.get('file_size', 0), record.get('sample_hash'),
+                       record.get('full_hash'), now, local_path, remote_path,
+                       record.get('remote_ref'), record.get('storage_status', 'local'),
+                       now if local_path else None, now if remote_path else None)
+        
+        with self.transaction() as cursor:
+            cursor.executemany(SQL_ADD_MESSAGE, params())
+            return max(cursor.rowcount, 0)
+    
     def get_message(self, chat_id: int, message_id: int) -> Optional[Dict]:
         """Get message info."""
         with self.get_cursor() as cursor:
-            cursor.execute("""
-                SELECT * FROM messages 
-                WHERE chat_id = ? AND message_id = ?
-            """, (chat_id, message_id))
+            cursor.execute(SQL_GET_MESSAGE, (chat_id, message_id))
             
             row = cursor.fetchone()
-            return dict(row) if row else None
+            return message_row_to_dict(row) if row else None
     
     def is_message_downloaded(self, chat_id: int, message_id: int) -> bool:
         """Check if message has an available file location (local or remote)."""
         with self.get_cursor() as cursor:
-            cursor.execute("""
-                SELECT local_path, file_path, remote_path, storage_status FROM messages
-                WHERE chat_id = ? AND message_id = ?
-            """, (chat_id, message_id))
+            cursor.execute(SQL_IS_DOWNLOADED, (chat_id, message_id))
 
             row = cursor.fetchone()
             if not row:
@@ -457,26 +1068,93 @@ class DatabaseManager:
 
             return bool(local_path)
     
-    def get_all_messages(self, chat_id: int) -> List[Dict]:
-        """Get all messages for a chat."""
+    def known_message_ids(self, chat_id: int) -> set:
+        """Return the set of message IDs in a chat that have a messages row."""
+        with self.get_cursor() as cursor:
+            cursor.execute("SELECT message_id FROM messages WHERE chat_id = ?", (chat_id,))
+            return {row[0] for row in cursor}
+    
+    def downloaded_message_ids(self, chat_id: int) -> set:
+        """
+        Return the set of message IDs in a chat that have an available file location.
+        Lets callers scanning many messages test membership in memory instead of
+        issuing one is_message_downloaded query per message.
+        """
+        with self.get_cursor() as cursor:
+            cursor.execute(f"""
+                SELECT message_id FROM messages
+                WHERE chat_id = ? AND {SQL_DOWNLOADED_CONDITION}
+            """, (chat_id,))
+            return {row[0] for row in cursor}
+    
+    def filter_undownloaded(self, chat_id: int, message_ids: List[int]) -> List[int]:
+        """
+        Return the subset of message_ids that are not downloaded, in one query.
+        IDs are passed as a single JSON array parameter and joined against the
+        messages primary key, avoiding per-ID round-trips and bound-parameter limits.
+        """
+        if not message_ids:
+            return []
+        with self.get_cursor() as cursor:
+            cursor.execute(f"""
+                SELECT ids.value FROM json_each(?) AS ids
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM messages
+                    WHERE chat_id = ? AND message_id = ids.value
+                    AND {SQL_DOWNLOADED_CONDITION}
+                )
+            """, (json.dumps([int(m) for m in message_ids]), chat_id))
+            return [row[0] for row in cursor]
+    
+    def iter_messages(self, chat_id: int):
+        """
+        Stream all messages for a chat, one dict at a time.
+        The pooled connection is held until the iterator is exhausted or closed.
+        """
         with self.get_cursor() as cursor:
             cursor.execute("""
                 SELECT * FROM messages WHERE chat_id = ?
                 ORDER BY message_id
             """, (chat_id,))
             
-            return [dict(row) for row in cursor.fetchall()]
+            for row in cursor:
+                yield message_row_to_dict(row)
+    
+    def get_all_messages(self, chat_id: int) -> List[Dict]:
+        """Get all messages for a chat."""
+        return list(self.iter_messages(chat_id))
+    
+    def get_message_locations_by_chat(self) -> Dict[int, List[Dict]]:
+        """
+        Location columns (message_id, file_path, local_path, remote_path,
+        remote_ref) of every message, grouped by chat_id, in a single query.
+        """
+        by_chat = {}
+        with self.get_cursor() as cursor:
+            cursor.execute("""
+                SELECT chat_id, message_id, file_path, local_path, remote_path, remote_ref
+                FROM messages
+            """)
+            for row in cursor:
+                by_chat.setdefault(row['chat_id'], []).append(dict(row))
+        return by_chat
     
     def update_file_path(self, old_path: str, new_path: str) -> bool:
         """Update file path for a message."""
         with self.get_cursor(commit=True) as cursor:
-            cursor.execute("""
+            # Resolve affected rows via the file_path index, then update by rowid
+            cursor.execute("SELECT id FROM messages WHERE file_path = ?", (old_path,))
+            row_ids = [row['id'] for row in cursor.fetchall()]
+            if not row_ids:
+                return False
+            
+            cursor.executemany("""
                 UPDATE messages 
-                SET file_path = ?, filename = ?, local_path = ?
-                WHERE file_path = ?
-            """, (new_path, os.path.basename(new_path), new_path, old_path))
+                SET file_path = ?, local_path = ?
+                WHERE id = ?
+            """, [(new_path, new_path, row_id) for row_id in row_ids])
             
-            return cursor.rowcount > 0
+            return True
     
     def update_message_location(self, chat_id: int, message_id: int,
                                local_path: str = None, remote_path: str = None,
@@ -543,15 +1221,7 @@ class DatabaseManager:
 
             updated = cursor.rowcount > 0
             if updated:
-                cursor.execute("""
-                    INSERT INTO message_status
-                    (chat_id, message_id, status, status_reason, updated_at)
-                    VALUES (?, ?, ?, ?, ?)
-                    ON CONFLICT(chat_id, message_id) DO UPDATE SET
-                        status = excluded.status,
-                        status_reason = excluded.status_reason,
-                        updated_at = excluded.updated_at
-                """, (
+                cursor.execute(SQL_SET_STATUS, (
                     chat_id,
                     message_id,
                     'missing',
@@ -589,21 +1259,69 @@ class DatabaseManager:
         Args:
             storage_location: 'local', 'remote', or 'both'
         """
-        hash_key = f"{file_size}:{sample_hash}"
+        with self.get_cursor(commit=True) as cursor:
+            # Existing entries are left untouched by ON CONFLICT DO NOTHING
+            cursor.execute(SQL_REGISTER_HASH, (file_size, sample_hash, file_path, message_id, chat_id,
+                  storage_location, remote_ref))
+    
+    def bulk_register_file_hashes(self, rows: List[Tuple[int, str, Optional[str]]]) -> int:
+        """
+        Register many files in the global hash index in a single transaction.
+        Existing entries are kept (first occurrence wins).
+        
+        Args:
+            rows: Tuples of (file_size, sample_hash, file_path)
         
+        Returns:
+            Number of new entries
+        """
         with self.get_cursor(commit=True) as cursor:
-            # Check if already exists
-            cursor.execute("SELECT hash_key FROM file_hashes WHERE hash_key = ?", (hash_key,))
-            if cursor.fetchone():
-                return  # Already registered
-            
+            cursor.executemany(SQL_REGISTER_HASH, (
+                (file_size, sample_hash, file_path, None, None, 'local', None)
+                for file_size, sample_hash, file_path in rows
+            ))
+            return max(cursor.rowcount, 0)
+    
+    def get_cached_sample_hashes(self, directory: str) -> Dict[str, Tuple[int, int, str]]:
+        """
+        Return cached sample hashes for files under directory.
+        
+        Returns:
+            Dict mapping path -> (mtime_ns, file_size, sample_hash); an entry is
+            only valid while the file's mtime_ns and size still match
+        """
+        prefix = os.path.join(directory, '')
+        # Range scan on the primary key: every path starting with prefix
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        with self.get_cursor() as cursor:
             cursor.execute("""
-                INSERT INTO file_hashes 
-                (hash_key, file_size, sample_hash, first_occurrence_path, first_message_id, 
-                 first_chat_id, storage_location, remote_ref)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (hash_key, file_size, sample_hash, file_path, message_id, chat_id,
-                  storage_location, remote_ref))
+                SELECT path, mtime_ns, file_size, sample_hash FROM hash_cache
+                WHERE path >= ? AND path < ?
+            """, (prefix, upper))
+            return {row[0]: (row[1], row[2], row[3]) for row in cursor}
+    
+    def update_hash_cache(self, rows: List[Tuple[str, int, int, str]],
+                          removed_paths: List[str] = ()) -> int:
+        """
+        Store sample hashes in the cache and drop entries for removed files,
+        in a single transaction.
+        
+        Args:
+            rows: Tuples of (path, mtime_ns, file_size, sample_hash)
+            removed_paths: Paths whose cache entries should be deleted
+        
+        Returns:
+            Number of entries written
+        """
+        with self.transaction() as cursor:
+            if removed_paths:
+                cursor.executemany("DELETE FROM hash_cache WHERE path = ?",
+                                   ((path,) for path in removed_paths))
+            cursor.executemany("""
+                INSERT OR REPLACE INTO hash_cache (path, mtime_ns, file_size, sample_hash)
+                VALUES (?, ?, ?, ?)
+            """, rows)
+            return max(cursor.rowcount, 0)
     
     def find_duplicate_by_hash(self, file_size: int, sample_hash: str) -> Optional[Dict]:
         """
@@ -612,14 +1330,8 @@ class DatabaseManager:
         Returns:
             Dict with 'path', 'storage_location', 'remote_ref', or None
         """
-        hash_key = f"{file_size}:{sample_hash}"
-        
         with self.get_cursor() as cursor:
-            cursor.execute("""
-                SELECT first_occurrence_path, storage_location, remote_ref 
-                FROM file_hashes 
-                WHERE hash_key = ?
-            """, (hash_key,))
+            cursor.execute(SQL_FIND_DUP_BY_HASH, (file_size, sample_hash))
             
             row = cursor.fetchone()
             if not row:
@@ -640,13 +1352,7 @@ class DatabaseManager:
             Dict with 'message_id', 'file_path', 'local_path', 'remote_path', or None
         """
         with self.get_cursor() as cursor:
-            cursor.execute("""
-                SELECT message_id, file_path, local_path, remote_path, storage_status
-                FROM messages
-                WHERE chat_id = ? AND file_size = ? AND sample_hash = ?
-                ORDER BY message_id
-                LIMIT 1
-            """, (chat_id, file_size, sample_hash))
+            cursor.execute(SQL_FIND_DUP_IN_CHAT, (chat_id, file_size, sample_hash))
             
             row = cursor.fetchone()
             return dict(row) if row else None
@@ -657,21 +1363,26 @@ class DatabaseManager:
                       canonical_chat_id: int, canonical_msg_id: int):
         """Mark a message as duplicate of another."""
         with self.get_cursor(commit=True) as cursor:
-            cursor.execute("""
-                INSERT INTO duplicates 
-                (chat_id, duplicate_msg_id, canonical_chat_id, canonical_msg_id)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(chat_id, duplicate_msg_id) DO NOTHING
-            """, (chat_id, duplicate_msg_id, canonical_chat_id, canonical_msg_id))
+            cursor.execute(SQL_MARK_DUPLICATE, (chat_id, duplicate_msg_id, canonical_chat_id, canonical_msg_id))
+    
+    def bulk_mark_duplicates(self, rows: List[Tuple[int, int, int, int]]) -> int:
+        """
+        Mark many messages as duplicates in a single transaction.
+        
+        Args:
+            rows: Tuples of (chat_id, duplicate_msg_id, canonical_chat_id, canonical_msg_id)
+        
+        Returns:
+            Number of duplicate entries created
+        """
+        with self.get_cursor(commit=True) as cursor:
+            cursor.executemany(SQL_MARK_DUPLICATE, rows)
+            return max(cursor.rowcount, 0)
     
     def get_duplicate_info(self, chat_id: int, message_id: int) -> Optional[Dict]:
         """Get duplicate information for a message."""
         with self.get_cursor() as cursor:
-            cursor.execute("""
-                SELECT canonical_chat_id, canonical_msg_id 
-                FROM duplicates
-                WHERE chat_id = ? AND duplicate_msg_id = ?
-            """, (chat_id, message_id))
+            cursor.execute(SQL_GET_DUPLICATE_INFO, (chat_id, message_id))
             
             row = cursor.fetchone()
             return dict(row) if row else None
@@ -679,6 +1390,7 @@ class DatabaseManager:
     def get_all_duplicates(self, chat_id: int = None) -> List[Dict]:
         """Get all duplicates, optionally filtered by chat."""
         with self.get_cursor() as cursor:
+            cursor.row_factory = dict_row_factory
             if chat_id:
                 cursor.execute("""
                     SELECT * FROM duplicates WHERE chat_id = ?
@@ -687,33 +1399,143 @@ class DatabaseManager:
             else:
                 cursor.execute("SELECT * FROM duplicates ORDER BY detected_at DESC")
             
-            return [dict(row) for row in cursor.fetchall()]
+            return cursor.fetchall()
     
     # ==================== Message Status Operations ====================
     
+    def record_download(self, chat_id: int, message_id: int, file_path: str = None,
+                        file_size: int = 0, sample_hash: str = None,
+                        full_hash: str = None) -> int:
+        """
+        Record a completed download in one transaction: message row, 'downloaded'
+        status, global hash entry and incremental chat totals.
+        
+        Returns:
+            int: message record id
+        """
+        now = datetime.now().isoformat()
+        local_verified = now if file_path else None
+        
+        with self.transaction() as cursor:
+            # Chat totals change by the difference to any existing row, so
+            # re-marking a message does not double count it
+            cursor.execute(SQL_GET_MESSAGE, (chat_id, message_id))
+            existing = cursor.fetchone()
+            files_delta = 0 if existing else 1
+            bytes_delta = (file_size or 0) - ((existing['file_size'] or 0) if existing else 0)
+            
+            cursor.execute(SQL_ADD_MESSAGE, (chat_id, message_id, file_path, file_size,
+                  sample_hash, full_hash, now, file_path, None, None,
+                  'local', local_verified, None))
+            
+            cursor.execute(SQL_GET_MESSAGE_ROW_ID, (chat_id, message_id))
+            row = cursor.fetchone()
+            msg_rec_id = row['id'] if row else cursor.lastrowid
+            
+            cursor.execute(SQL_SET_STATUS, (chat_id, message_id, 'downloaded', None, now))
+            
+            if sample_hash and file_size > 0 and msg_rec_id:
+                cursor.execute(SQL_REGISTER_HASH, (file_size, sample_hash, file_path,
+                      msg_rec_id, chat_id, 'local', None))
+            
+            cursor.execute(SQL_BUMP_CHAT_STATS, (files_delta, bytes_delta, message_id, now, chat_id))
+            
+            return msg_rec_id
+    
+    def record_downloads_bulk(self, chat_id: int,
+                              rows: List[Tuple[int, str, int, Optional[str]]]) -> int:
+        """
+        Record many completed downloads in a single transaction.
+        Same effect as calling record_download for each row, but the message,
+        status and hash writes go through executemany and chat totals are
+        updated once for the whole batch.
+        
+        Args:
+            rows: Tuples of (message_id, file_path, file_size, sample_hash)
+        
+        Returns:
+            Number of messages recorded
+        """
+        # Later rows for the same message win, as with repeated record_download calls
+        batch = {int(message_id): (file_path, file_size or 0, sample_hash)
+                 for message_id, file_path, file_size, sample_hash in rows}
+        if not batch:
+            return 0
+        now = datetime.now().isoformat()
+        
+        with self.transaction() as cursor:
+            cursor.execute("""
+                SELECT message_id, file_size FROM messages
+                WHERE chat_id = ? AND message_id IN (SELECT value FROM json_each(?))
+            """, (chat_id, json.dumps(list(batch))))
+            existing = {row['message_id']: row['file_size'] or 0 for row in cursor.fetchall()}
+            files_delta = len(batch) - len(existing)
+            bytes_delta = sum(size for _, size, _ in batch.values()) - sum(existing.values())
+            
+            cursor.executemany(SQL_ADD_MESSAGE, (
+                (chat_id, message_id, file_path, file_size, sample_hash, None, now,
+                 file_path, None, None, 'local', now if file_path else None, None)
+                for message_id, (file_path, file_size, sample_hash) in batch.items()
+            ))
+            cursor.executemany(SQL_SET_STATUS, (
+                (chat_id, message_id, 'downloaded', None, now) for message_id in batch
+            ))
+            cursor.executemany("""
+                INSERT INTO file_hashes
+                (file_size, sample_hash, first_occurrence_path, first_message_id,
+                 first_chat_id, storage_location, remote_ref)
+                SELECT ?, ?, ?, id, chat_id, 'local', NULL
+                FROM messages WHERE chat_id = ? AND message_id = ?
+                ON CONFLICT(file_size, sample_hash) DO NOTHING
+            """, (
+                (file_size, sample_hash, file_path, chat_id, message_id)
+                for message_id, (file_path, file_size, sample_hash) in batch.items()
+                if sample_hash and file_size > 0
+            ))
+            cursor.execute(SQL_BUMP_CHAT_STATS, (files_delta, bytes_delta, next(reversed(batch)),
+                                                 now, chat_id))
+            
+            return len(batch)
+    
+    def record_status(self, chat_id: int, message_id: int, status: str,
+                      reason: str = None):
+        """Set a message's status and the chat's last_message_id in one transaction."""
+        now = datetime.now().isoformat()
+        with self.transaction() as cursor:
+            cursor.execute(SQL_SET_STATUS, (chat_id, message_id, status, reason, now))
+            cursor.execute(SQL_SET_CHAT_LAST_MESSAGE, (message_id, now, chat_id))
+    
     def set_message_status(self, chat_id: int, message_id: int, 
                           status: str, reason: str = None):
         """
         Set message status (downloaded, skipped, failed).
         """
         with self.get_cursor(commit=True) as cursor:
-            cursor.execute("""
-                INSERT INTO message_status 
-                (chat_id, message_id, status, status_reason, updated_at)
-                VALUES (?, ?, ?, ?, ?)
-                ON CONFLICT(chat_id, message_id) DO UPDATE SET
-                    status = excluded.status,
-                    status_reason = excluded.status_reason,
-                    updated_at = excluded.updated_at
-            """, (chat_id, message_id, status, reason, datetime.now().isoformat()))
+            cursor.execute(SQL_SET_STATUS, (chat_id, message_id, status, reason,
+                                            datetime.now().isoformat()))
+    
+    def bulk_set_message_status(self, rows: List[Tuple[int, int, str, Optional[str]]]) -> int:
+        """
+        Set status for many messages in a single transaction.
+        
+        Args:
+            rows: Tuples of (chat_id, message_id, status, reason)
+        
+        Returns:
+            Number of status rows written
+        """
+        now = datetime.now().isoformat()
+        with self.get_cursor(commit=True) as cursor:
+            cursor.executemany(SQL_SET_STATUS, (
+                (chat_id, message_id, status, reason, now)
+                for chat_id, message_id, status, reason in rows
+            ))
+            return max(cursor.rowcount, 0)
     
     def get_message_status(self, chat_id: int, message_id: int) -> Optional[str]:
         """Get message status."""
         with self.get_cursor() as cursor:
-            cursor.execute("""
-                SELECT status FROM message_status
-                WHERE chat_id = ? AND message_id = ?
-            """, (chat_id, message_id))
+            cursor.execute(SQL_GET_STATUS, (chat_id, message_id))
             
             row = cursor.fetchone()
             return row['status'] if row else None
@@ -722,10 +1544,8 @@ class DatabaseManager:
         """Get counts of messages by status."""
         with self.get_cursor() as cursor:
             cursor.execute("""
-                SELECT status, COUNT(*) as count
-                FROM message_status
-                WHERE chat_id = ?
-                GROUP BY status
+                SELECT status, count FROM status_counters
+                WHERE chat_id = ? AND count > 0
             """, (chat_id,))
             
             return {row['status']: row['count'] for row in cursor.fetchall()}
@@ -743,11 +1563,39 @@ class DatabaseManager:
     
     # ==================== Utility Operations ====================
     
+    def optimize(self):
+        """Run PRAGMA optimize (cheap ANALYZE of tables whose statistics drifted)."""
+        with self.get_cursor(commit=True) as cursor:
+            cursor.execute("PRAGMA optimize")
+    
+    def analyze(self):
+        """Recompute planner statistics for all tables and indexes."""
+        with self.get_cursor(commit=True) as cursor:
+            cursor.execute("ANALYZE")
+    
+    def incremental_vacuum(self, pages: int = 0) -> None:
+        """
+        Reclaim free pages without rewriting the whole file.
+        Only effective on databases created with auto_vacuum=INCREMENTAL.
+        
+        Args:
+            pages: Maximum number of free pages to reclaim (0 = all)
+        """
+        with self.get_cursor(commit=True) as cursor:
+            cursor.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+            cursor.fetchall()
+    
     def vacuum(self):
-        """Optimize database by vacuuming."""
-        conn = self._get_connection()
-        conn.execute("VACUUM")
-        conn.commit()
+        """
+        Rebuild the entire database file with VACUUM.
+        Blocks all writers for the duration; prefer incremental_vacuum() for routine use.
+        """
+        conn = self._writer_pool.acquire()
+        try:
+            conn.execute("VACUUM")
+            conn.commit()
+        finally:
+            self._writer_pool.release(conn)
     
     def get_database_size(self) -> int:
         """Get database file size in bytes."""
@@ -760,6 +1608,38 @@ class DatabaseManager:
         Returns:
             Dict: JSON-compatible state dictionary
         """
+        state = self._export_chat_metadata(chat_id)
+        if not state:
+            return {}
+        
+        state['downloaded_messages'] = dict(self.iter_chat_export(chat_id))
+        return state
+    
+    def iter_chat_export(self, chat_id: int):
+        """
+        Stream downloaded message entries of a chat in JSON state format.
+        
+        Yields:
+            tuple: (message_id as str, file info dict)
+        """
+        with self.get_cursor() as cursor:
+            cursor.execute("""
+                SELECT message_id, file_size, file_path, local_path, remote_path,
+                       sample_hash, full_hash
+                FROM messages WHERE chat_id = ?
+            """, (chat_id,))
+            
+            for msg in cursor:
+                yield str(msg['message_id']), {
+                    'filename': message_filename(msg),
+                    'size': msg['file_size'],
+                    'path': msg['file_path'],
+                    'sample_hash': msg['sample_hash'],
+                    'full_hash': msg['full_hash']
+                }
+    
+    def _export_chat_metadata(self, chat_id: int) -> Dict:
+        """Export everything of a chat's JSON state except downloaded_messages."""
         with self.get_cursor() as cursor:
             # Get chat info
             cursor.execute("SELECT * FROM chats WHERE chat_id = ?", (chat_id,))
@@ -767,18 +1647,13 @@ class DatabaseManager:
             if not chat:
                 return {}
             
-            # Get all messages
-            cursor.execute("""
-                SELECT message_id, filename, file_size, file_path, sample_hash, full_hash
-                FROM messages WHERE chat_id = ?
-            """, (chat_id,))
-            messages = cursor.fetchall()
-            
-            # Get status info
-            cursor.execute("""
-                SELECT message_id, status FROM message_status WHERE chat_id = ?
-            """, (chat_id,))
-            statuses = {row['message_id']: row['status'] for row in cursor.fetchall()}
+            # Get skipped/failed message IDs, already filtered by SQLite
+            status_lists = {}
+            for status in ('skipped', 'failed'):
+                cursor.execute("""
+                    SELECT message_id FROM message_status WHERE chat_id = ? AND status = ?
+                """, (chat_id, status))
+                status_lists[status] = [row['message_id'] for row in cursor.fetchall()]
             
             # Get duplicates
             cursor.execute("""
@@ -787,26 +1662,17 @@ class DatabaseManager:
             duplicates = {row['duplicate_msg_id']: row['canonical_msg_id'] 
                          for row in cursor.fetchall()}
             
-            # Build JSON structure
-            downloaded_messages = {}
-            hash_index = {}
-            
-            for msg in messages:
-                msg_id = str(msg['message_id'])
-                downloaded_messages[msg_id] = {
-                    'filename': msg['filename'],
-                    'size': msg['file_size'],
-                    'path': msg['file_path'],
-                    'sample_hash': msg['sample_hash'],
-                    'full_hash': msg['full_hash']
-                }
-                
-                # Build hash index
-                if msg['sample_hash'] and msg['file_size']:
-                    key = f"{msg['file_size']}:{msg['sample_hash']}"
-                    if key not in hash_index:
-                        hash_index[key] = []
-                    hash_index[key].append(msg_id)
+            # Build hash index, grouped by SQLite
+            cursor.execute("""
+                SELECT file_size || ':' || sample_hash AS hash_key,
+                       GROUP_CONCAT(message_id) AS message_ids
+                FROM messages
+                WHERE chat_id = ? AND sample_hash IS NOT NULL AND sample_hash != ''
+                  AND file_size > 0
+                GROUP BY file_size, sample_hash
+            """, (chat_id,))
+            hash_index = {row['hash_key']: row['message_ids'].split(',')
+                          for row in cursor.fetchall()}
             
             return {
                 'chat_name': chat['chat_name'],
@@ -814,9 +1680,8 @@ class DatabaseManager:
                 'last_updated': chat['last_updated'],
                 'completed': bool(chat['completed']),
                 'completed_at': chat['completed_at'],
-                'downloaded_messages': downloaded_messages,
-                'skipped_messages': [m for m, s in statuses.items() if s == 'skipped'],
-                'failed_messages': [m for m, s in statuses.items() if s == 'failed'],
+                'skipped_messages': status_lists['skipped'],
+                'failed_messages': status_lists['failed'],
                 'total_files': chat['total_files'],
                 'total_bytes': chat['total_bytes'],
                 'last_message_id': chat['last_message_id'],
@@ -824,11 +1689,30 @@ class DatabaseManager:
                 'duplicate_map': duplicates
             }
     
-    def close(self):
-        """Close database connection."""
-        if hasattr(self._local, 'connection') and self._local.connection:
-            self._local.connection.close()
-            self._local.connection = None
+    def _write_chat_export(self, chat_id: int, filepath: str):
+        """
+        Write a chat's JSON state to filepath, streaming downloaded_messages
+        row by row instead of building the full dict in memory.
+        """
+        state = self._export_chat_metadata(chat_id)
+        
+        with open(filepath, 'wb') as f:
+            if not state:
+                f.write(b'{}')
+                return
+            
+            # Write metadata without its closing brace, then append messages
+            f.write(json_dumps_bytes(state)[:-1])
+            f.write(b',"downloaded_messages":{')
+            first = True
+            for msg_id, file_info in self.iter_chat_export(chat_id):
+                if not first:
+                    f.write(b',')
+                first = False
+                f.write(json_dumps_bytes(msg_id))
+                f.write(b':')
+                f.write(json_dumps_bytes(file_info))
+            f.write(b'}}')
     
     # ==================== Migration and Utility Operations ====================
     
@@ -842,8 +1726,6 @@ class DatabaseManager:
         Returns:
             List of created file paths
         """
-        import os
-        
         os.makedirs(output_dir, exist_ok=True)
         exported_files = []
         
@@ -851,28 +1733,19 @@ class DatabaseManager:
             # Get all chats
             cursor.execute("SELECT chat_id, chat_name, chat_hash FROM chats")
             chats = cursor.fetchall()
-            
-            for chat in chats:
-                chat_id = chat['chat_id']
-                chat_hash = chat['chat_hash']
-                
-                # Export chat to JSON
-                state_json = self.export_chat_to_json(chat_id)
-                
-                # Save to file
-                filename = f".backup_state_{chat_hash}.json"
-                filepath = os.path.join(output_dir, filename)
-                
-                with open(filepath, 'w', encoding='utf-8') as f:
-                    json.dump(state_json, f, indent=2)
-                
-                exported_files.append(filepath)
+        
+        # Export outside the cursor so each chat export can take its own pooled connection
+        for chat in chats:
+            filename = f".backup_state_{chat['chat_hash']}.json"
+            filepath = os.path.join(output_dir, filename)
+            self._write_chat_export(chat['chat_id'], filepath)
+            exported_files.append(filepath)
         
         # Export global state
         global_state = self._export_global_state()
         global_filepath = os.path.join(output_dir, ".backup_state_global.json")
-        with open(global_filepath, 'w', encoding='utf-8') as f:
-            json.dump(global_state, f, indent=2)
+        with open(global_filepath, 'wb') as f:
+            f.write(json_dumps_bytes(global_state))
         exported_files.append(global_filepath)
         
         return exported_files
@@ -880,7 +1753,10 @@ class DatabaseManager:
     def _export_global_state(self) -> Dict:
         """Export global hash index to JSON format."""
         with self.get_cursor() as cursor:
-            cursor.execute("SELECT hash_key, first_occurrence_path FROM file_hashes")
+            cursor.execute("""
+                SELECT file_size || ':' || sample_hash AS hash_key, first_occurrence_path
+                FROM file_hashes
+            """)
             hash_entries = cursor.fetchall()
             
             hash_index = {row['hash_key']: row['first_occurrence_path'] 
@@ -901,43 +1777,36 @@ class DatabaseManager:
             Dict with database statistics
         """
         with self.get_cursor() as cursor:
-            # Chat counts
-            cursor.execute("SELECT COUNT(*) as total, SUM(CASE WHEN completed THEN 1 ELSE 0 END) as completed FROM chats")
+            # Chat completion and total size (chats table is small)
+            cursor.execute("""
+                SELECT SUM(CASE WHEN completed THEN 1 ELSE 0 END) as completed,
+                       SUM(total_bytes) as total_bytes
+                FROM chats
+            """)
             chat_stats = dict(cursor.fetchone())
+            total_bytes = chat_stats['total_bytes'] or 0
             
-            # Message counts
-            cursor.execute("SELECT COUNT(*) as total FROM messages")
-            message_count = cursor.fetchone()['total']
+            # Row counts (trigger-maintained)
+            cursor.execute("SELECT table_name, count FROM table_counters")
+            row_counts = {row['table_name']: row['count'] for row in cursor.fetchall()}
             
-            # Status counts
-            cursor.execute("SELECT status, COUNT(*) as count FROM message_status GROUP BY status")
+            # Status counts (trigger-maintained)
+            cursor.execute("SELECT status, SUM(count) as count FROM status_counters GROUP BY status")
             status_counts = {row['status']: row['count'] for row in cursor.fetchall()}
             
-            # Duplicate counts
-            cursor.execute("SELECT COUNT(*) as total FROM duplicates")
-            duplicate_count = cursor.fetchone()['total']
-            
-            # Hash index size
-            cursor.execute("SELECT COUNT(*) as total FROM file_hashes")
-            hash_count = cursor.fetchone()['total']
-            
-            # Total size
-            cursor.execute("SELECT SUM(total_bytes) as total FROM chats")
-            total_bytes = cursor.fetchone()['total'] or 0
-            
             return {
                 'chats': {
-                    'total': chat_stats['total'],
+                    'total': row_counts.get('chats', 0),
                     'completed': chat_stats['completed']
                 },
                 'messages': {
-                    'total': message_count,
+                    'total': row_counts.get('messages', 0),
                     'downloaded': status_counts.get('downloaded', 0),
                     'skipped': status_counts.get('skipped', 0),
                     'failed': status_counts.get('failed', 0)
                 },
-                'duplicates': duplicate_count,
-                'hash_index_size': hash_count,
+                'duplicates': row_counts.get('duplicates', 0),
+                'hash_index_size': row_counts.get('file_hashes', 0),
                 'total_bytes': total_bytes,
                 'database_size': self.get_database_size()
             }
@@ -947,8 +1816,9 @@ class DatabaseManager:
     def get_all_chats(self) -> List[Dict]:
         """Get all chats in the database."""
         with self.get_cursor() as cursor:
+            cursor.row_factory = dict_row_factory
             cursor.execute("SELECT * FROM chats ORDER BY chat_name")
-            return [dict(row) for row in cursor.fetchall()]
+            return cursor.fetchall()
     
     def bulk_update_from_filesystem(self, chat_id: int, file_records: List[Dict]) -> int:
         """
@@ -967,11 +1837,10 @@ class DatabaseManager:
             for record in file_records:
                 cursor.execute("""
                     INSERT INTO messages 
-                    (chat_id, message_id, filename, file_path, file_size, sample_hash,
+                    (chat_id, message_id, file_path, file_size, sample_hash,
                      downloaded_at, local_path, storage_status, local_verified_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'local', ?)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, 'local', ?)
                     ON CONFLICT(chat_id, message_id) DO UPDATE SET
-                        filename = excluded.filename,
                         file_path = excluded.file_path,
                         file_size = excluded.file_size,
                         sample_hash = excluded.sample_hash,
@@ -984,7 +1853,6 @@ class DatabaseManager:
                 """, (
                     chat_id, 
                     record['message_id'], 
-                    record.get('filename'),
                     record.get('file_path') or record.get('local_path'),
                     record.get('file_size', 0),
                     record.get('sample_hash'),
@@ -1013,9 +1881,9 @@ class DatabaseManager:
             for record in file_records:
                 cursor.execute("""
                     INSERT INTO messages 
-                    (chat_id, message_id, filename, file_size, sample_hash,
+                    (chat_id, message_id, file_size, sample_hash,
                      downloaded_at, remote_path, remote_ref, storage_status, remote_verified_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'remote', ?)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, 'remote', ?)
                     ON CONFLICT(chat_id, message_id) DO UPDATE SET
                         remote_path = excluded.remote_path,
                         remote_ref = excluded.remote_ref,
@@ -1029,7 +1897,6 @@ class DatabaseManager:
                 """, (
                     chat_id,
                     record['message_id'],
-                    record.get('filename') or os.path.basename(record.get('remote_path', '')),
                     record.get('file_size', 0),
                     record.get('sample_hash'),
                     datetime.now().isoformat(),
@@ -1052,23 +1919,9 @@ class DatabaseManager:
         Returns:
             Number of hash entries created
         """
-        count = 0
         with self.get_cursor(commit=True) as cursor:
-            for record in hash_records:
-                hash_key = f"{record['file_size']}:{record['sample_hash']}"
-                
-                # Check if exists
-                cursor.execute("SELECT 1 FROM file_hashes WHERE hash_key = ?", (hash_key,))
-                if cursor.fetchone():
-                    continue
-                
-                cursor.execute("""
-                    INSERT INTO file_hashes 
-                    (hash_key, file_size, sample_hash, first_occurrence_path, 
-                     first_message_id, first_chat_id, storage_location, remote_ref)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    hash_key,
+            cursor.executemany(SQL_REGISTER_HASH, (
+                (
                     record['file_size'],
                     record['sample_hash'],
                     record.get('file_path'),
@@ -1076,10 +1929,10 @@ class DatabaseManager:
                     record.get('chat_id'),
                     record.get('storage_location', 'local'),
                     record.get('remote_ref')
-                ))
-                count += 1
-        
-        return count
+                )
+                for record in hash_records
+            ))
+            return max(cursor.rowcount, 0)
     
     def cleanup_orphaned_records(self) -> Dict[str, int]:
         """
@@ -1093,33 +1946,35 @@ class DatabaseManager:
         with self.get_cursor(commit=True) as cursor:
             # Remove duplicates pointing to non-existent messages
             cursor.execute("""
-                DELETE FROM duplicates 
-                WHERE NOT EXISTS (
-                    SELECT 1 FROM messages 
-                    WHERE messages.chat_id = duplicates.canonical_chat_id 
-                    AND messages.message_id = duplicates.canonical_msg_id
+                DELETE FROM duplicates
+                WHERE id IN (
+                    SELECT d.id FROM duplicates d
+                    LEFT JOIN messages m
+                        ON m.chat_id = d.canonical_chat_id
+                        AND m.message_id = d.canonical_msg_id
+                    WHERE m.id IS NULL AND d.canonical_msg_id != -1
                 )
-                AND canonical_msg_id != -1
             """)
             counts['orphaned_duplicates'] = cursor.rowcount
             
             # Remove hash entries pointing to non-existent files
             cursor.execute("""
-                DELETE FROM file_hashes 
-                WHERE first_occurrence_path IS NOT NULL 
-                AND NOT EXISTS (
-                    SELECT 1 FROM messages 
-                    WHERE messages.file_path = file_hashes.first_occurrence_path
+                DELETE FROM file_hashes
+                WHERE (file_size, sample_hash) IN (
+                    SELECT h.file_size, h.sample_hash FROM file_hashes h
+                    LEFT JOIN messages m ON m.file_path = h.first_occurrence_path
+                    WHERE h.first_occurrence_path IS NOT NULL AND m.id IS NULL
                 )
             """)
             counts['orphaned_hashes'] = cursor.rowcount
             
             # Remove message status for non-existent messages
             cursor.execute("""
-                DELETE FROM message_status 
-                WHERE NOT EXISTS (
-                    SELECT 1 FROM chats 
-                    WHERE chats.chat_id = message_status.chat_id
+                DELETE FROM message_status
+                WHERE id IN (
+                    SELECT s.id FROM message_status s
+                    LEFT JOIN chats c ON c.chat_id = s.chat_id
+                    WHERE c.chat_id IS NULL
                 )
             """)
             counts['orphaned_statuses'] = cursor.rowcount
@@ -1131,99 +1986,91 @@ class DatabaseManager:
         Rebuild global hash index from all messages in database.
         Useful for fixing inconsistencies.
         
+        The index is fully derived from messages, so the rebuild runs without
+        fsync (synchronous=OFF); if it is interrupted, just run it again.
+        
         Returns:
             Number of hash entries created
         """
-        count = 0
-        
-        with self.get_cursor(commit=True) as cursor:
+        with self.get_cursor(commit=True, durable=False) as cursor:
             # Clear existing hash index
             cursor.execute("DELETE FROM file_hashes")
             
-            # Rebuild from messages
+            # Rebuild from messages in one statement: SQLite groups by
+            # (file_size, sample_hash) and keeps the earliest download of each
             cursor.execute("""
-                SELECT DISTINCT file_size, sample_hash,
-                       COALESCE(local_path, file_path) as effective_path,
-                       id, chat_id, storage_status, remote_ref
-                FROM messages
-                WHERE sample_hash IS NOT NULL
-                  AND file_size > 0
-                  AND (
-                      local_path IS NOT NULL
-                      OR file_path IS NOT NULL
-                      OR remote_path IS NOT NULL
-                  )
-                ORDER BY downloaded_at ASC
+                INSERT INTO file_hashes
+                (file_size, sample_hash, first_occurrence_path, first_message_id,
+                 first_chat_id, storage_location, remote_ref)
+                SELECT file_size, sample_hash, effective_path, id, chat_id,
+                       COALESCE(storage_status, 'local'), remote_ref
+                FROM (
+                    SELECT file_size, sample_hash,
+                           COALESCE(local_path, file_path) as effective_path,
+                           id, chat_id, storage_status, remote_ref,
+                           ROW_NUMBER() OVER (
+                               PARTITION BY file_size, sample_hash
+                               ORDER BY downloaded_at ASC, id ASC
+                           ) as occurrence
+                    FROM messages
+                    WHERE sample_hash IS NOT NULL
+                      AND file_size > 0
+                      AND (
+                          local_path IS NOT NULL
+                          OR file_path IS NOT NULL
+                          OR remote_path IS NOT NULL
+                      )
+                )
+                WHERE occurrence = 1
             """)
-            
-            seen_hashes = set()
-            for row in cursor.fetchall():
-                hash_key = f"{row['file_size']}:{row['sample_hash']}"
-                
-                # Only add first occurrence
-                if hash_key not in seen_hashes:
-                    cursor.execute("""
-                        INSERT INTO file_hashes 
-                        (hash_key, file_size, sample_hash, first_occurrence_path, first_message_id,
-                         first_chat_id, storage_location, remote_ref)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    """, (
-                        hash_key,
-                        row['file_size'],
-                        row['sample_hash'],
-                        row['effective_path'],
-                        row['id'],
-                        row['chat_id'],
-                        row['storage_status'] or 'local',
-                        row['remote_ref']
-                    ))
-                    
-                    seen_hashes.add(hash_key)
-                    count += 1
-        
-        return count
+            return max(cursor.rowcount, 0)
     
-    def get_duplicate_report(self, chat_id: int = None) -> List[Dict]:
+    def get_duplicate_report(self, chat_id: int = None, order_by_recent: bool = True,
+                             limit: int = None) -> List[Dict]:
         """
         Generate a detailed duplicate report.
         
         Args:
             chat_id: Optional chat_id to filter by
+            order_by_recent: Newest detections first; pass False to skip sorting
+            limit: Optional maximum number of entries
             
         Returns:
             List of duplicate entries with details
         """
+        return list(self.iter_duplicate_report(chat_id, order_by_recent, limit))
+    
+    def iter_duplicate_report(self, chat_id: int = None, order_by_recent: bool = True,
+                              limit: int = None):
+        """
+        Stream duplicate report entries as dicts (see get_duplicate_report).
+        The pooled connection is held until the iterator is exhausted or closed.
+        """
+        query = """
+            SELECT 
+                d.duplicate_msg_id,
+                d.canonical_msg_id,
+                m1.file_path as dup_path,
+                m1.file_size as dup_size,
+                m2.file_path as canon_path,
+                c.chat_name
+            FROM duplicates d
+            LEFT JOIN messages m1 ON d.chat_id = m1.chat_id AND d.duplicate_msg_id = m1.message_id
+            LEFT JOIN messages m2 ON d.canonical_chat_id = m2.chat_id AND d.canonical_msg_id = m2.message_id
+            LEFT JOIN chats c ON d.chat_id = c.chat_id
+        """
+        params = []
+        if chat_id:
+            query += " WHERE d.chat_id = ?"
+            params.append(chat_id)
+        # Served by idx_duplicates_chat_detected / idx_duplicates_detected
+        if order_by_recent:
+            query += " ORDER BY d.detected_at DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(int(limit))
+        
         with self.get_cursor() as cursor:
-            if chat_id:
-                cursor.execute("""
-                    SELECT 
-                        d.duplicate_msg_id,
-                        d.canonical_msg_id,
-                        m1.file_path as dup_path,
-                        m1.file_size as dup_size,
-                        m2.file_path as canon_path,
-                        c.chat_name
-                    FROM duplicates d
-                    LEFT JOIN messages m1 ON d.chat_id = m1.chat_id AND d.duplicate_msg_id = m1.message_id
-                    LEFT JOIN messages m2 ON d.canonical_chat_id = m2.chat_id AND d.canonical_msg_id = m2.message_id
-                    LEFT JOIN chats c ON d.chat_id = c.chat_id
-                    WHERE d.chat_id = ?
-                    ORDER BY d.detected_at DESC
-                """, (chat_id,))
-            else:
-                cursor.execute("""
-                    SELECT 
-                        d.duplicate_msg_id,
-                        d.canonical_msg_id,
-                        m1.file_path as dup_path,
-                        m1.file_size as dup_size,
-                        m2.file_path as canon_path,
-                        c.chat_name
-                    FROM duplicates d
-                    LEFT JOIN messages m1 ON d.chat_id = m1.chat_id AND d.duplicate_msg_id = m1.message_id
-                    LEFT JOIN messages m2 ON d.canonical_chat_id = m2.chat_id AND d.canonical_msg_id = m2.message_id
-                    LEFT JOIN chats c ON d.chat_id = c.chat_id
-                    ORDER BY d.detected_at DESC
-                """)
-            
-            return [dict(row) for row in cursor.fetchall()]
+            cursor.row_factory = dict_row_factory
+            cursor.execute(query, params)
+            yield from cursor
@@ -3,35 +3,80 @@ Download state management for resume capability in Telegram backup.
 Tracks progress and enables resuming downloads.
 Supports both SQLite (default) and JSON (legacy) backends.
 """
-import json
 import os
 import sqlite3
+import time
+import atexit
+import weakref
 from datetime import datetime
+from collections import Counter, OrderedDict, defaultdict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
 import config
 import utils
-from state_db import DatabaseManager
+from state_db import (DatabaseManager, json_dumps_bytes, json_loads,
+                      read_state_file, state_file_exists, write_state_file)
 
 
-def log_debug(message):
-    """Print debug message if DEBUG is enabled"""
+def log_debug(message, *args):
+    """Print debug message if DEBUG is enabled (args are %-formatted lazily)"""
     if config.DEBUG:
-        print(f"[DEBUG] {message}")
+        print(f"[DEBUG] {message % args if args else message}")
+
+
+@lru_cache(maxsize=1024)
+def chat_state_hash(chat_name):
+    """
+    Short stable hash of a chat name, used in state file names and as chats.chat_hash.
+    Stays MD5-based so existing state files and database rows keep matching.
+    """
+    return hashlib.md5(chat_name.encode()).hexdigest()[:8]
+
+
+# JSON-backed managers with unsaved changes are flushed at interpreter exit
+_json_state_managers = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_json_state_managers():
+    for manager in list(_json_state_managers):
+        manager.flush_state()
+
+
+# find_duplicate probes the same canonical paths over and over during a run;
+# a path seen on disk within the last VERIFIED_PATH_TTL_SECONDS is trusted
+# without another stat (LRU, at most VERIFIED_PATH_CACHE_SIZE entries)
+VERIFIED_PATH_TTL_SECONDS = 60.0
+VERIFIED_PATH_CACHE_SIZE = 4096
+_verified_paths = OrderedDict()
+
+
+def _path_exists(path):
+    """os.path.exists with a short-lived cache of paths known to exist."""
+    now = time.monotonic()
+    verified_at = _verified_paths.get(path)
+    if verified_at is not None and now - verified_at < VERIFIED_PATH_TTL_SECONDS:
+        _verified_paths.move_to_end(path)
+        return True
+    
+    if not os.path.exists(path):
+        _verified_paths.pop(path, None)
+        return False
+    
+    _verified_paths[path] = now
+    _verified_paths.move_to_end(path)
+    if len(_verified_paths) > VERIFIED_PATH_CACHE_SIZE:
+        _verified_paths.popitem(last=False)
+    return True
 
 
 class StateManager:
-    def _migrate_to_dict_format(self):
-        """Migrate downloaded_messages from list format to dict format if needed."""
-        if isinstance(self.state['downloaded_messages'], list):
-            log_debug("Migrating downloaded_messages from list to dict format")
-            old_list = self.state['downloaded_messages']
-            self.state['downloaded_messages'] = {}
-            for old_id in old_list:
-                self.state['downloaded_messages'][str(old_id)] = {
-                    'filename': 'unknown',
-                    'size': 0,
-                    'path': None
-                }
+    # JSON backend: every mark_* is appended to a small log next to the state
+    # file; the full snapshot is rewritten (and the log cleared) at most every
+    # SAVE_THRESHOLD changes or SAVE_INTERVAL_SECONDS
+    SAVE_THRESHOLD = 1000
+    SAVE_INTERVAL_SECONDS = 30.0
     
     def generate_state_from_existing_files(self, backup_dir):
         """
@@ -39,49 +84,50 @@ class StateManager:
         Also computes sample hashes for duplicate detection.
         """
         downloaded = {}
-        total_files = 0
-        total_bytes = 0
-        log_debug(f"Generating state from existing files in {backup_dir}")
+        log_debug("Generating state from existing files in %s", backup_dir)
         try:
-            for root, _, files in os.walk(backup_dir):
-                for fname in files:
-                    if fname.startswith('.'):
-                        continue
-                    fpath = os.path.join(root, fname)
-                    if not os.path.isfile(fpath):
-                        continue
-                    try:
-                        size = os.path.getsize(fpath)
-                        # Use filename as message_id if no better info
-                        msg_id = fname.split('.')[0]
-                        
-                        # Compute sample hash for duplicate detection
-                        sample_hash = utils.sample_hash_file(fpath)
-                        
-                        downloaded[msg_id] = {
-                            'filename': fname,
-                            'size': size,
-                            'path': fpath,
-                            'sample_hash': sample_hash
-                        }
-                        
-                        # Update hash index
-                        if sample_hash:
-                            self._update_hash_index(size, sample_hash, msg_id)
-                        
-                        total_files += 1
-                        total_bytes += size
-                    except Exception as e:
-                        log_debug(f"Error processing file {fpath}: {e}")
-                        continue
+            # One stat() per DirEntry replaces isfile() + getsize()
+            files = []
+            for entry in utils.iter_files(backup_dir):
+                try:
+                    files.append((entry.name, entry.path, entry.stat().st_size))
+                except OSError as e:
+                    log_debug("Error processing file %s: %s", entry.path, e)
+            
+            # A file whose size is unique cannot have a duplicate, so only
+            # size collisions are hashed now; the rest are hashed lazily by
+            # find_duplicate if a file of the same size turns up later
+            size_counts = Counter(size for _, _, size in files)
+            to_hash = [path for _, path, size in files if size_counts[size] > 1]
+            
+            # Sample hashes are computed concurrently (hashlib releases the GIL
+            # and several reads keep the disk queue busy); results are merged
+            # in scan order on this thread
+            workers = min(config.HASH_WORKERS, len(to_hash)) or 1
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                hashes = dict(zip(to_hash, executor.map(utils.sample_hash_file_mmap, to_hash)))
+            
+            for name, path, size in files:
+                sample_hash = hashes.get(path)
+                # Use filename as message_id if no better info
+                msg_id = name.split('.')[0]
+                downloaded[msg_id] = {
+                    'filename': name,
+                    'size': size,
+                    'path': path,
+                    'sample_hash': sample_hash
+                }
+                
+                # Update hash index
+                if sample_hash:
+                    self._update_hash_index(size, sample_hash, msg_id)
             
             self.state['downloaded_messages'] = downloaded
-            self.state['total_files'] = total_files
-            self.state['total_bytes'] = total_bytes
-            self._save_state()
-            log_debug(f"Generated state with {total_files} files ({total_bytes} bytes)")
+            self._unhashed_by_size = None
+            self._save_state_now()
+            log_debug("Generated state with %s files (%s bytes)", self.total_files, self.total_bytes)
         except Exception as e:
-            log_debug(f"Error generating state from existing files: {e}")
+            log_debug("Error generating state from existing files: %s", e)
 
     def __init__(self, output_dir, chat_name):
         """
@@ -92,21 +138,38 @@ class StateManager:
         self.chat_name = chat_name
         self.chat_hash = self._sanitize_for_filename(chat_name)
         self.state_file = os.path.join(output_dir, f".backup_state_{self.chat_hash}.json")
+        self.log_file = f"{self.state_file}.log"
         self.state = {}
+        self._log_handle = None
+        # JSON backend: {size: [msg_id]} of downloaded files without a sample
+        # hash, built on first use by find_duplicate
+        self._unhashed_by_size = None
+        
+        # Debounced JSON saves
+        self._dirty = False
+        self._pending_saves = 0
+        self._last_save = time.monotonic()
+        self._last_saved_digest = None
         
         # Determine backend mode
         self.use_db = config.DB_ENABLE
         self.db = None
         self.chat_id = None
+        # SQLite backend: IDs of messages with a row in this chat, loaded on
+        # first use so lookups for unknown messages skip the database
+        self._known_message_ids = None
         
         if self.use_db:
             self._init_sql_backend_with_recovery()
         else:
             self.state = self._load_state()
-            log_debug(f"Using JSON backend for chat: {chat_name}")
+            self._replay_log()
+            _json_state_managers.add(self)
+            log_debug("Using JSON backend for chat: %s", chat_name)
         
-        # Initialize global state manager for cross-chat duplicate detection
-        self.global_state = GlobalStateManager(output_dir)
+        # Initialize global state manager for cross-chat duplicate detection;
+        # the global index lives in the same database, so share the connections
+        self.global_state = GlobalStateManager(output_dir, db=self.db)
 
     def _is_db_corruption_error(self, error):
         """Return True if error indicates SQLite corruption/malformed database."""
@@ -121,20 +184,26 @@ class StateManager:
     def _init_sql_backend_with_recovery(self):
         """Initialize SQLite backend and recover from corruption if needed."""
         db_path = config.DB_PATH or os.path.join(self.output_dir, "telegram_backup.db")
+        self._known_message_ids = None
         try:
             self.db = DatabaseManager(db_path)
             self.chat_id = self.db.get_or_create_chat(self.chat_name, self.chat_hash)
             if not self.db.check_integrity():
                 raise sqlite3.DatabaseError("SQLite integrity_check failed")
-            log_debug(f"Using SQLite backend for chat: {self.chat_name} (chat_id={self.chat_id})")
+            log_debug("Using SQLite backend for chat: %s (chat_id=%s)", self.chat_name, self.chat_id)
         except Exception as e:
             if self._is_db_corruption_error(e):
                 self._recover_sqlite_db(e)
                 self.db = DatabaseManager(db_path)
                 self.chat_id = self.db.get_or_create_chat(self.chat_name, self.chat_hash)
-                log_debug(f"Recovered SQLite backend for chat: {self.chat_name} (chat_id={self.chat_id})")
+                log_debug("Recovered SQLite backend for chat: %s (chat_id=%s)", self.chat_name, self.chat_id)
             else:
                 raise
+        
+        # Keep a global state manager sharing the previous database in sync
+        global_state = getattr(self, 'global_state', None)
+        if global_state is not None and global_state.use_db:
+            global_state.db = self.db
 
     def _recover_sqlite_db(self, error=None):
         """Recover from SQLite corruption by rotating malformed DB and recreating it."""
@@ -151,9 +220,9 @@ class StateManager:
             corrupt_copy = f"{db_path}.corrupt.{timestamp}"
             try:
                 os.replace(db_path, corrupt_copy)
-                log_debug(f"[DB ERROR] Corrupted database moved to: {corrupt_copy}")
+                log_debug("[DB ERROR] Corrupted database moved to: %s", corrupt_copy)
             except Exception as move_error:
-                log_debug(f"[DB ERROR] Could not archive corrupted database: {move_error}")
+                log_debug("[DB ERROR] Could not archive corrupted database: %s", move_error)
                 raise
 
         for suffix in ["-wal", "-shm"]:
@@ -165,29 +234,33 @@ class StateManager:
                     pass
 
         if error is not None:
-            log_debug(f"[DB ERROR] Recreating SQLite database after corruption: {error}")
+            log_debug("[DB ERROR] Recreating SQLite database after corruption: %s", error)
     
     def _sanitize_for_filename(self, name):
         """
         Create a safe filename from a chat name (for state file).
         """
-        return hashlib.md5(name.encode()).hexdigest()[:8]
+        return chat_state_hash(name)
     
     def _load_state(self):
         """
         Load existing state from file, or create a new state dict.
         """
-        if os.path.exists(self.state_file):
-            try:
-                with open(self.state_file, 'r', encoding='utf-8') as f:
-                    loaded_state = json.load(f)
-                log_debug(f"Loaded existing state from {self.state_file}")
-                return loaded_state
-            except Exception as e:
-                log_debug(f"Failed to load state file: {e}. Creating new state.")
+        try:
+            loaded_state = json_loads(read_state_file(self.state_file))
+            log_debug("Loaded existing state from %s", self.state_file)
+            # Legacy list format is migrated once here; schedule writing
+            # the dict form back so later loads skip the migration
+            if isinstance(loaded_state.get('downloaded_messages'), list):
+                self._dirty = True
+            return self._normalize_state(loaded_state)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log_debug("Failed to load state file: %s. Creating new state.", e)
         
-        log_debug(f"Creating new state for chat: {self.chat_name}")
-        return {
+        log_debug("Creating new state for chat: %s", self.chat_name)
+        return self._normalize_state({
             'chat_name': self.chat_name,
             'started_at': datetime.now().isoformat(),
             'last_updated': None,
@@ -195,26 +268,238 @@ class StateManager:
             'downloaded_messages': {},  # Dict: {message_id: {"filename": str, "size": int, "path": str, "sample_hash": str, "full_hash": str (optional)}}
             'skipped_messages': [],
             'failed_messages': [],
-            'total_files': 0,
-            'total_bytes': 0,
             'last_message_id': None,
-            'hash_index': {},  # Dict: {(size, sample_hash): [message_ids]} for fast duplicate lookup
+            'hash_index': {},  # Dict: {(size, sample_hash): [message_ids]} for fast duplicate lookup ("size:hash" keys on disk)
             'duplicate_map': {}  # Dict: {duplicate_msg_id: canonical_msg_id} tracks which messages share files
-        }
+        })
+    
+    @staticmethod
+    def _normalize_state(state):
+        """
+        Convert loaded state into its in-memory form, once at load time:
+        - downloaded_messages is always a dict (legacy list format migrated)
+        - skipped/failed message IDs are sets of ints for O(1) membership
+          tests (lists on disk)
+        - hash_index is keyed by (size, sample_hash) tuples ("size:hash"
+          strings on disk), so lookups do not format a key each time
+        """
+        downloaded = state.get('downloaded_messages', {})
+        if isinstance(downloaded, list):
+            log_debug("Migrating downloaded_messages from list to dict format")
+            downloaded = {
+                str(old_id): {'filename': 'unknown', 'size': 0, 'path': None}
+                for old_id in downloaded
+            }
+        state['downloaded_messages'] = downloaded
+        state['skipped_messages'] = {int(m) for m in state.get('skipped_messages', [])}
+        state['failed_messages'] = {int(m) for m in state.get('failed_messages', [])}
+        hash_index = {}
+        for key, msg_ids in state.get('hash_index', {}).items():
+            size, _, sample_hash = key.partition(':')
+            try:
+                hash_index[(int(size), sample_hash)] = msg_ids
+            except ValueError:
+                # Malformed entry; rebuild_hash_index can restore it
+                continue
+        state['hash_index'] = hash_index
+        # Totals are derived from downloaded_messages (see total_files/total_bytes)
+        state.pop('total_files', None)
+        state.pop('total_bytes', None)
+        return state
+    
+    def _serializable_state(self):
+        """
+        Shallow copy of the state with sets converted back to sorted lists,
+        hash_index keys back to "size:hash" strings and the derived totals
+        filled in, matching the on-disk format.
+        """
+        state = dict(self.state)
+        for key in ('skipped_messages', 'failed_messages'):
+            if key in state:
+                state[key] = sorted(state[key])
+        if 'hash_index' in state:
+            state['hash_index'] = {
+                f"{size}:{sample_hash}": msg_ids
+                for (size, sample_hash), msg_ids in state['hash_index'].items()
+            }
+        state['total_files'] = self.total_files
+        state['total_bytes'] = self.total_bytes
+        return state
+    
+    @property
+    def total_files(self):
+        """Number of downloaded files (JSON backend), derived from downloaded_messages."""
+        return len(self.state.get('downloaded_messages', {}))
+    
+    @property
+    def total_bytes(self):
+        """
+        Total size of downloaded files (JSON backend), derived from downloaded_messages.
+        Computed on demand rather than maintained per mark, so it cannot drift when
+        entries are re-marked with a different size or removed.
+        """
+        return sum(info.get('size') or 0 for info in self.state.get('downloaded_messages', {}).values())
     
     def _save_state(self):
+        """
+        Record a state change and save to the JSON file once enough changes
+        or time have accumulated. Use flush_state() to force a write.
+        """
+        self._dirty = True
+        self._pending_saves += 1
+        if (self._pending_saves >= self.SAVE_THRESHOLD or
+                time.monotonic() - self._last_save >= self.SAVE_INTERVAL_SECONDS):
+            self._save_state_now()
+    
+    def _save_state_now(self):
         """
         Save the current state to the JSON file.
+        Skipped when nothing but last_updated would change. Otherwise written
+        through write_state_file (temporary file swapped in, zstd-compressed
+        when available), so a crash mid-write never leaves a truncated file.
         """
-        self.state['last_updated'] = datetime.now().isoformat()
         try:
-            with open(self.state_file, 'w', encoding='utf-8') as f:
-                json.dump(self.state, f, indent=2)
-            log_debug(f"State saved to {self.state_file}")
+            # Serialize once without last_updated to detect no-op saves
+            state = self._serializable_state()
+            state.pop('last_updated', None)
+            body = json_dumps_bytes(state)
+            digest = hash(body)
+            if digest == self._last_saved_digest and state_file_exists(self.state_file):
+                self._dirty = False
+                self._pending_saves = 0
+                self._truncate_log()
+                return
+            
+            # Prepend last_updated to the already serialized body
+            self.state['last_updated'] = datetime.now().isoformat()
+            data = b'{"last_updated":' + json_dumps_bytes(self.state['last_updated'])
+            data += b',' + body[1:] if len(body) > 2 else b'}'
+            
+            write_state_file(self.state_file, data)
+            # The snapshot now contains every logged change
+            self._truncate_log()
+            self._last_saved_digest = digest
+            self._dirty = False
+            self._pending_saves = 0
+            self._last_save = time.monotonic()
+            log_debug("State saved to %s", self.state_file)
         except Exception as e:
-            log_debug(f"Error saving state: {e}")
+            log_debug("Error saving state: %s", e)
             print(f"⚠️  Warning: Could not save state: {e}")
     
+    def _append_log(self, ops):
+        """Append state-change operations to the log, one JSON object per line."""
+        try:
+            if self._log_handle is None:
+                self._log_handle = open(self.log_file, 'ab')
+            self._log_handle.write(b''.join(json_dumps_bytes(op) + b'\n' for op in ops))
+            self._log_handle.flush()
+        except Exception as e:
+            log_debug("Error appending to state log: %s", e)
+    
+    def _truncate_log(self):
+        """Close and remove the change log once a snapshot covers it."""
+        if self._log_handle is not None:
+            try:
+                self._log_handle.close()
+            except Exception:
+                pass
+            self._log_handle = None
+        try:
+            os.remove(self.log_file)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log_debug("Failed to remove state log: %s", e)
+    
+    def _replay_log(self):
+        """
+        Apply changes logged after the last snapshot (JSON backend).
+        A torn last line from a crash mid-append ends the replay; the state is
+        then snapshotted and the log cleared.
+        """
+        if not os.path.exists(self.log_file):
+            return
+        replayed = 0
+        try:
+            with open(self.log_file, 'rb') as f:
+                for line in f:
+                    try:
+                        op = json_loads(line)
+                    except Exception:
+                        break
+                    self._apply_op(op)
+                    replayed += 1
+        except Exception as e:
+            log_debug("Failed to replay state log: %s", e)
+        log_debug("Replayed %s logged change(s) from %s", replayed, self.log_file)
+        # Compact right away so new appends never follow a torn line
+        self._save_state_now()
+    
+    def _apply_op(self, op):
+        """
+        Apply one logged operation to the in-memory state.
+        Ops: 'dl' (downloaded), 'sk' (skipped), 'fl' (failed), 'dup' (duplicate).
+        """
+        kind = op['op']
+        message_id = op['id']
+        if kind == 'dl':
+            file_path = op.get('f')
+            file_size = op.get('s') or 0
+            file_info = {
+                'filename': os.path.basename(file_path) if file_path else 'unknown',
+                'size': file_size,
+                'path': file_path
+            }
+            if op.get('h'):
+                file_info['sample_hash'] = op['h']
+            if op.get('fh'):
+                file_info['full_hash'] = op['fh']
+            self.state['downloaded_messages'][str(message_id)] = file_info
+            if op.get('h') and file_size > 0:
+                self._update_hash_index(file_size, op['h'], message_id)
+            elif file_size > 0:
+                self._unhashed_by_size = None
+        elif kind == 'sk':
+            self.state['skipped_messages'].add(int(message_id))
+        elif kind == 'fl':
+            self.state['failed_messages'].add(int(message_id))
+        elif kind == 'dup':
+            self.state.setdefault('duplicate_map', {})[str(message_id)] = op['c']
+            self.state['skipped_messages'].add(int(message_id))
+            return
+        self.state['last_message_id'] = message_id
+    
+    def _record_op(self, op):
+        """Apply an operation, append it to the change log and schedule a snapshot."""
+        self._apply_op(op)
+        self._append_log((op,))
+        self._save_state()
+    
+    def flush_state(self):
+        """Write any pending state changes to disk (JSON backend only)."""
+        if not self.use_db and self._dirty:
+            self._save_state_now()
+        global_state = getattr(self, 'global_state', None)
+        if global_state is not None:
+            global_state.flush_state()
+    
+    def __del__(self):
+        try:
+            self.flush_state()
+        except Exception:
+            pass
+    
+    @staticmethod
+    def _file_size(path):
+        """Size of the file at path from a single stat, or None if it is missing."""
+        if not path:
+            return None
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            return None
+    
     def validate_downloaded_file(self, message_id):
         """
         Validate if a downloaded file is available (locally or remotely).
@@ -243,41 +528,37 @@ class StateManager:
             # If marked as remote-only or both, trust the state (hybrid mode)
             if storage_status in ('remote', 'both'):
                 if remote_path:
-                    log_debug(f"[VALIDATION OK] File available remotely for message {message_id}: {remote_path}")
+                    log_debug("[VALIDATION OK] File available remotely for message %s: %s", message_id, remote_path)
                     return True
             
-            # Check local file if present
-            if local_path and os.path.exists(local_path):
+            # Check local file if present (a single stat covers existence and size)
+            actual_size = self._file_size(local_path)
+            if actual_size is not None:
                 expected_size = file_info.get('file_size', 0)
-                try:
-                    actual_size = os.path.getsize(local_path)
-                    if actual_size == 0:
-                        log_debug(f"[VALIDATION FAILED] Local file is empty (0 bytes) for message {message_id}: {local_path}")
+                if actual_size == 0:
+                    log_debug("[VALIDATION FAILED] Local file is empty (0 bytes) for message %s: %s", message_id, local_path)
+                    return False
+                
+                # Size validation
+                if expected_size and expected_size > 0:
+                    size_diff = abs(actual_size - expected_size)
+                    tolerance = expected_size * 0.01
+                    if size_diff > tolerance and size_diff > 1024:
+                        log_debug("[VALIDATION FAILED] File size mismatch for message %s: expected %s bytes, got %s bytes", message_id, expected_size, actual_size)
                         return False
-                    
-                    # Size validation
-                    if expected_size > 0:
-                        size_diff = abs(actual_size - expected_size)
-                        tolerance = expected_size * 0.01
-                        if size_diff > tolerance and size_diff > 1024:
-                            log_debug(f"[VALIDATION FAILED] File size mismatch for message {message_id}: expected {expected_size} bytes, got {actual_size} bytes")
-                            return False
-                    
-                    log_debug(f"[VALIDATION OK] Local file valid for message {message_id}: {actual_size} bytes at {local_path}")
-                    return True
-                except Exception as e:
-                    log_debug(f"[VALIDATION ERROR] Error validating local file for message {message_id}: {e}")
+                
+                log_debug("[VALIDATION OK] Local file valid for message %s: %s bytes at %s", message_id, actual_size, local_path)
+                return True
             
             # No valid local file, but might be remote-only
             if storage_status == 'remote' and remote_path:
-                log_debug(f"[VALIDATION OK] File marked as remote-only for message {message_id}")
+                log_debug("[VALIDATION OK] File marked as remote-only for message %s", message_id)
                 return True
             
-            log_debug(f"[VALIDATION FAILED] No valid location found for message {message_id}")
+            log_debug("[VALIDATION FAILED] No valid location found for message %s", message_id)
             return False
         else:
             # JSON backend - legacy local-only validation
-            self._migrate_to_dict_format()
             file_info = self.state['downloaded_messages'].get(str(message_id))
             if not file_info:
                 return False
@@ -285,28 +566,24 @@ class StateManager:
             file_path = file_info.get('path')
             expected_size = file_info.get('size', 0)
         
-            if not file_path or not os.path.exists(file_path):
-                log_debug(f"File not found for message {message_id}: {file_path}")
+            actual_size = self._file_size(file_path)
+            if actual_size is None:
+                log_debug("File not found for message %s: %s", message_id, file_path)
                 return False
         
-            try:
-                actual_size = os.path.getsize(file_path)
-                if actual_size == 0:
-                    log_debug(f"[VALIDATION FAILED] File is empty (0 bytes) for message {message_id}: {file_path}")
-                    return False
-            
-                if expected_size > 0:
-                    size_diff = abs(actual_size - expected_size)
-                    tolerance = expected_size * 0.01
-                    if size_diff > tolerance and size_diff > 1024:
-                        log_debug(f"[VALIDATION FAILED] File size mismatch for message {message_id}: expected {expected_size} bytes, got {actual_size} bytes (diff: {size_diff} bytes)")
-                        return False
-            
-                log_debug(f"[VALIDATION OK] File valid for message {message_id}: {actual_size} bytes at {file_path}")
-                return True
-            except Exception as e:
-                log_debug(f"[VALIDATION ERROR] Error validating file for message {message_id}: {e}")
+            if actual_size == 0:
+                log_debug("[VALIDATION FAILED] File is empty (0 bytes) for message %s: %s", message_id, file_path)
                 return False
+        
+            if expected_size and expected_size > 0:
+                size_diff = abs(actual_size - expected_size)
+                tolerance = expected_size * 0.01
+                if size_diff > tolerance and size_diff > 1024:
+                    log_debug("[VALIDATION FAILED] File size mismatch for message %s: expected %s bytes, got %s bytes (diff: %s bytes)", message_id, expected_size, actual_size, size_diff)
+                    return False
+        
+            log_debug("[VALIDATION OK] File valid for message %s: %s bytes at %s", message_id, actual_size, file_path)
+            return True
     
     def is_message_downloaded(self, message_id):
         """
@@ -314,6 +591,12 @@ class StateManager:
         """
         if self.use_db:
             try:
+                # Messages without a row cannot be downloaded; only known IDs
+                # need the availability query
+                if self._known_message_ids is None:
+                    self._known_message_ids = self.db.known_message_ids(self.chat_id)
+                if int(message_id) not in self._known_message_ids:
+                    return False
                 return self.db.is_message_downloaded(self.chat_id, message_id)
             except Exception as e:
                 if self._is_db_corruption_error(e):
@@ -322,12 +605,41 @@ class StateManager:
                     return self.is_message_downloaded(message_id)
                 raise
         
-        msg_id_str = str(message_id)
-        # Handle both old format (list) and new format (dict)
-        if isinstance(self.state['downloaded_messages'], list):
-            return message_id in self.state['downloaded_messages']
-        else:
-            return msg_id_str in self.state['downloaded_messages']
+        return str(message_id) in self.state['downloaded_messages']
+    
+    def get_downloaded_message_ids(self):
+        """
+        Return the set of downloaded message IDs (as ints) for fast membership tests.
+        """
+        if self.use_db:
+            try:
+                return self.db.downloaded_message_ids(self.chat_id)
+            except Exception as e:
+                if self._is_db_corruption_error(e):
+                    self._recover_sqlite_db(e)
+                    self._init_sql_backend_with_recovery()
+                    return self.get_downloaded_message_ids()
+                raise
+        
+        # State generated from files on disk keys some entries by filename
+        # stem (e.g. 'photo_5'); those never match a message id
+        return {int(msg_id) for msg_id in self.state['downloaded_messages'] if msg_id.isdigit()}
+    
+    def get_skipped_message_ids(self):
+        """
+        Return the set of skipped message IDs (as ints) for fast membership tests.
+        """
+        if self.use_db:
+            try:
+                return set(self.db.get_messages_by_status(self.chat_id, 'skipped'))
+            except Exception as e:
+                if self._is_db_corruption_error(e):
+                    self._recover_sqlite_db(e)
+                    self._init_sql_backend_with_recovery()
+                    return self.get_skipped_message_ids()
+                raise
+        
+        return set(self.state['skipped_messages'])
     
     def is_message_skipped(self, message_id):
         """
@@ -344,7 +656,7 @@ class StateManager:
                     return self.is_message_skipped(message_id)
                 raise
         
-        return message_id in self.state['skipped_messages']
+        return int(message_id) in self.state['skipped_messages']
     
     def is_message_failed(self, message_id):
         """
@@ -361,7 +673,7 @@ class StateManager:
                     return self.is_message_failed(message_id)
                 raise
         
-        return message_id in self.state['failed_messages']
+        return int(message_id) in self.state['failed_messages']
     
     def update_file_path(self, old_path, new_path):
         """
@@ -377,13 +689,12 @@ class StateManager:
                     return self.update_file_path(old_path, new_path)
                 raise
         
-        if isinstance(self.state['downloaded_messages'], dict):
-            for msg_id, file_info in self.state['downloaded_messages'].items():
-                if file_info.get('path') == old_path:
-                    file_info['path'] = new_path
-                    file_info['filename'] = os.path.basename(new_path)
-                    self._save_state()
-                    return True
+        for msg_id, file_info in self.state['downloaded_messages'].items():
+            if file_info.get('path') == old_path:
+                file_info['path'] = new_path
+                file_info['filename'] = os.path.basename(new_path)
+                self._save_state()
+                return True
         return False
     
     def mark_downloaded(self, message_id, file_path=None, file_size=0, sample_hash=None, full_hash=None):
@@ -397,37 +708,24 @@ class StateManager:
             sample_hash: SHA-256 hash of first+last 64KB (optional)
             full_hash: Full SHA-256 hash (optional)
         """
+        filename = os.path.basename(file_path) if file_path else 'unknown'
+        
         if self.use_db:
             try:
-                # Add message to database
-                filename = os.path.basename(file_path) if file_path else 'unknown'
-                msg_rec_id = self.db.add_message(
-                    self.chat_id, message_id, filename, file_path, 
+                # Message row, status, global hash entry and chat totals in one
+                # transaction (the global index lives in the same database)
+                self.db.record_download(
+                    self.chat_id, message_id, file_path,
                     file_size, sample_hash, full_hash
                 )
+                if self._known_message_ids is not None:
+                    self._known_message_ids.add(int(message_id))
 
-                # Mark status as downloaded
-                self.db.set_message_status(self.chat_id, message_id, 'downloaded')
-
-                # Update hash indices
-                if sample_hash and file_size > 0 and msg_rec_id:
-                    self.db.register_file_hash(file_size, sample_hash, file_path, msg_rec_id, self.chat_id)
-                    self.global_state.register_file(file_size, sample_hash, file_path)
-
-                # Update chat stats
-                stats = self.db.get_chat_stats(self.chat_id)
-                self.db.update_chat_stats(
-                    self.chat_id,
-                    total_files=stats.get('total_files', 0) + 1,
-                    total_bytes=stats.get('total_bytes', 0) + file_size,
-                    last_message_id=message_id
-                )
-
-                log_debug(f"Marked message {message_id} as downloaded (SQL): {filename}")
+                log_debug("Marked message %s as downloaded (SQL): %s", message_id, filename)
             except sqlite3.IntegrityError as e:
-                log_debug(f"[DB ERROR] Integrity error while marking downloaded for message {message_id}: {e}")
+                log_debug("[DB ERROR] Integrity error while marking downloaded for message %s: %s", message_id, e)
             except Exception as e:
-                log_debug(f"[DB ERROR] Failed to mark downloaded for message {message_id}: {e}")
+                log_debug("[DB ERROR] Failed to mark downloaded for message %s: %s", message_id, e)
                 if self._is_db_corruption_error(e):
                     self._recover_sqlite_db(e)
                     self._init_sql_backend_with_recovery()
@@ -435,39 +733,62 @@ class StateManager:
             return
         
         # JSON backend
-        msg_id_str = str(message_id)
-        
-        # Migrate old format to new format if needed
-        self._migrate_to_dict_format()
-        
-        # Add or update entry
-        if msg_id_str not in self.state['downloaded_messages']:
-            self.state['total_files'] += 1
-            self.state['total_bytes'] += file_size
-            log_debug(f"Marked message {message_id} as downloaded: {os.path.basename(file_path) if file_path else 'N/A'}")
-        
-        file_info = {
-            'filename': os.path.basename(file_path) if file_path else 'unknown',
-            'size': file_size,
-            'path': file_path
-        }
+        if str(message_id) not in self.state['downloaded_messages']:
+            log_debug("Marked message %s as downloaded: %s", message_id, filename)
         
-        # Add hash fields if provided
+        op = {'op': 'dl', 'id': message_id, 'f': file_path, 's': file_size}
         if sample_hash:
-            file_info['sample_hash'] = sample_hash
+            op['h'] = sample_hash
         if full_hash:
-            file_info['full_hash'] = full_hash
-        
-        self.state['downloaded_messages'][msg_id_str] = file_info
+            op['fh'] = full_hash
+        # Entry and hash index are updated by _apply_op
+        self._record_op(op)
         
-        # Update hash index for duplicate detection
         if sample_hash and file_size > 0:
-            self._update_hash_index(file_size, sample_hash, message_id)
             # Also update global hash index for cross-chat duplicate detection
             self.global_state.register_file(file_size, sample_hash, file_path)
+    
+    def mark_downloaded_bulk(self, records):
+        """
+        Mark many messages as downloaded at once.
         
-        self.state['last_message_id'] = message_id
+        Args:
+            records: Iterable of (message_id, file_path, file_size, sample_hash) tuples
+        """
+        records = list(records)
+        if not records:
+            return
+        
+        if self.use_db:
+            try:
+                count = self.db.record_downloads_bulk(self.chat_id, records)
+                if self._known_message_ids is not None:
+                    self._known_message_ids.update(int(record[0]) for record in records)
+                log_debug("Marked %s messages as downloaded (SQL bulk)", count)
+            except Exception as e:
+                log_debug("[DB ERROR] Failed to bulk mark %s messages as downloaded: %s", len(records), e)
+                if self._is_db_corruption_error(e):
+                    self._recover_sqlite_db(e)
+                    self._init_sql_backend_with_recovery()
+                    self.mark_downloaded_bulk(records)
+            return
+        
+        ops = []
+        for message_id, file_path, file_size, sample_hash in records:
+            op = {'op': 'dl', 'id': message_id, 'f': file_path, 's': file_size}
+            if sample_hash:
+                op['h'] = sample_hash
+            self._apply_op(op)
+            ops.append(op)
+        
+        self._append_log(ops)
+        self.global_state.register_files_bulk(
+            (file_size, sample_hash, file_path)
+            for _, file_path, file_size, sample_hash in records
+            if sample_hash and file_size > 0
+        )
         self._save_state()
+        log_debug("Marked %s messages as downloaded", len(records))
     
     def mark_skipped(self, message_id):
         """
@@ -475,25 +796,22 @@ class StateManager:
         """
         if self.use_db:
             try:
-                self.db.set_message_status(self.chat_id, message_id, 'skipped')
-                self.db.update_chat_stats(self.chat_id, last_message_id=message_id)
-                log_debug(f"Marked message {message_id} as skipped (SQL)")
+                self.db.record_status(self.chat_id, message_id, 'skipped')
+                log_debug("Marked message %s as skipped (SQL)", message_id)
             except sqlite3.IntegrityError as e:
-                log_debug(f"[DB ERROR] Integrity error while marking skipped for message {message_id}: {e}")
+                log_debug("[DB ERROR] Integrity error while marking skipped for message %s: %s", message_id, e)
             except Exception as e:
-                log_debug(f"[DB ERROR] Failed to mark skipped for message {message_id}: {e}")
+                log_debug("[DB ERROR] Failed to mark skipped for message %s: %s", message_id, e)
                 if self._is_db_corruption_error(e):
                     self._recover_sqlite_db(e)
                     self._init_sql_backend_with_recovery()
                     self.mark_skipped(message_id)
             return
         
-        if message_id not in self.state['skipped_messages']:
-            self.state['skipped_messages'].append(message_id)
-            log_debug(f"Marked message {message_id} as skipped")
+        if int(message_id) not in self.state['skipped_messages']:
+            log_debug("Marked message %s as skipped", message_id)
         
-        self.state['last_message_id'] = message_id
-        self._save_state()
+        self._record_op({'op': 'sk', 'id': message_id})
     
     def mark_failed(self, message_id):
         """
@@ -501,25 +819,22 @@ class StateManager:
         """
         if self.use_db:
             try:
-                self.db.set_message_status(self.chat_id, message_id, 'failed')
-                self.db.update_chat_stats(self.chat_id, last_message_id=message_id)
-                log_debug(f"Marked message {message_id} as failed (SQL)")
+                self.db.record_status(self.chat_id, message_id, 'failed')
+                log_debug("Marked message %s as failed (SQL)", message_id)
             except sqlite3.IntegrityError as e:
-                log_debug(f"[DB ERROR] Integrity error while marking failed for message {message_id}: {e}")
+                log_debug("[DB ERROR] Integrity error while marking failed for message %s: %s", message_id, e)
             except Exception as e:
-                log_debug(f"[DB ERROR] Failed to mark failed for message {message_id}: {e}")
+                log_debug("[DB ERROR] Failed to mark failed for message %s: %s", message_id, e)
                 if self._is_db_corruption_error(e):
                     self._recover_sqlite_db(e)
                     self._init_sql_backend_with_recovery()
                     self.mark_failed(message_id)
             return
         
-        if message_id not in self.state['failed_messages']:
-            self.state['failed_messages'].append(message_id)
-            log_debug(f"Marked message {message_id} as failed")
+        if int(message_id) not in self.state['failed_messages']:
+            log_debug("Marked message %s as failed", message_id)
         
-        self.state['last_message_id'] = message_id
-        self._save_state()
+        self._record_op({'op': 'fl', 'id': message_id})
     
     def mark_completed(self):
         """
@@ -528,7 +843,7 @@ class StateManager:
         if self.use_db:
             try:
                 self.db.mark_chat_completed(self.chat_id)
-                log_debug(f"Marked chat as completed (SQL)")
+                log_debug("Marked chat as completed (SQL)")
             except Exception as e:
                 if self._is_db_corruption_error(e):
                     self._recover_sqlite_db(e)
@@ -540,7 +855,8 @@ class StateManager:
         
         self.state['completed'] = True
         self.state['completed_at'] = datetime.now().isoformat()
-        self._save_state()
+        self._save_state_now()
+        self.global_state.flush_state()
     
     def get_stats(self):
         """
@@ -566,16 +882,12 @@ class StateManager:
                 'last_message_id': chat_stats.get('last_message_id')
             }
         
-        downloaded_count = len(self.state['downloaded_messages']) if isinstance(
-            self.state['downloaded_messages'], (list, dict)
-        ) else 0
-        
         return {
-            'downloaded': downloaded_count,
+            'downloaded': len(self.state['downloaded_messages']),
             'skipped': len(self.state['skipped_messages']),
             'failed': len(self.state['failed_messages']),
-            'total_files': self.state['total_files'],
-            'total_bytes': self.state['total_bytes'],
+            'total_files': self.total_files,
+            'total_bytes': self.total_bytes,
             'last_message_id': self.state['last_message_id']
         }
     
@@ -595,15 +907,7 @@ class StateManager:
             return (stats.get('total_files', 0) > 0 or 
                    stats.get('last_message_id') is not None)
         
-        downloaded_messages = self.state.get('downloaded_messages', [])
-        has_downloads = False
-        
-        if isinstance(downloaded_messages, list):
-            has_downloads = len(downloaded_messages) > 0
-        elif isinstance(downloaded_messages, dict):
-            has_downloads = len(downloaded_messages) > 0
-        
-        return has_downloads or self.state.get('last_message_id') is not None
+        return bool(self.state['downloaded_messages']) or self.state.get('last_message_id') is not None
     
     def get_resume_info(self):
         """Get information about resume state"""
@@ -627,26 +931,25 @@ class StateManager:
                 'last_message_id': stats.get('last_message_id')
             }
         
-        downloaded_messages = self.state.get('downloaded_messages', [])
-        downloaded_count = len(downloaded_messages) if isinstance(
-            downloaded_messages, (list, dict)
-        ) else 0
-        
         return {
             'started_at': self.state['started_at'],
             'last_updated': self.state['last_updated'],
-            'downloaded': downloaded_count,
+            'downloaded': len(self.state['downloaded_messages']),
             'last_message_id': self.state['last_message_id']
         }
     
     def delete_state(self):
         """Delete state file (for fresh start)"""
-        if os.path.exists(self.state_file):
-            try:
-                os.remove(self.state_file)
-                log_debug(f"Deleted state file: {self.state_file}")
-            except Exception as e:
-                log_debug(f"Failed to delete state file: {e}")
+        self._dirty = False
+        self._last_saved_digest = None
+        self._truncate_log()
+        for path in (self.state_file, f"{self.state_file}.zst"):
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                    log_debug("Deleted state file: %s", path)
+                except Exception as e:
+                    log_debug("Failed to delete state file: %s", e)
     
     def _update_hash_index(self, file_size, sample_hash, message_id):
         """
@@ -657,19 +960,38 @@ class StateManager:
             sample_hash: Sample hash of the file
             message_id: Message ID to add to index
         """
-        if 'hash_index' not in self.state:
-            self.state['hash_index'] = {}
-        
         # Use tuple (size, hash) as key for precise matching
-        key = f"{file_size}:{sample_hash}"
-        
-        if key not in self.state['hash_index']:
-            self.state['hash_index'][key] = []
+        msg_ids = self.state.setdefault('hash_index', {}).setdefault((int(file_size), sample_hash), [])
         
         msg_id_str = str(message_id)
-        if msg_id_str not in self.state['hash_index'][key]:
-            self.state['hash_index'][key].append(msg_id_str)
-            log_debug(f"Added message {message_id} to hash index (size={file_size}, hash={sample_hash[:8]}...)")
+        if msg_id_str not in msg_ids:
+            msg_ids.append(msg_id_str)
+            log_debug("Added message %s to hash index (size=%s, hash=%s...)", message_id, file_size, sample_hash[:8])
+    
+    def _hash_unhashed_files(self, file_size):
+        """
+        Compute sample hashes for downloaded files of file_size that were
+        recorded without one, and add them to the hash index (JSON backend).
+        """
+        if self._unhashed_by_size is None:
+            self._unhashed_by_size = {}
+            for msg_id_str, file_info in self.state['downloaded_messages'].items():
+                size = file_info.get('size') or 0
+                if size > 0 and not file_info.get('sample_hash') and file_info.get('path'):
+                    self._unhashed_by_size.setdefault(size, []).append(msg_id_str)
+        
+        msg_ids = self._unhashed_by_size.pop(int(file_size), None)
+        if not msg_ids:
+            return
+        for msg_id_str in msg_ids:
+            file_info = self.state['downloaded_messages'].get(msg_id_str)
+            if not file_info or file_info.get('sample_hash') or not os.path.exists(file_info['path']):
+                continue
+            sample_hash = utils.sample_hash_file(file_info['path'])
+            if sample_hash:
+                file_info['sample_hash'] = sample_hash
+                self._update_hash_index(file_size, sample_hash, msg_id_str)
+        self._save_state()
     
     def find_duplicate(self, file_size, sample_hash):
         """
@@ -698,15 +1020,15 @@ class StateManager:
                     
                     # Check if file is available in any location
                     if storage_status == 'remote' and remote_path:
-                        log_debug(f"Found remote duplicate in same chat (SQL): size={file_size}, hash={sample_hash[:8]}... -> message {msg_id} (remote)")
+                        log_debug("Found remote duplicate in same chat (SQL): size=%s, hash=%s... -> message %s (remote)", file_size, sample_hash[:8], msg_id)
                         return msg_id, {'remote_path': remote_path, 'storage_status': 'remote'}
                     
-                    if local_path and os.path.exists(local_path):
-                        log_debug(f"Found local duplicate in same chat (SQL): size={file_size}, hash={sample_hash[:8]}... -> message {msg_id}")
+                    if local_path and _path_exists(local_path):
+                        log_debug("Found local duplicate in same chat (SQL): size=%s, hash=%s... -> message %s", file_size, sample_hash[:8], msg_id)
                         return msg_id, local_path
                     
                     if storage_status == 'both':
-                        log_debug(f"Found duplicate in both locations (SQL): message {msg_id}")
+                        log_debug("Found duplicate in both locations (SQL): message %s", msg_id)
                         return msg_id, {'local_path': local_path, 'remote_path': remote_path, 'storage_status': 'both'}
 
                 # Check global index
@@ -718,11 +1040,11 @@ class StateManager:
                     
                     # Trust remote location in global index
                     if storage_location == 'remote' and remote_ref:
-                        log_debug(f"Found remote duplicate across chats (SQL): size={file_size}, hash={sample_hash[:8]}... -> {remote_ref}")
+                        log_debug("Found remote duplicate across chats (SQL): size=%s, hash=%s... -> %s", file_size, sample_hash[:8], remote_ref)
                         return 'global', {'remote_path': remote_ref, 'storage_status': 'remote'}
                     
-                    if global_path and os.path.exists(global_path):
-                        log_debug(f"Found local duplicate across chats (SQL): size={file_size}, hash={sample_hash[:8]}... -> {global_path}")
+                    if global_path and _path_exists(global_path):
+                        log_debug("Found local duplicate across chats (SQL): size=%s, hash=%s... -> %s", file_size, sample_hash[:8], global_path)
                         return 'global', global_path
             except Exception as e:
                 if self._is_db_corruption_error(e):
@@ -734,24 +1056,21 @@ class StateManager:
             return None, None
         
         # JSON backend - legacy local-only
-        if 'hash_index' not in self.state:
-            self.state['hash_index'] = {}
-        
-        key = f"{file_size}:{sample_hash}"
-        existing_msg_ids = self.state['hash_index'].get(key, [])
+        self._hash_unhashed_files(file_size)
+        existing_msg_ids = self.state.get('hash_index', {}).get((int(file_size), sample_hash), ())
         
         # Return first valid match from this chat
         for msg_id_str in existing_msg_ids:
             file_info = self.state['downloaded_messages'].get(msg_id_str)
             if file_info and file_info.get('path'):
-                if os.path.exists(file_info['path']):
-                    log_debug(f"Found duplicate in same chat: size={file_size}, hash={sample_hash[:8]}... -> message {msg_id_str}")
+                if _path_exists(file_info['path']):
+                    log_debug("Found duplicate in same chat: size=%s, hash=%s... -> message %s", file_size, sample_hash[:8], msg_id_str)
                     return msg_id_str, file_info['path']
         
         # Check global hash index (across all chats)
         global_path = self.global_state.find_duplicate(file_size, sample_hash)
-        if global_path and os.path.exists(global_path):
-            log_debug(f"Found duplicate across chats: size={file_size}, hash={sample_hash[:8]}... -> {global_path}")
+        if global_path and _path_exists(global_path):
+            log_debug("Found duplicate across chats: size=%s, hash=%s... -> %s", file_size, sample_hash[:8], global_path)
             return 'global', global_path
         
         return None, None
@@ -786,31 +1105,20 @@ class StateManager:
                 
                 self.db.mark_duplicate(self.chat_id, duplicate_msg_id, self.chat_id, canonical_msg_id)
                 self.db.set_message_status(self.chat_id, duplicate_msg_id, 'skipped', 'duplicate')
-                log_debug(f"Marked message {duplicate_msg_id} as duplicate (canonical: {canonical_ref})")
+                log_debug("Marked message %s as duplicate (canonical: %s)", duplicate_msg_id, canonical_ref)
             except Exception as e:
                 if self._is_db_corruption_error(e):
                     self._recover_sqlite_db(e)
                     self._init_sql_backend_with_recovery()
                     self.mark_duplicate(duplicate_msg_id, canonical_ref)
                 else:
-                    log_debug(f"Error marking duplicate: {e}")
+                    log_debug("Error marking duplicate: %s", e)
             return
         
-        # JSON backend
-        # JSON backend
-        if 'duplicate_map' not in self.state:
-            self.state['duplicate_map'] = {}
-        
-        msg_id_str = str(duplicate_msg_id)
+        # JSON backend: recorded in duplicate_map and marked as skipped
         canonical_str = str(canonical_ref) if not isinstance(canonical_ref, dict) else 'location_based'
-        self.state['duplicate_map'][msg_id_str] = canonical_str
-        
-        # Mark as skipped
-        if msg_id_str not in self.state['skipped_messages']:
-            self.state['skipped_messages'].append(int(duplicate_msg_id))
-        
-        self._save_state()
-        log_debug(f"Marked message {duplicate_msg_id} as duplicate of {canonical_ref}")
+        self._record_op({'op': 'dup', 'id': duplicate_msg_id, 'c': canonical_str})
+        log_debug("Marked message %s as duplicate of %s", duplicate_msg_id, canonical_ref)
     
     def is_duplicate(self, message_id):
         """
@@ -891,7 +1199,7 @@ class StateManager:
         
         computed_hash = self.compute_file_hash(file_path, full=False)
         if computed_hash != stored_hash:
-            log_debug(f"Hash mismatch for message {message_id}: stored={stored_hash[:8]}..., computed={computed_hash[:8] if computed_hash else 'None'}...")
+            log_debug("Hash mismatch for message %s: stored=%s..., computed=%s...", message_id, stored_hash[:8], computed_hash[:8] if computed_hash else 'None')
             return False
         
         return True
@@ -902,19 +1210,21 @@ class StateManager:
         Useful after loading old state files or manual state modifications.
         """
         log_debug("Rebuilding hash index from downloaded messages...")
-        self.state['hash_index'] = {}
-        
+        # Built in one pass; keys are unique per message, so no per-entry
+        # membership check is needed as in _update_hash_index
+        hash_index = defaultdict(list)
         count = 0
         for msg_id_str, file_info in self.state['downloaded_messages'].items():
             sample_hash = file_info.get('sample_hash')
-            file_size = file_info.get('size', 0)
+            file_size = file_info.get('size') or 0
             
             if sample_hash and file_size > 0:
-                self._update_hash_index(file_size, sample_hash, msg_id_str)
+                hash_index[(int(file_size), sample_hash)].append(msg_id_str)
                 count += 1
+        self.state['hash_index'] = dict(hash_index)
         
-        log_debug(f"Rebuilt hash index with {count} entries")
-        self._save_state()
+        log_debug("Rebuilt hash index with %s entries", count)
+        self._save_state_now()
 
 
 class GlobalStateManager:
@@ -924,25 +1234,33 @@ class GlobalStateManager:
     Supports both SQLite and JSON backends.
     """
     
-    def __init__(self, output_dir):
+    def __init__(self, output_dir, db=None):
         """
         Initialize global state manager.
         
         Args:
             output_dir: Base directory where all backups are stored
+            db: Optional DatabaseManager to share (SQLite backend); a new one
+                is opened when not given
         """
         self.output_dir = output_dir
         self.state_file = os.path.join(output_dir, ".backup_state_global.json")
         
         # Use SQL backend if enabled
         self.use_db = config.DB_ENABLE
-        self.db = None
+        self.db = db
         
-        if self.use_db:
+        # Debounced JSON saves, same policy as StateManager
+        self._dirty = False
+        self._pending_saves = 0
+        self._last_save = time.monotonic()
+        
+        if self.use_db and self.db is None:
             self._init_sql_backend_with_recovery()
         
         if not self.use_db:
             self.state = self._load_state()
+            _json_state_managers.add(self)
             log_debug("Using JSON backend for global state")
 
     def _is_db_corruption_error(self, error):
@@ -986,9 +1304,9 @@ class GlobalStateManager:
             corrupt_copy = f"{db_path}.corrupt.{timestamp}"
             try:
                 os.replace(db_path, corrupt_copy)
-                log_debug(f"[DB ERROR] Corrupted database moved to: {corrupt_copy}")
+                log_debug("[DB ERROR] Corrupted database moved to: %s", corrupt_copy)
             except Exception as move_error:
-                log_debug(f"[DB ERROR] Could not archive corrupted database: {move_error}")
+                log_debug("[DB ERROR] Could not archive corrupted database: %s", move_error)
                 raise
 
         for suffix in ["-wal", "-shm"]:
@@ -1000,36 +1318,82 @@ class GlobalStateManager:
                     pass
 
         if error is not None:
-            log_debug(f"[DB ERROR] Recreating SQLite database after corruption: {error}")
+            log_debug("[DB ERROR] Recreating SQLite database after corruption: %s", error)
     
     def _load_state(self):
         """Load existing global state or create new one."""
-        if os.path.exists(self.state_file):
-            try:
-                with open(self.state_file, 'r', encoding='utf-8') as f:
-                    loaded_state = json.load(f)
-                log_debug(f"Loaded global state from {self.state_file}")
-                return loaded_state
-            except Exception as e:
-                log_debug(f"Failed to load global state: {e}. Creating new state.")
+        try:
+            loaded_state = json_loads(read_state_file(self.state_file))
+            log_debug("Loaded global state from %s", self.state_file)
+            return self._normalize_state(loaded_state)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log_debug("Failed to load global state: %s. Creating new state.", e)
         
         log_debug("Creating new global state")
         return {
             'created_at': datetime.now().isoformat(),
             'last_updated': None,
-            'hash_index': {},  # Dict: {(size, hash): file_path} maps to first occurrence
+            'hash_index': {},  # Dict: {(size, hash): file_path} maps to first occurrence ("size:hash" keys on disk)
             'version': '1.0'
         }
     
+    @staticmethod
+    def _normalize_state(state):
+        """Key hash_index by (size, sample_hash) tuples in memory ("size:hash" strings on disk)."""
+        hash_index = {}
+        for key, file_path in state.get('hash_index', {}).items():
+            size, _, sample_hash = key.partition(':')
+            try:
+                hash_index[(int(size), sample_hash)] = file_path
+            except ValueError:
+                continue
+        state['hash_index'] = hash_index
+        return state
+    
+    def _serializable_state(self):
+        """Shallow copy of the global state with hash_index keys back to "size:hash" strings."""
+        state = dict(self.state)
+        state['hash_index'] = {
+            f"{size}:{sample_hash}": file_path
+            for (size, sample_hash), file_path in self.state.get('hash_index', {}).items()
+        }
+        return state
+    
     def _save_state(self):
+        """
+        Record a change and save the global state once StateManager.SAVE_THRESHOLD
+        changes or SAVE_INTERVAL_SECONDS have accumulated. Use flush_state() to force a write.
+        """
+        self._dirty = True
+        self._pending_saves += 1
+        if (self._pending_saves >= StateManager.SAVE_THRESHOLD or
+                time.monotonic() - self._last_save >= StateManager.SAVE_INTERVAL_SECONDS):
+            self._save_state_now()
+    
+    def _save_state_now(self):
         """Save the current global state to file."""
         self.state['last_updated'] = datetime.now().isoformat()
         try:
-            with open(self.state_file, 'w', encoding='utf-8') as f:
-                json.dump(self.state, f, indent=2)
-            log_debug(f"Global state saved to {self.state_file}")
+            write_state_file(self.state_file, json_dumps_bytes(self._serializable_state()))
+            self._dirty = False
+            self._pending_saves = 0
+            self._last_save = time.monotonic()
+            log_debug("Global state saved to %s", self.state_file)
         except Exception as e:
-            log_debug(f"Error saving global state: {e}")
+            log_debug("Error saving global state: %s", e)
+    
+    def flush_state(self):
+        """Write any pending global state changes to disk (JSON backend only)."""
+        if not self.use_db and self._dirty:
+            self._save_state_now()
+    
+    def __del__(self):
+        try:
+            self.flush_state()
+        except Exception:
+            pass
     
     def register_file(self, file_size, sample_hash, file_path):
         """
@@ -1056,16 +1420,51 @@ class GlobalStateManager:
         if 'hash_index' not in self.state:
             self.state['hash_index'] = {}
         
-        key = f"{file_size}:{sample_hash}"
+        key = (file_size, sample_hash)
         
         # Only store if not already present (keep first occurrence)
         if key not in self.state['hash_index']:
             self.state['hash_index'][key] = file_path
-            log_debug(f"Registered in global index: size={file_size}, hash={sample_hash[:8]}... -> {os.path.basename(file_path)}")
+            log_debug("Registered in global index: size=%s, hash=%s... -> %s", file_size, sample_hash[:8], os.path.basename(file_path))
             self._save_state()
         else:
             # File already registered, this is a duplicate
-            log_debug(f"File already in global index: size={file_size}, hash={sample_hash[:8]}...")
+            log_debug("File already in global index: size=%s, hash=%s...", file_size, sample_hash[:8])
+    
+    def register_files_bulk(self, records):
+        """
+        Register many files in the global hash index with a single write.
+        
+        Args:
+            records: Iterable of (file_size, sample_hash, file_path) tuples
+        """
+        records = list(records)
+        if not records:
+            return
+        
+        if self.use_db:
+            try:
+                self.db.bulk_register_file_hashes(records)
+            except Exception as e:
+                if self._is_db_corruption_error(e):
+                    self._recover_sqlite_db(e)
+                    self._init_sql_backend_with_recovery()
+                    self.register_files_bulk(records)
+                else:
+                    raise
+            return
+        
+        hash_index = self.state.setdefault('hash_index', {})
+        added = 0
+        for file_size, sample_hash, file_path in records:
+            key = (file_size, sample_hash)
+            # Only store if not already present (keep first occurrence)
+            if key not in hash_index:
+                hash_index[key] = file_path
+                added += 1
+        if added:
+            log_debug("Registered %s file(s) in global index", added)
+            self._save_state()
     
     def find_duplicate(self, file_size, sample_hash):
         """
@@ -1080,8 +1479,9 @@ class GlobalStateManager:
         """
         if self.use_db:
             try:
-                file_path = self.db.find_duplicate_by_hash(file_size, sample_hash)
-                if file_path and os.path.exists(file_path):
+                result = self.db.find_duplicate_by_hash(file_size, sample_hash)
+                file_path = result.get('path') if result else None
+                if file_path and _path_exists(file_path):
                     return file_path
                 return None
             except Exception as e:
@@ -1094,14 +1494,14 @@ class GlobalStateManager:
         if 'hash_index' not in self.state:
             return None
         
-        key = f"{file_size}:{sample_hash}"
+        key = (file_size, sample_hash)
         file_path = self.state['hash_index'].get(key)
         
-        if file_path and os.path.exists(file_path):
+        if file_path and _path_exists(file_path):
             return file_path
         elif file_path:
             # File was registered but no longer exists, remove from index
-            log_debug(f"Global index entry points to missing file: {file_path}")
+            log_debug("Global index entry points to missing file: %s", file_path)
             del self.state['hash_index'][key]
             self._save_state()
         
@@ -1115,37 +1515,33 @@ class GlobalStateManager:
         Args:
             backup_dir: Root backup directory to scan
         """
-        log_debug(f"Rebuilding global hash index from {backup_dir}...")
-        self.state['hash_index'] = {}
-        
-        count = 0
-        for root, _, files in os.walk(backup_dir):
-            # Skip hidden files and duplicates folder
-            if 'duplicates' in root or '/.backup_state' in root:
-                continue
-            
-            for fname in files:
-                if fname.startswith('.'):
-                    continue
-                
-                fpath = os.path.join(root, fname)
-                if not os.path.isfile(fpath):
-                    continue
-                
-                try:
-                    size = os.path.getsize(fpath)
-                    sample_hash = utils.sample_hash_file(fpath)
-                    
+        log_debug("Rebuilding global hash index from %s...", backup_dir)
+        
+        # Skip hidden files, and never descend into the duplicates folder or
+        # hidden directories (.backup_state etc.)
+        def skip_dir(path):
+            name = os.path.basename(path)
+            return name == 'duplicates' or name.startswith('.')
+        files = []
+        for entry in utils.iter_files(backup_dir, skip_dir):
+            try:
+                files.append((entry.path, entry.stat().st_size))
+            except OSError as e:
+                log_debug("Error processing %s: %s", entry.path, e)
+        
+        # Hash in a thread pool (I/O-bound), then build the index in scan order
+        # so the first occurrence is the same as a serial scan would pick
+        hash_index = {}
+        if files:
+            workers = min(config.HASH_WORKERS, len(files)) or 1
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                hashes = executor.map(utils.sample_hash_file_mmap, [path for path, _ in files])
+                for (fpath, size), sample_hash in zip(files, hashes):
                     if sample_hash:
-                        key = f"{size}:{sample_hash}"
-                        # Only register first occurrence
-                        if key not in self.state['hash_index']:
-                            self.state['hash_index'][key] = fpath
-                            count += 1
-                except Exception as e:
-                    log_debug(f"Error processing {fpath}: {e}")
-                    continue
+                        hash_index.setdefault((size, sample_hash), fpath)
         
-        log_debug(f"Rebuilt global hash index with {count} unique files")
-        self._save_state()
+        self.state['hash_index'] = hash_index
+        count = len(hash_index)
+        log_debug("Rebuilt global hash index with %s unique files", count)
+        self._save_state_now()
         return count
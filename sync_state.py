@@ -4,9 +4,11 @@ Sync backup state from filesystem and rclone remote.
 Scans local files and remote listing to build/update state database.
 """
 import os
+import re
 import sys
 import argparse
-from collections import defaultdict
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
 from rich.console import Console
 from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn
 from rclone_manager import RcloneManager
@@ -16,85 +18,103 @@ import utils
 
 console = Console()
 
+# Leading digits followed by "_", a single extension, or nothing
+_MESSAGE_ID_RE = re.compile(r'(\d+)(?:_|\.[^.]*$|$)')
+
 
 def extract_message_id_from_filename(filename):
     """
     Extract message ID from filename.
     Assumes format: <message_id>_<description>.<ext> or <message_id>.<ext>
     """
-    try:
-        # Remove extension
-        name_without_ext = os.path.splitext(filename)[0]
-        # Try to extract leading number
-        parts = name_without_ext.split('_')
-        msg_id = int(parts[0])
-        return msg_id
-    except (ValueError, IndexError):
-        return None
+    match = _MESSAGE_ID_RE.match(filename)
+    return int(match.group(1)) if match else None
 
 
-def scan_local_files(backup_dir, chat_name):
+def scan_local_files(backup_dir, chat_name, db=None):
     """
     Scan local backup directory for files.
     
+    When db is given, sample hashes are reused from its hash cache for files
+    whose mtime and size are unchanged, and the cache is updated afterwards.
+    
     Returns:
         List of dicts with keys: message_id, filename, file_path, file_size, sample_hash
     """
     records = []
 
+    # The raw and sanitized names may be the same directory (identical, or
+    # differing only in case on a case-insensitive filesystem); scan it once
     candidate_dirs = []
+    seen_dirs = set()
     for candidate in (chat_name, utils.sanitize_dirname(chat_name)):
         candidate_path = os.path.join(backup_dir, candidate)
-        if candidate_path not in candidate_dirs:
+        try:
+            stat = os.stat(candidate_path)
+        except OSError:
+            continue
+        if (stat.st_dev, stat.st_ino) not in seen_dirs:
+            seen_dirs.add((stat.st_dev, stat.st_ino))
             candidate_dirs.append(candidate_path)
 
-    seen_paths = set()
+    cached = {}
+    mtimes = {}
     for chat_dir in candidate_dirs:
-        if not os.path.exists(chat_dir):
-            continue
+        if db is not None:
+            cached.update(db.get_cached_sample_hashes(chat_dir))
 
-        for root, _, files in os.walk(chat_dir):
-            for filename in files:
-                if filename.startswith('.'):
-                    continue
+        for entry in utils.iter_files(chat_dir):
+            filename = entry.name
+            file_path = entry.path
 
-                file_path = os.path.join(root, filename)
-                if file_path in seen_paths:
+            try:
+                stat = entry.stat()
+                file_size = stat.st_size
+                if file_size == 0:
                     continue
-                seen_paths.add(file_path)
 
-                if not os.path.isfile(file_path):
-                    continue
+                sample_hash = None
+                hit = cached.get(file_path)
+                if hit and hit[0] == stat.st_mtime_ns and hit[1] == file_size:
+                    sample_hash = hit[2]
+                else:
+                    mtimes[file_path] = stat.st_mtime_ns
 
-                try:
-                    file_size = os.path.getsize(file_path)
-                    if file_size == 0:
-                        continue
-
-                    # Extract message ID from filename (optional)
-                    message_id = extract_message_id_from_filename(filename)
-                    if not message_id:
-                        # Some backups don't include message IDs in filenames.
-                        # Keep record and resolve message_id from state using file paths later.
-                        try:
-                            message_id = int(os.path.splitext(filename)[0])
-                        except ValueError:
-                            message_id = None
-
-                    # Compute sample hash
-                    sample_hash = utils.sample_hash_file(file_path)
-
-                    records.append({
-                        'message_id': message_id,
-                        'filename': filename,
-                        'file_path': file_path,
-                        'local_path': file_path,
-                        'file_size': file_size,
-                        'sample_hash': sample_hash
-                    })
-                except Exception as e:
-                    console.print(f"[yellow]Warning: Error processing {filename}: {e}[/yellow]")
-                    continue
+                # Extract message ID from filename (optional). Some backups don't
+                # include message IDs in filenames; those records are resolved
+                # from state using file paths later.
+                message_id = extract_message_id_from_filename(filename)
+
+                records.append({
+                    'message_id': message_id,
+                    'filename': filename,
+                    'file_path': file_path,
+                    'local_path': file_path,
+                    'file_size': file_size,
+                    'sample_hash': sample_hash
+                })
+            except Exception as e:
+                console.print(f"[yellow]Warning: Error processing {filename}: {e}[/yellow]")
+                continue
+
+    # Hashing is I/O-bound; keep several reads in flight
+    to_hash = [record for record in records if record['sample_hash'] is None]
+    if to_hash:
+        workers = min(config.HASH_WORKERS, len(to_hash)) or 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            paths = [record['file_path'] for record in to_hash]
+            for record, sample_hash in zip(to_hash, executor.map(utils.sample_hash_file_mmap, paths)):
+                record['sample_hash'] = sample_hash
+
+    if db is not None:
+        cache_rows = [
+            (record['file_path'], mtimes[record['file_path']], record['file_size'], record['sample_hash'])
+            for record in to_hash if record['sample_hash']
+        ]
+        scanned = {record['file_path'] for record in records}
+        removed = [path for path in cached if path not in scanned]
+        if cache_rows or removed:
+            db.update_hash_cache(cache_rows, removed)
     
     return records
 
@@ -129,11 +149,6 @@ def scan_remote_files(rclone_manager, remote_path, chat_name, remote_chat_folder
 
                 # Extract message ID (optional)
                 message_id = extract_message_id_from_filename(filename)
-                if not message_id:
-                    try:
-                        message_id = int(os.path.splitext(filename)[0])
-                    except ValueError:
-                        message_id = None
 
                 records.append({
                     'message_id': message_id,
@@ -164,80 +179,91 @@ def sync_chat_state(db, chat_id, local_records, remote_records):
     
     all_msg_ids = set(local_map.keys()) | set(remote_map.keys())
     
+    # Collect rows first and write them in two bulk transactions per chat
+    message_rows = []
+    status_rows = []
     for msg_id in all_msg_ids:
         local_rec = local_map.get(msg_id)
         remote_rec = remote_map.get(msg_id)
         
         if local_rec and remote_rec:
             # File exists in both locations
-            db.add_message(
-                chat_id=chat_id,
-                message_id=msg_id,
-                filename=local_rec['filename'],
-                file_path=local_rec['file_path'],
-                file_size=local_rec['file_size'],
-                sample_hash=local_rec.get('sample_hash') or remote_rec.get('sample_hash'),
-                local_path=local_rec['local_path'],
-                remote_path=remote_rec['remote_path'],
-                remote_ref=remote_rec['remote_ref'],
-                storage_status='both'
-            )
-            db.set_message_status(chat_id, msg_id, 'downloaded', 'available in local and remote')
+            message_rows.append({
+                'message_id': msg_id,
+                'file_path': local_rec['file_path'],
+                'file_size': local_rec['file_size'],
+                'sample_hash': local_rec.get('sample_hash') or remote_rec.get('sample_hash'),
+                'local_path': local_rec['local_path'],
+                'remote_path': remote_rec['remote_path'],
+                'remote_ref': remote_rec['remote_ref'],
+                'storage_status': 'both'
+            })
+            status_rows.append((chat_id, msg_id, 'downloaded', 'available in local and remote'))
             stats['both_updated'] += 1
         elif local_rec:
             # Local only
-            db.add_message(
-                chat_id=chat_id,
-                message_id=msg_id,
-                filename=local_rec['filename'],
-                file_path=local_rec['file_path'],
-                file_size=local_rec['file_size'],
-                sample_hash=local_rec.get('sample_hash'),
-                local_path=local_rec['local_path'],
-                storage_status='local'
-            )
-            db.set_message_status(chat_id, msg_id, 'downloaded', 'available locally')
+            message_rows.append({
+                'message_id': msg_id,
+                'file_path': local_rec['file_path'],
+                'file_size': local_rec['file_size'],
+                'sample_hash': local_rec.get('sample_hash'),
+                'local_path': local_rec['local_path'],
+                'storage_status': 'local'
+            })
+            status_rows.append((chat_id, msg_id, 'downloaded', 'available locally'))
             stats['local_updated'] += 1
         elif remote_rec:
             # Remote only
-            db.add_message(
-                chat_id=chat_id,
-                message_id=msg_id,
-                filename=remote_rec['filename'],
-                file_size=remote_rec['file_size'],
-                sample_hash=remote_rec.get('sample_hash'),
-                remote_path=remote_rec['remote_path'],
-                remote_ref=remote_rec['remote_ref'],
-                storage_status='remote'
-            )
-            db.set_message_status(chat_id, msg_id, 'downloaded', 'available remotely')
+            message_rows.append({
+                'message_id': msg_id,
+                'file_size': remote_rec['file_size'],
+                'sample_hash': remote_rec.get('sample_hash'),
+                'remote_path': remote_rec['remote_path'],
+                'remote_ref': remote_rec['remote_ref'],
+                'storage_status': 'remote'
+            })
+            status_rows.append((chat_id, msg_id, 'downloaded', 'available remotely'))
             stats['remote_updated'] += 1
     
+    if message_rows:
+        db.add_messages_bulk(chat_id, message_rows)
+        db.bulk_set_message_status(status_rows)
+    
     return stats
 
 
+HASH_INDEX_BATCH_SIZE = 5000
+
+
 def sync_hash_index(db, all_records):
     """
-    Build global hash index from all records.
+    Build global hash index from all records (any iterable), registering them
+    in batches of HASH_INDEX_BATCH_SIZE so memory and transaction length stay
+    bounded.
     
     Returns:
         Number of hash entries created
     """
-    hash_records = []
-    
-    for rec in all_records:
-        if rec.get('sample_hash') and rec.get('file_size', 0) > 0:
-            hash_records.append({
-                'file_size': rec['file_size'],
-                'sample_hash': rec['sample_hash'],
-                'file_path': rec.get('file_path') or rec.get('local_path'),
-                'message_id': rec.get('message_id'),
-                'chat_id': rec.get('chat_id'),
-                'storage_location': rec.get('storage_status', 'local'),
-                'remote_ref': rec.get('remote_ref')
-            })
+    hash_records = (
+        {
+            'file_size': rec['file_size'],
+            'sample_hash': rec['sample_hash'],
+            'file_path': rec.get('file_path') or rec.get('local_path'),
+            'message_id': rec.get('message_id'),
+            'chat_id': rec.get('chat_id'),
+            'storage_location': rec.get('storage_status', 'local'),
+            'remote_ref': rec.get('remote_ref')
+        }
+        for rec in all_records
+        if rec.get('sample_hash') and rec.get('file_size', 0) > 0
+    )
     
-    return db.bulk_register_hashes(hash_records)
+    total = 0
+    while True:
+        batch = list(islice(hash_records, HASH_INDEX_BATCH_SIZE))
+        if not batch:
+            return total
+        total += db.bulk_register_hashes(batch)
 
 
 def _norm_path(path):
@@ -247,19 +273,23 @@ def _norm_path(path):
     return os.path.normpath(str(path)).replace('\\', '/').strip()
 
 
+_AMBIGUOUS = object()
+
+
 def _build_basename_index(paths_to_msg_ids):
     """Build basename -> unique message_id map from a path index."""
-    grouped = defaultdict(set)
+    by_base = {}
     for path, msg_id in paths_to_msg_ids.items():
         base = os.path.basename(path)
-        if base:
-            grouped[base].add(msg_id)
+        if not base:
+            continue
+        seen = by_base.get(base)
+        if seen is None:
+            by_base[base] = msg_id
+        elif seen is not _AMBIGUOUS and seen != msg_id:
+            by_base[base] = _AMBIGUOUS
 
-    unique_map = {}
-    for base, msg_ids in grouped.items():
-        if len(msg_ids) == 1:
-            unique_map[base] = next(iter(msg_ids))
-    return unique_map
+    return {base: msg_id for base, msg_id in by_base.items() if msg_id is not _AMBIGUOUS}
 
 
 def resolve_message_ids_from_state(local_records, remote_records, existing_messages):
@@ -439,85 +469,101 @@ def sync_state(backup_dir, remote_path=None, dry_run=False):
         'hashes_indexed': 0
     }
     
-    all_records = []
+    # Existing message locations for every chat, fetched in one query
+    existing_by_chat = db.get_message_locations_by_chat() if not dry_run else {}
+    synced_chat_ids = set()
     
-    with Progress(
-        SpinnerColumn(),
-        TextColumn("[progress.description]{task.description}"),
-        BarColumn(),
-        console=console
-    ) as progress:
-        task = progress.add_task("Syncing chats...", total=len(chats_to_sync))
-        
-        for chat_name in chats_to_sync:
-            progress.update(task, description=f"Syncing: {chat_name[:30]}...")
-            
-            # Get or create chat in database
-            chat_id = resolve_chat_id(db, existing_chats_by_name, chat_name)
-            
-            # Scan local files
-            local_records = scan_local_files(backup_dir, chat_name)
-            total_stats['local_files'] += len(local_records)
-            
-            # Scan remote files
-            remote_records = []
-            if rclone_manager and remote_path:
-                remote_records = scan_remote_files(
-                    rclone_manager,
-                    remote_path,
-                    chat_name,
-                    remote_chat_folders=remote_chats
-                )
-                total_stats['remote_files'] += len(remote_records)
+    # Remote listings are dominated by rclone process latency; start them all
+    # up front in a small pool and collect each one when its chat comes up
+    remote_scans = {}
+    remote_pool = None
+    if rclone_manager and remote_path:
+        remote_pool = ThreadPoolExecutor(max_workers=config.RCLONE_LIST_WORKERS)
+        remote_scans = {
+            chat_name: remote_pool.submit(
+                scan_remote_files,
+                rclone_manager,
+                remote_path,
+                chat_name,
+                remote_chat_folders=remote_chats
+            )
+            for chat_name in chats_to_sync
+        }
+    
+    try:
+        with Progress(
+            SpinnerColumn(),
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            console=console
+        ) as progress:
+            task = progress.add_task("Syncing chats...", total=len(chats_to_sync))
             
-            # Merge and update state
-            if not dry_run:
-                existing_messages = db.get_all_messages(chat_id)
-
-                resolution_stats = resolve_message_ids_from_state(
-                    local_records,
-                    remote_records,
-                    existing_messages
-                )
-                total_stats['resolved_by_path'] += (
-                    resolution_stats['resolved_local'] + resolution_stats['resolved_remote']
-                )
-                total_stats['unresolved_without_message_id'] += (
-                    resolution_stats['unresolved_local'] + resolution_stats['unresolved_remote']
-                )
-
-                chat_stats = sync_chat_state(db, chat_id, local_records, remote_records)
-                total_stats['total_messages'] += sum(chat_stats.values())
-
-                # Reconcile stale rows that were previously present but now missing in both local and remote
-                seen_msg_ids = {
-                    r['message_id']
-                    for r in (local_records + remote_records)
-                    if r.get('message_id') is not None
-                }
-                for row in existing_messages:
-                    msg_id = row['message_id']
-                    if msg_id in seen_msg_ids:
-                        continue
-                    if db.mark_message_missing(chat_id, msg_id):
-                        total_stats['missing_marked'] += 1
+            for chat_name in chats_to_sync:
+                progress.update(task, description=f"Syncing: {chat_name[:30]}...")
                 
-                # Track for hash index
-                for rec in local_records + remote_records:
-                    if rec.get('message_id') is None:
-                        continue
-                    rec['chat_id'] = chat_id
-                    all_records.append(rec)
+                # Get or create chat in database
+                chat_id = resolve_chat_id(db, existing_chats_by_name, chat_name)
                 
-                # Update chat stats
-                db.update_chat_stats(
-                    chat_id,
-                    total_files=len(local_records) + len(remote_records),
-                    total_bytes=sum(r.get('file_size', 0) for r in local_records + remote_records)
-                )
-            
-            total_stats['chats'] += 1
-            progress.advance(task)
+                # Scan local files
+                local_records = scan_local_files(backup_dir, chat_name, db)
+                total_stats['local_files'] += len(local_records)
+                
+                # Scan remote files
+                remote_records = []
+                if chat_name in remote_scans:
+                    remote_records = remote_scans.pop(chat_name).result()
+                    total_stats['remote_files'] += len(remote_records)
+                
+                # Merge and update state
+                if not dry_run:
+                    if chat_id in synced_chat_ids:
+                        # Two chat names resolved to the same chat; the snapshot is stale
+                        existing_messages = db.get_all_messages(chat_id)
+                    else:
+                        existing_messages = existing_by_chat.pop(chat_id, [])
+                    synced_chat_ids.add(chat_id)
+
+                    resolution_stats = resolve_message_ids_from_state(
+                        local_records,
+                        remote_records,
+                        existing_messages
+                    )
+                    total_stats['resolved_by_path'] += (
+                        resolution_stats['resolved_local'] + resolution_stats['resolved_remote']
+                    )
+                    total_stats['unresolved_without_message_id'] += (
+                        resolution_stats['unresolved_local'] + resolution_stats['unresolved_remote']
+                    )
+
+                    chat_stats = sync_chat_state(db, chat_id, local_records, remote_records)
+                    total_stats['total_messages'] += sum(chat_stats.values())
+
+                    # Reconcile stale rows that were previously present but now missing in both local and remote
+                    seen_msg_ids = {
+                        r['message_id']
+                        for r in chain(local_records, remote_records)
+                        if r.get('message_id') is not None
+                    }
+                    for row in existing_messages:
+                        msg_id = row['message_id']
+                        if msg_id in seen_msg_ids:
+                            continue
+                        if db.mark_message_missing(chat_id, msg_id):
+                            total_stats['missing_marked'] += 1
+                    
+                    # Update chat stats
+                    db.update_chat_stats(
+                        chat_id,
+                        total_files=len(local_records) + len(remote_records),
+                        total_bytes=sum(r.get('file_size', 0) for r in chain(local_records, remote_records))
+                    )
+                
+                total_stats['chats'] += 1
+                progress.advance(task)
+    finally:
+        if remote_pool is not None:
+            remote_pool.shutdown(cancel_futures=True)
     
     # Build hash index
     if not dry_run:
@@ -4,24 +4,123 @@ Telegram client initialization and session management
 from telethon import TelegramClient
 from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError, FloodWaitError
 import asyncio
+import functools
+import random
 import sys
+from pathlib import Path
 import config
 from rich.console import Console
 
-console = Console()
+try:
+    import qrcode
+except ImportError:
+    qrcode = None  # installed on first QR login attempt
 
-def log_debug(message):
-    """Print debug message if DEBUG is enabled"""
+console = Console(highlight=False, soft_wrap=True)  # auth prompts use explicit markup only
+
+def log_debug(message, *args):
+    """Print debug message if DEBUG is enabled (args are %-formatted lazily)"""
     if config.DEBUG:
-        console.print(f"[DEBUG] {message}")
+        console.print(f"[DEBUG] {message % args if args else message}")
+
+
+# Where to look for the login code, by Telethon SentCodeType class name
+_SMS_CODE_HINT = ("   • Check your SMS messages",)
+_CODE_TYPE_HINTS = {
+    'SentCodeTypeApp': (
+        "   • Check your Telegram app (any device where you're logged in)",
+        "   • Look in 'Telegram' official chat or notifications",
+        "   • [bold yellow]CHECK TELEGRAM WEB if you're logged in there![/bold yellow]",
+    ),
+    'SentCodeTypeSms': _SMS_CODE_HINT,
+    'SentCodeTypeFirebaseSms': _SMS_CODE_HINT,
+    'SentCodeTypeSmsWord': _SMS_CODE_HINT,
+    'SentCodeTypeSmsPhrase': _SMS_CODE_HINT,
+    'SentCodeTypeCall': ("   • You'll receive a phone call with the code",),
+    'SentCodeTypeMissedCall': ("   • You'll receive a missed call; the code is the end of the calling number",),
+    'SentCodeTypeFlashCall': ("   • Check for a flash SMS message",),
+    'SentCodeTypeFragmentSms': ("   • Check the anonymous number in your Fragment account",),
+    'SentCodeTypeEmailCode': ("   • Check your email",),
+}
+
+
+async def _wait_for_enter():
+    """
+    Return once the user presses Enter, without blocking the event loop.
+    Uses loop.add_reader on stdin so the wait can be cancelled cleanly; raises
+    NotImplementedError where that is unsupported (e.g. Windows event loops)
+    and EOFError if stdin is closed.
+    """
+    loop = asyncio.get_running_loop()
+    pressed = loop.create_future()
+    
+    def on_readable():
+        line = sys.stdin.readline()
+        if pressed.done():
+            return
+        if line:
+            pressed.set_result(None)
+        else:
+            pressed.set_exception(EOFError())
+    
+    fd = sys.stdin.fileno()
+    loop.add_reader(fd, on_readable)
+    try:
+        await pressed
+    finally:
+        loop.remove_reader(fd)
+
+
+def _cleanup_session_files(session_name):
+    """Remove the Telethon session file and its journal"""
+    for file in (f"{session_name}.session", f"{session_name}.session-journal"):
+        try:
+            Path(file).unlink(missing_ok=True)
+            log_debug("Removed %s", file)
+        except OSError as e:
+            log_debug("Could not remove %s: %s", file, e)
 
 
 class TelegramClientManager:
+    # Auth requests are retried with exponential backoff plus jitter, capped here
+    AUTH_RETRY_MAX_DELAY = 30.0  # seconds
+    AUTH_RETRY_JITTER = 0.5  # up to +50% of the backoff delay
+    QR_LOGIN_TIMEOUT = 30  # seconds to wait for a QR scan before falling back
+    
     def __init__(self):
         self.client = None
+    
+    async def _retry(self, request, recoverable=(FloodWaitError, ConnectionError, asyncio.TimeoutError)):
+        """
+        Await request() and retry it up to config.MAX_RETRIES times on transient
+        errors, sleeping config.RETRY_DELAY * 2**attempt (with jitter) in between.
+        A FloodWaitError waits the requested time plus a small random splay;
+        waits longer than AUTH_RETRY_MAX_DELAY are raised straight away.
+        """
+        attempt = 0
+        while True:
+            try:
+                return await request()
+            except recoverable as e:
+                if attempt >= config.MAX_RETRIES:
+                    raise
+                if isinstance(e, FloodWaitError):
+                    if e.seconds > self.AUTH_RETRY_MAX_DELAY:
+                        raise
+                    delay = e.seconds + random.uniform(0, 2)
+                else:
+                    delay = config.RETRY_DELAY * (2 ** attempt) * (1 + random.random() * self.AUTH_RETRY_JITTER)
+                delay = min(delay, self.AUTH_RETRY_MAX_DELAY)
+                attempt += 1
+                log_debug("%s; retry %s/%s in %.1fs", type(e).__name__, attempt, config.MAX_RETRIES, delay)
+                await asyncio.sleep(delay)
         
     async def initialize(self):
         """Initialize and connect the Telegram client"""
+        if self.client is not None and self.client.is_connected():
+            log_debug("Reusing connected Telegram client")
+            return self.client
+        
         log_debug("Initializing Telegram client...")
         
         if config.API_ID == 0 or not config.API_HASH:
@@ -30,7 +129,7 @@ class TelegramClientManager:
                 "Get them from https://my.telegram.org/apps"
             )
         
-        log_debug(f"Creating client with session: {config.SESSION_NAME}")
+        log_debug("Creating client with session: %s", config.SESSION_NAME)
         self.client = TelegramClient(
             config.SESSION_NAME,
             config.API_ID,
@@ -67,12 +166,16 @@ class TelegramClientManager:
     
     async def _authorize_qr(self):
         """Handle QR code authorization"""
-        try:
-            import qrcode
-        except ImportError:
+        global qrcode
+        if qrcode is None:
             console.print("[bold red]QR code library not installed. Installing...[/bold red]")
-            import subprocess
-            subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'qrcode'])
+            # Install without blocking the event loop (keeps the connection alive)
+            proc = await asyncio.create_subprocess_exec(sys.executable, '-m', 'pip', 'install', 'qrcode')
+            if await proc.wait() != 0:
+                console.print("[red]⚠️  Could not install qrcode.[/red]")
+                console.print("[yellow]Falling back to phone number authentication...[/yellow]\n")
+                await self._authorize_phone()
+                return
             import qrcode
         
         console.print("\n[bold blue]🔲 QR Code Authentication[/bold blue]")
@@ -87,7 +190,7 @@ class TelegramClientManager:
             qr = qrcode.QRCode(
                 version=1,
                 error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
+                box_size=1,
                 border=4,
             )
             qr.add_data(qr_login.url)
@@ -100,10 +203,25 @@ class TelegramClientManager:
             qr.print_ascii(invert=True)
             
             console.print("\n[dim]Waiting for you to scan the QR code...[/dim]")
-            console.print("[dim](QR code will expire in 30 seconds)[/dim]\n")
+            console.print(f"[dim](QR code will expire in {self.QR_LOGIN_TIMEOUT} seconds; press Enter to use your phone number instead)[/dim]\n")
             
-            # Wait for user to scan
-            await qr_login.wait()
+            # Wait for the scan, or for Enter to switch to phone login right away
+            scan_task = asyncio.create_task(qr_login.wait(timeout=self.QR_LOGIN_TIMEOUT))
+            enter_task = asyncio.create_task(_wait_for_enter())
+            done, _ = await asyncio.wait({scan_task, enter_task}, return_when=asyncio.FIRST_COMPLETED)
+            if scan_task not in done:
+                try:
+                    enter_task.result()
+                except (NotImplementedError, EOFError, OSError, ValueError):
+                    # stdin cannot be watched here; just wait for the scan
+                    await scan_task
+                else:
+                    scan_task.cancel()
+                    console.print("[yellow]Switching to phone number authentication...[/yellow]\n")
+                    await self._authorize_phone()
+                    return
+            enter_task.cancel()
+            scan_task.result()
             console.print("[green]✓ QR code scanned successfully![/green]")
             
         except asyncio.TimeoutError:
@@ -113,7 +231,7 @@ class TelegramClientManager:
             return
         except Exception as e:
             error_msg = str(e)
-            log_debug(f"QR login error: {error_msg}")
+            log_debug("QR login error: %s", error_msg)
             
             # Check if it's actually successful despite the error
             if await self.client.is_user_authorized():
@@ -134,10 +252,10 @@ class TelegramClientManager:
         # Add + if missing
         if not phone.startswith('+'):
             phone = '+' + phone
-            log_debug(f"Added + prefix to phone number: {phone}")
+            log_debug("Added + prefix to phone number: %s", phone)
         
-        log_debug(f"Sending code request to {phone}")
-        sent_code = await self.client.send_code_request(phone)
+        log_debug("Sending code request to %s", phone)
+        sent_code = await self._retry(lambda: self.client.send_code_request(phone))
         
         console.print("[green]✓ Code sent successfully![/green]\n")
         console.print("[bold blue]📱 Where to find your code:[/bold blue]")
@@ -148,17 +266,8 @@ class TelegramClientManager:
             if hasattr(code_type, 'length'):
                 console.print(f"   • Look for a [bold]{code_type.length}[/bold]-digit code")
             
-            type_name = type(code_type).__name__
-            if 'App' in type_name:
-                console.print("   • Check your Telegram app (any device where you're logged in)")
-                console.print("   • Look in 'Telegram' official chat or notifications")
-                console.print("   • [bold yellow]CHECK TELEGRAM WEB if you're logged in there![/bold yellow]")
-            elif 'Sms' in type_name:
-                console.print("   • Check your SMS messages")
-            elif 'Call' in type_name:
-                console.print("   • You'll receive a phone call with the code")
-            elif 'Flash' in type_name:
-                console.print("   • Check for a flash SMS message")
+            for line in _CODE_TYPE_HINTS.get(type(code_type).__name__, ()):
+                console.print(line)
         else:
             console.print("   • Check your Telegram app on any device where you're logged in")
             console.print("   • [bold yellow]CHECK TELEGRAM WEB - codes often appear there![/bold yellow]")
@@ -184,11 +293,11 @@ class TelegramClientManager:
             if code.lower() == 'resend':
                 try:
                     log_debug("Resending code...")
-                    await self.client.send_code_request(phone)
+                    await self._retry(lambda: self.client.send_code_request(phone))
                     console.print("[green]✓ Code resent successfully![/green]\n")
                 except FloodWaitError as e:
                     console.print(f"[yellow]⏳ Please wait {e.seconds} seconds before requesting another code.[/yellow]\n")
-                    log_debug(f"FloodWaitError: {e.seconds} seconds")
+                    log_debug("FloodWaitError: %s seconds", e.seconds)
                 except Exception as e:
                     error_msg = str(e)
                     if "SEND_CODE_UNAVAILABLE" in error_msg or "available options" in error_msg.lower():
@@ -197,15 +306,15 @@ class TelegramClientManager:
                         console.print("[bold yellow]    1. Use the code you already received (check Telegram Web!)[/bold yellow]")
                         console.print("[bold yellow]    2. Wait 10-15 minutes and try again[/bold yellow]")
                         console.print("[bold yellow]    3. Restart and use QR code login (option 2)[/bold yellow]\n")
-                        log_debug(f"Resend error: {error_msg}")
+                        log_debug("Resend error: %s", error_msg)
                     else:
                         console.print(f"[bold red]⚠️  Failed to resend code: {error_msg[:80]}[/bold red]\n")
-                        log_debug(f"Unexpected resend error: {error_msg}")
+                        log_debug("Unexpected resend error: %s", error_msg)
                 continue
             
             try:
                 log_debug("Attempting to sign in with code")
-                await self.client.sign_in(phone, code)
+                await self._retry(lambda: self.client.sign_in(phone, code))
                 break
             except PhoneCodeInvalidError:
                 console.print("[bold red]✗ Invalid code. Please try again.[/bold red]\n")
@@ -213,36 +322,24 @@ class TelegramClientManager:
             except SessionPasswordNeededError:
                 log_debug("Two-factor authentication required")
                 password = console.input("[bold yellow]Two-factor authentication enabled. Enter your password:[/bold yellow] ")
-                await self.client.sign_in(password=password)
+                await self._retry(lambda: self.client.sign_in(password=password))
                 break
         
         console.print("[green]✓ Authentication successful![/green]\n")
     
     async def logout(self):
         """Logout and remove session"""
-        import os
-        
         if self.client:
             try:
                 log_debug("Logging out from Telegram...")
                 await self.client.log_out()
                 log_debug("Logged out successfully")
             except Exception as e:
-                log_debug(f"Logout error (might be already logged out): {e}")
+                log_debug("Logout error (might be already logged out): %s", e)
             
             await self.client.disconnect()
         
-        # Remove session files
-        session_file = f"{config.SESSION_NAME}.session"
-        session_journal = f"{config.SESSION_NAME}.session-journal"
-        
-        for file in [session_file, session_journal]:
-            if os.path.exists(file):
-                try:
-                    os.remove(file)
-                    log_debug(f"Removed {file}")
-                except Exception as e:
-                    log_debug(f"Could not remove {file}: {e}")
+        _cleanup_session_files(config.SESSION_NAME)
         
         console.print("[green]✓ Logged out successfully. Session cleared.[/green]\n")
     
@@ -254,3 +351,9 @@ class TelegramClientManager:
     def get_client(self):
         """Get the active client"""
         return self.client
+
+
+@functools.lru_cache(maxsize=None)
+def get_manager():
+    """Return the process-wide TelegramClientManager so the connection is reused"""
+    return TelegramClientManager()
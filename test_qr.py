@@ -8,7 +8,7 @@ test_url = "tg://login?token=abcdef123456"
 qr = qrcode.QRCode(
     version=1,
     error_correction=qrcode.constants.ERROR_CORRECT_L,
-    box_size=10,
+    box_size=1,
     border=4,
 )
 qr.add_data(test_url)
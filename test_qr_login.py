@@ -26,7 +26,7 @@ async def test_qr():
         qr = qrcode.QRCode(
             version=1,
             error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
+            box_size=1,
             border=4,
         )
         qr.add_data(qr_login.url)
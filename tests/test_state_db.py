@@ -0,0 +1,52 @@
+"""
+Tests for DatabaseManager connection handling.
+Run with: python -m unittest discover -s tests
+"""
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from state_db import DatabaseManager
+
+
+class TransactionVisibilityTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = DatabaseManager(os.path.join(self.tmpdir.name, "test.db"))
+        self.chat_id = self.db.get_or_create_chat("chat", "hash")
+
+    def tearDown(self):
+        self.db.close()
+        self.tmpdir.cleanup()
+
+    def test_read_inside_transaction_sees_uncommitted_write(self):
+        with self.db.transaction():
+            self.db.add_message(self.chat_id, 1, "a.jpg", "/tmp/a.jpg", 10)
+            message = self.db.get_message(self.chat_id, 1)
+            self.assertIsNotNone(message)
+            self.assertEqual(message['file_size'], 10)
+
+    def test_nested_write_joins_outer_transaction(self):
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.add_message(self.chat_id, 2, "b.jpg", "/tmp/b.jpg", 20)
+                raise RuntimeError("abort")
+        self.assertIsNone(self.db.get_message(self.chat_id, 2))
+
+    def test_other_threads_do_not_see_uncommitted_write(self):
+        seen = []
+        with self.db.transaction():
+            self.db.add_message(self.chat_id, 3, "c.jpg", "/tmp/c.jpg", 30)
+            reader = threading.Thread(target=lambda: seen.append(self.db.get_message(self.chat_id, 3)))
+            reader.start()
+            reader.join()
+        self.assertEqual(seen, [None])
+        self.assertIsNotNone(self.db.get_message(self.chat_id, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
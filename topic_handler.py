@@ -2,14 +2,38 @@
 Forum topic detection and handling for Telegram backup.
 Helps identify and process forum topics in chats.
 """
+import asyncio
+from collections import namedtuple
 from telethon.tl.types import Channel
 import config
 
+# Forum topics RPC: messages.GetForumTopicsRequest (peer) on current Telethon,
+# channels.GetForumTopicsRequest (channel) on older releases
+try:
+    from telethon.tl.functions.messages import GetForumTopicsRequest
+    _FORUM_TOPICS_PEER_ARG = 'peer'
+except ImportError:
+    try:
+        from telethon.tl.functions.channels import GetForumTopicsRequest
+        _FORUM_TOPICS_PEER_ARG = 'channel'
+    except ImportError:
+        GetForumTopicsRequest = None
 
-def log_debug(message):
-    """Print debug message if DEBUG is enabled"""
+TOPICS_PAGE_SIZE = 100  # server maximum per GetForumTopicsRequest
+TOPIC_IDS_PER_REQUEST = 100  # server maximum ids per messages.GetMessages
+TOPIC_TITLE_CONCURRENCY = 5  # per-topic title lookups in flight when batching fails
+TOPIC_MESSAGES_PAGE_SIZE = 100  # server maximum per messages.GetReplies page
+TOPIC_FETCH_CONCURRENCY = 4  # topics fetched at once, kept low to avoid flood waits
+
+
+# A forum topic; title is None when it could not be resolved (see get_topic_name)
+Topic = namedtuple('Topic', 'id title')
+
+
+def log_debug(message, *args):
+    """Print debug message if DEBUG is enabled (args are %-formatted lazily)"""
     if config.DEBUG:
-        print(f"[DEBUG] {message}")
+        print(f"[DEBUG] {message % args if args else message}")
 
 
 class TopicHandler:
@@ -18,107 +42,230 @@ class TopicHandler:
         Initialize topic handler for a Telegram client.
         """
         self.client = client
+        # Topics per entity id for this run (each scan costs up to 1000
+        # messages of history); see invalidate()
+        self._topics_cache = {}
+        self._forum_cache = {}  # entity id -> is_forum result
 
-    async def is_forum(self, entity):
+    def invalidate(self, entity_id=None):
         """
-        Return True if the entity is a forum-enabled chat.
+        Drop cached topics (and forum flags) for one entity id, or for all entities.
         """
-        if not isinstance(entity, Channel):
-            return False
-        return getattr(entity, 'forum', False)
+        if entity_id is None:
+            self._topics_cache.clear()
+            self._forum_cache.clear()
+        else:
+            self._topics_cache.pop(entity_id, None)
+            self._forum_cache.pop(entity_id, None)
+
+    def is_forum(self, entity):
+        """
+        Return True if the entity is a forum-enabled chat (memoized per entity id).
+        """
+        key = getattr(entity, 'id', id(entity))
+        cached = self._forum_cache.get(key)
+        if cached is None:
+            cached = isinstance(entity, Channel) and bool(getattr(entity, 'forum', False))
+            self._forum_cache[key] = cached
+        return cached
 
     async def get_topics(self, entity):
         """
         Fetch all topics from a forum chat.
-        Returns a list of topic objects or dicts.
-        Note: GetForumTopicsRequest is not available in this version of Telethon,
-        so we use the fallback message scanning method.
+        Returns a list of Topic tuples. Results are cached per
+        entity for the lifetime of this handler (see invalidate()).
+        Uses GetForumTopicsRequest when Telethon provides it, and falls back
+        to scanning recent messages when it is missing or the request fails.
         """
-        if not await self.is_forum(entity):
+        # Same test as is_forum, inlined: this runs once per chat when
+        # enumerating dialogs
+        if not isinstance(entity, Channel) or not getattr(entity, 'forum', False):
             return []
         
-        log_debug("Fetching topics from forum (using message scanning)")
-        # Use message scanning fallback since GetForumTopicsRequest is not available
-        topics = await self._extract_topics_from_messages(entity)
-        return topics
+        entity_id = getattr(entity, 'id', None)
+        if entity_id is not None and entity_id in self._topics_cache:
+            return list(self._topics_cache[entity_id])
+        
+        topics = None
+        if GetForumTopicsRequest is not None:
+            try:
+                topics = await self._fetch_forum_topics(entity)
+            except Exception as e:
+                log_debug("GetForumTopicsRequest failed, scanning messages instead: %s", e)
+        
+        if topics is None:
+            log_debug("Fetching topics from forum (using message scanning)")
+            topics = await self._extract_topics_from_messages(entity)
+        if entity_id is not None:
+            self._topics_cache[entity_id] = topics
+        return list(topics)
+
+    async def _fetch_forum_topics(self, entity):
+        """
+        Fetch all topics of a forum with GetForumTopicsRequest, one page of
+        TOPICS_PAGE_SIZE per request. Deleted topics are skipped.
+        Returns a list of Topic tuples.
+        """
+        topics = {}
+        offset_date, offset_id, offset_topic = None, 0, 0
+        while True:
+            result = await self.client(GetForumTopicsRequest(**{
+                _FORUM_TOPICS_PEER_ARG: entity,
+                'offset_date': offset_date,
+                'offset_id': offset_id,
+                'offset_topic': offset_topic,
+                'limit': TOPICS_PAGE_SIZE
+            }))
+            for topic in result.topics:
+                title = getattr(topic, 'title', None)
+                if title:
+                    topics[topic.id] = Topic(topic.id, title)
+            
+            if len(result.topics) < TOPICS_PAGE_SIZE or len(topics) >= result.count:
+                break
+            # Next page starts after the last topic (keyed by its top message)
+            last = result.topics[-1]
+            top_message = next((m for m in result.messages
+                                if m.id == getattr(last, 'top_message', None)), None)
+            offset_date = getattr(top_message, 'date', None)
+            offset_id = getattr(last, 'top_message', 0)
+            offset_topic = last.id
+        
+        log_debug("Found %s topics via GetForumTopicsRequest", len(topics))
+        return list(topics.values())
 
     async def _extract_topics_from_messages(self, entity):
         """
         Extract topics by scanning messages in a chat.
-        Returns a list of topic dicts.
+        Topic IDs are collected first, then their root messages (used as
+        titles) are fetched in concurrent get_messages calls of up to
+        TOPIC_IDS_PER_REQUEST ids each.
+        Returns a list of Topic tuples (title None when the root message has
+        no text).
         """
         topics_dict = {}
         try:
             log_debug("Extracting topics from messages")
+            topic_ids = {}  # dict as an insertion-ordered set
             async for message in self.client.iter_messages(entity, limit=1000):
-                if hasattr(message, 'reply_to') and message.reply_to:
-                    # Forum topics use reply_to_msg_id for the root topic message
-                    # Check for forum_topic attribute (if present) or reply_to_msg_id
-                    topic_id = None
-                    if hasattr(message.reply_to, 'forum_topic') and message.reply_to.forum_topic:
-                        # This is a forum topic message
-                        topic_id = message.reply_to.reply_to_msg_id
-                    elif hasattr(message.reply_to, 'reply_to_msg_id') and message.reply_to.reply_to_msg_id:
-                        # Could be a forum topic or regular reply - check if message is part of a topic thread
-                        topic_id = message.reply_to.reply_to_msg_id
-                    
-                    if topic_id and topic_id not in topics_dict:
-                        # Try to get the actual topic title from the first message
-                        try:
-                            topic_msg = await self.client.get_messages(entity, ids=topic_id)
-                            if topic_msg and hasattr(topic_msg, 'message') and topic_msg.message:
-                                title = topic_msg.message[:50]  # Limit title length
-                            else:
-                                title = f"Topic {topic_id}"
-                        except Exception as e:
-                            log_debug(f"Failed to fetch topic message {topic_id}: {e}")
-                            title = f"Topic {topic_id}"
-                        
-                        topics_dict[topic_id] = {
-                            'id': topic_id,
-                            'title': title
-                        }
+                # Every Message/MessageService has reply_to; most are None
+                reply_to = message.reply_to
+                if reply_to is None:
+                    continue
+                # Forum topics use reply_to_msg_id for the root topic message
+                # (set for forum_topic replies and regular thread replies alike)
+                topic_id = getattr(reply_to, 'reply_to_msg_id', None)
+                if not topic_id:
+                    continue
+                topic_ids.setdefault(topic_id, None)
+            
+            titles = {}
+            ids = list(topic_ids)
+            chunks = [ids[i:i + TOPIC_IDS_PER_REQUEST] for i in range(0, len(ids), TOPIC_IDS_PER_REQUEST)]
+            for topic_msgs in await asyncio.gather(*(self._fetch_topic_messages(entity, chunk) for chunk in chunks)):
+                for topic_msg in topic_msgs:
+                    if topic_msg and getattr(topic_msg, 'message', None):
+                        titles[topic_msg.id] = topic_msg.message[:50]  # Limit title length
+            
+            for topic_id in topic_ids:
+                topics_dict[topic_id] = Topic(topic_id, titles.get(topic_id))
             
-            log_debug(f"Found {len(topics_dict)} topics via message scanning")
+            log_debug("Found %s topics via message scanning", len(topics_dict))
         except Exception as e:
-            log_debug(f"Error extracting topics from messages: {e}")
+            log_debug("Error extracting topics from messages: %s", e)
         
         return list(topics_dict.values())
 
-    async def get_topic_messages(self, entity, topic_id, limit=None):
+    async def _fetch_topic_messages(self, entity, topic_ids):
         """
-        Get messages from a specific topic in a forum chat.
-        Returns a list of messages.
+        Fetch the root messages for a chunk of topic IDs in one request,
+        falling back to one request per ID if the batch fails.
         """
         try:
-            messages = []
+            return await self.client.get_messages(entity, ids=topic_ids)
+        except Exception as e:
+            log_debug("Batched topic message fetch failed, fetching one by one: %s", e)
+            return await self._fetch_topic_messages_individually(entity, topic_ids)
+
+    async def _fetch_topic_messages_individually(self, entity, topic_ids):
+        """
+        Fetch topic root messages one request per ID, at most
+        TOPIC_TITLE_CONCURRENCY at a time. Failed lookups come back as None.
+        """
+        semaphore = asyncio.Semaphore(TOPIC_TITLE_CONCURRENCY)
+        
+        async def fetch(topic_id):
+            async with semaphore:
+                return await self.client.get_messages(entity, ids=topic_id)
+        
+        results = await asyncio.gather(*(fetch(topic_id) for topic_id in topic_ids),
+                                       return_exceptions=True)
+        return [None if isinstance(result, BaseException) else result for result in results]
+
+    async def iter_topic_messages(self, entity, topic_id, limit=None):
+        """
+        Stream messages from a specific topic in a forum chat, one at a time.
+        Errors are logged and end the stream.
+        """
+        count = 0
+        try:
             async for message in self.client.iter_messages(
                 entity,
                 limit=limit,
                 reply_to=topic_id
             ):
-                messages.append(message)
-            log_debug(f"Retrieved {len(messages)} messages from topic {topic_id}")
-            return messages
+                count += 1
+                yield message
         except Exception as e:
-            log_debug(f"Error getting messages for topic {topic_id}: {e}")
-            return []
+            log_debug("Error getting messages for topic %s: %s", topic_id, e)
+            return
+        log_debug("Retrieved %s messages from topic %s", count, topic_id)
+
+    async def get_topic_messages(self, entity, topic_id, limit=None):
+        """
+        Get messages from a specific topic in a forum chat.
+        Returns a list of messages; prefer iter_topic_messages for large topics.
+        """
+        return [message async for message in self.iter_topic_messages(entity, topic_id, limit=limit)]
 
     def get_topic_name(self, topic):
         """
-        Extract a topic name from a topic object or dict.
-        """
-        # Prefer .title attribute if present (Telethon topic object)
-        if hasattr(topic, 'title') and getattr(topic, 'title', None):
-            return topic.title
-        # If dict, prefer 'title' key if not default
-        if isinstance(topic, dict):
-            title = topic.get('title', '')
-            topic_id = topic.get('id', None)
-            if title and topic_id and title != f"Topic {topic_id}":
-                return title
-            if topic_id:
-                return f"Topic {topic_id}"
-            return title or 'Unknown Topic'
-        # fallback
-        return f"Topic {getattr(topic, 'id', 'unknown')}"
+        Return the folder name for a Topic: its title, or "Topic <id>".
+        """
+        return topic.title or f"Topic {topic.id}"
+
+    async def get_topic_messages_bulk(self, entity, topic_ids, limit=None, concurrency=TOPIC_FETCH_CONCURRENCY):
+        """
+        Fetch messages for several topics at once, at most `concurrency` topics
+        in flight. Each topic is paged with get_messages(offset_id=...).
+        Returns a dict of topic id -> list of messages (newest first); a topic
+        whose fetch fails keeps the messages retrieved before the error.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def fetch(topic_id):
+            messages = []
+            offset_id = 0
+            async with semaphore:
+                try:
+                    while limit is None or len(messages) < limit:
+                        page_size = TOPIC_MESSAGES_PAGE_SIZE
+                        if limit is not None:
+                            page_size = min(page_size, limit - len(messages))
+                        page = await self.client.get_messages(
+                            entity,
+                            limit=page_size,
+                            reply_to=topic_id,
+                            offset_id=offset_id
+                        )
+                        messages.extend(page)
+                        if len(page) < page_size:
+                            break
+                        offset_id = page[-1].id
+                except Exception as e:
+                    log_debug("Error getting messages for topic %s: %s", topic_id, e)
+            log_debug("Retrieved %s messages from topic %s", len(messages), topic_id)
+            return topic_id, messages
+        
+        results = await asyncio.gather(*(asyncio.create_task(fetch(topic_id)) for topic_id in topic_ids))
+        return dict(results)
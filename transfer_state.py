@@ -1,22 +1,42 @@
 """
 Persistent transfer state for cumulative auto-transfer thresholds.
 """
-import json
+import atexit
 import os
+import time
+import weakref
 from datetime import datetime
 
+from state_db import json_dumps_bytes, json_loads
+
+# Live instances, flushed once at exit; weak so they can still be collected
+_live_states = weakref.WeakSet()
+
+
+def _flush_all():
+    for state in list(_live_states):
+        state.flush()
+
+
+atexit.register(_flush_all)
+
 
 class TransferState:
+    SAVE_INTERVAL = 1.0  # seconds between debounced writes from add_downloaded_bytes
+
     def __init__(self, output_dir):
         self.output_dir = output_dir
         self.state_file = os.path.join(output_dir, ".cloud_transfer_state.json")
         self.state = self._load_state()
+        self._dirty = False
+        self._last_save = 0.0
+        _live_states.add(self)
 
     def _load_state(self):
         if os.path.exists(self.state_file):
             try:
-                with open(self.state_file, "r", encoding="utf-8") as f:
-                    data = json.load(f)
+                with open(self.state_file, "rb") as f:
+                    data = json_loads(f.read())
                 if isinstance(data, dict):
                     return data
             except Exception:
@@ -30,13 +50,31 @@ class TransferState:
 
     def _save_state(self):
         os.makedirs(self.output_dir, exist_ok=True)
-        with open(self.state_file, "w", encoding="utf-8") as f:
-            json.dump(self.state, f, indent=2)
+        # Write a temp file and swap it in so a crash never leaves a truncated file
+        data = json_dumps_bytes(self.state, indent=True)
+        tmp_file = f"{self.state_file}.tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.state_file)
+        self._dirty = False
+        self._last_save = time.monotonic()
+
+    def _maybe_save(self):
+        if time.monotonic() - self._last_save >= self.SAVE_INTERVAL:
+            self._save_state()
+
+    def flush(self):
+        """Write pending changes (also runs at interpreter exit)."""
+        if self._dirty:
+            self._save_state()
 
     def add_downloaded_bytes(self, count):
         current = int(self.state.get("cumulative_bytes_since_transfer", 0) or 0)
         self.state["cumulative_bytes_since_transfer"] = max(0, current + int(count or 0))
-        self._save_state()
+        self._dirty = True
+        self._maybe_save()
         return self.state["cumulative_bytes_since_transfer"]
 
     def get_cumulative_bytes(self):